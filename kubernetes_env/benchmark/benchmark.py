@@ -5,14 +5,12 @@ import subprocess
 import os
 import sys
 import signal
-import requests
 import time
-import seaborn as sns
-import pandas as pd
+import asyncio
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor
-import numpy as np
-import matplotlib.pyplot as plt
+import multiprocessing
+import queue as queue_module
 import json
 from pathlib import Path
 
@@ -20,14 +18,37 @@ DIRS = Path(__file__).resolve().parents
 sys.path.append(str(DIRS[1]))
 import kube_env
 import kube_util as util
+import namespaces
+import readiness
+import wasm_tools
+from histogram import (OutcomeHistograms, status_outcome, dump_histograms,
+                       SUCCESS, TIMEOUT, CONNECTION_ERROR)
+from timeseries import TimeSeries, TimeSeriesWriter
+from result_sink import (ResultSink, histograms_from_records,
+                         records_to_columns, OUTCOMES)
+import results_store
 
 log = logging.getLogger(__name__)
 FILE_DIR = DIRS[0]
 FILTER_DIR = FILE_DIR.joinpath("rs-empty-filter")
-GRAPHS_DIR = FILE_DIR.joinpath("graphs")
-DATA_DIR = FILE_DIR.joinpath("data")
-NPY_DIR = FILE_DIR.joinpath("npy")
+# benchmarks running next to each other each get their own work directory
+WORK_DIR_ENV = "KUBE_ENV_WORK_DIR"
+WORK_DIR = Path(os.environ.get(WORK_DIR_ENV) or FILE_DIR)
+GRAPHS_DIR = WORK_DIR.joinpath("graphs")
+DATA_DIR = WORK_DIR.joinpath("data")
+NPY_DIR = WORK_DIR.joinpath("npy")
 FORTIO_DIR = DIRS[2].joinpath("bin/fortio")
+# seconds until a request counts as timed out
+REQUEST_TIMEOUT = 3
+# upper bound of concurrently open connections of the async load generator
+ASYNC_MAX_CONNECTIONS = 1000
+# bins of the loadgen latency histogram plot
+HIST_BINS = 50
+# warn if a load generator worker spends more than this share of its time
+# on the CPU, at that point we measure the client and not the application
+CLIENT_CPU_WARN = 0.9
+# how often the sharded load generator checks that its workers are alive
+WORKER_POLL = 1
 
 # Hotel Reservation(HR) is not supported as an application
 APPLICATIONS = {
@@ -42,7 +63,10 @@ def sec_to_ms(res_time):
     return round(float(res_time) * 1000, 3)
 
 
-def plot(dfs, filters, plot_name, custom):
+def plot(dfs, filters, plot_name, custom, series=None):
+    # the plotting stack is slow to import, only load it when plotting
+    import seaborn as sns
+    import matplotlib.pyplot as plt
     if custom == "locust":
         for df in dfs:
             sns.lineplot(data=df, x="Latency (ms)", y="Percent")
@@ -55,12 +79,30 @@ def plot(dfs, filters, plot_name, custom):
         plt.legend(labels=filters)
         plt.title(plot_name)
     elif custom == "loadgen":
-        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(18, 6))
-        dplot = sns.ecdfplot(dfs, ax=ax1)
+        # dfs holds one result per filter, plot directly from the buckets.
+        # Failed and timed out requests are included, otherwise the latency
+        # looks better the more requests fail.
+        df = histograms_to_frame({fname: result.combined()
+                                  for fname, result in dfs.items()})
+        if series:
+            fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(27, 6))
+        else:
+            fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(18, 6))
+        dplot = sns.ecdfplot(data=df, x="Latency (ms)", weights="Count",
+                             hue="Filter", ax=ax1)
         dplot.set(xlabel="Latency (ms)", ylabel="Percentiles")
         dplot.set_title(plot_name)
-        hplot = sns.histplot(dfs, ax=ax2)
+        hplot = sns.histplot(data=df, x="Latency (ms)", weights="Count",
+                             hue="Filter", bins=HIST_BINS, ax=ax2)
         hplot.set(xlabel="Latency (ms)", ylabel="Count")
+        if series:
+            for fname, series_df in series.items():
+                ax3.plot(series_df["second"], series_df["p50"],
+                         label=f"{fname} p50")
+                ax3.plot(series_df["second"], series_df["p99"],
+                         label=f"{fname} p99", linestyle="--")
+            ax3.set(xlabel="Time (s)", ylabel="Latency (ms)")
+            ax3.legend()
     else:
         log.info("No valid load generator supplied!")
         return util.EXIT_FAILURE
@@ -72,6 +114,7 @@ def plot(dfs, filters, plot_name, custom):
 
 
 def transform_locust_data(filters, application, output):
+    import pandas as pd
     dfs = []
     for fname in filters:
         csv_prefix = str(GRAPHS_DIR.joinpath(f"{application}_{output}")) 
@@ -113,6 +156,7 @@ def run_locust(url, platform, command_args, application, filename, run_time, num
 
 
 def transform_fortio_data(filters):
+    import pandas as pd
     dfs = []
     title = ""
     for fname in filters:
@@ -144,6 +188,7 @@ def run_fortio(url, platform, threads, qps, run_time, command_args, filename):
     cmd = f"{fortio_dir} load "
     cmd += f"-c {threads} -qps {qps} -timeout 50s -t {run_time}s -json {output_file} "
     cmd += " {command_args} "
+    cmd += namespaces.fortio_flags()
     cmd += f"{url}"
     with open(output_file, "w") as f:
         res = util.exec_process(cmd,
@@ -152,82 +197,94 @@ def run_fortio(url, platform, threads, qps, run_time, command_args, filename):
         return res
 
 
-def transform_loadgen_data(filters, data):
-    combined_data = {}
-    for fname, loadgen in zip(filters, data):
-        combined_data[fname] = loadgen
-    return pd.DataFrame(combined_data, columns=filters)
+CURRENCY_PARAMS = {'currency_code': 'USD'}
+CART_PARAMS = {'product_id': 'LS4PSXUNUM', 'quantity': 5}
+CHECKOUT_PARAMS = {
+    'email': 'someone@example.com',
+    'street_address': '1600 Amphitheatre Parkway',
+    'zip_code': '94043',
+    'city': 'Mountain View',
+    'state': 'CA',
+    'country': 'United States',
+    'credit_card_number': '4432-8015-6152-0454',
+    'credit_card_expiration_month': '1',
+    'credit_card_expiration_year': '2039',
+    'credit_card_cvv': '672',
+}
 
 
-def run_loadgen(url, platform, threads, qps, run_time, request_type):
-    output = []
+def transform_loadgen_data(filters, data):
+    # data holds the record files of every filter, read them back lazily
+    combined_data = {}
+    for fname, records_file in zip(filters, data):
+        combined_data[fname] = histograms_from_records(records_file)
+    return combined_data
+
+
+def histograms_to_frame(hists):
+    import pandas as pd
+    # one row per non-empty bucket, located at the bucket upper bound
+    rows = {"Filter": [], "Latency (ms)": [], "Count": []}
+    for fname, hist in hists.items():
+        for _, high, count in hist.buckets():
+            rows["Filter"].append(fname)
+            rows["Latency (ms)"].append(high)
+            rows["Count"].append(count)
+    return pd.DataFrame(rows)
+
+
+def load_series(series_file):
+    import pandas as pd
+    series_file = Path(series_file)
+    worker_files = sorted(series_file.parent.glob(
+        series_file.name.replace(".series.csv", ".w*.series.csv")))
+    if not worker_files:
+        return pd.read_csv(series_file)
+    # sharded runs write one file per worker. Counts add up, but percentiles
+    # cannot be merged from rollups, so the worst worker is reported.
+    df = pd.concat([pd.read_csv(f) for f in worker_files])
+    return df.groupby("second", as_index=False).agg({
+        "offered": "sum", "achieved": "sum", "errors": "sum",
+        "timeouts": "sum", "p50": "max", "p90": "max", "p99": "max",
+        "max": "max"})
+
+
+def run_loadgen(url, platform, threads, qps, run_time, request_type,
+                fresh_connections=False, series_file=None, records_file=None):
+    import requests
+    output = OutcomeHistograms()
+    session = util.make_session(threads, fresh_connections)
+    series = TimeSeries(time.time())
+    writer = TimeSeriesWriter(series_file) if series_file else None
+    sink = ResultSink(records_file) if records_file else None
+
+    def elapsed_ms(res):
+        return res.elapsed.total_seconds() * 1000
 
     def get_request(_):
-        try:
-            # What should timeout be?
-            res = requests.get(url, timeout=3)
-            if res.status_code != 200:
-                return None
-            ms = res.elapsed.total_seconds() * 1000
-            return ms
-        except requests.exceptions.Timeout:
-            pass
+        res = session.get(url, timeout=REQUEST_TIMEOUT)
+        return res.status_code, elapsed_ms(res)
 
     def post_request(_):
-        try:
-            res = requests.post(url, timeout=3)
-            if res.status_code != 200:
-                return None
-            ms = res.elapsed.total_seconds() * 1000
-            return ms
-        except requests.exceptions.Timeout:
-            pass
+        res = session.post(url, timeout=REQUEST_TIMEOUT)
+        return res.status_code, elapsed_ms(res)
 
     def currency_request(_):
-        try:
-            res = requests.post(url, params={'currency_code': 'USD'}, timeout=3)
-            if res.status_code != 200:
-                return None
-            ms = res.elapsed.total_seconds() * 1000
-            return ms
-        except requests.exceptions.Timeout:
-            pass
+        res = session.post(url, params=CURRENCY_PARAMS,
+                           timeout=REQUEST_TIMEOUT)
+        return res.status_code, elapsed_ms(res)
 
     def add_to_cart(_):
-        try:
-            res = requests.post(url, params={'product_id': 'LS4PSXUNUM', 'quantity': 5}, timeout=3)
-            if res.status_code != 200:
-                return None
-            ms = res.elapsed.total_seconds() * 1000
-            return ms
-        except requests.exceptions.Timeout:
-            pass
+        res = session.post(url, params=CART_PARAMS, timeout=REQUEST_TIMEOUT)
+        return res.status_code, elapsed_ms(res)
 
     def checkout(_):
-        try:
-            res = requests.post(url, params={'product_id': 'LS4PSXUNUM', 'quantity': 5}, timeout=3)
-            if res.status_code != 200:
-                return None
-            ms = res.elapsed.total_seconds() * 1000
-            res2 = requests.post(url+"/checkout", params={
-                'email': 'someone@example.com',
-                'street_address': '1600 Amphitheatre Parkway',
-                'zip_code': '94043',
-                'city': 'Mountain View',
-                'state': 'CA',
-                'country': 'United States',
-                'credit_card_number': '4432-8015-6152-0454',
-                'credit_card_expiration_month': '1',
-                'credit_card_expiration_year': '2039',
-                'credit_card_cvv': '672',
-                },
-            timeout=3)
-            if res2.status_code != 200:
-                return None
-            ms2 = res2.elapsed.total_seconds() * 1000
-            return ms + ms2
-        except requests.exceptions.Timeout:
-            pass
+        res = session.post(url, params=CART_PARAMS, timeout=REQUEST_TIMEOUT)
+        if status_outcome(res.status_code) != SUCCESS:
+            return res.status_code, elapsed_ms(res)
+        res2 = session.post(url+"/checkout", params=CHECKOUT_PARAMS,
+                            timeout=REQUEST_TIMEOUT)
+        return res2.status_code, elapsed_ms(res) + elapsed_ms(res2)
 
     request_func = get_request
     if request_type == "POST":
@@ -239,18 +296,277 @@ def run_loadgen(url, platform, threads, qps, run_time, request_type):
     if request_type == "CHECKOUT":
         request_func = currency_request
 
+    def timed_request(idx):
+        sent = time.time()
+        series.offered(sent)
+        try:
+            status, ms = request_func(idx)
+            outcome = status_outcome(status)
+        except requests.exceptions.Timeout:
+            # censored, all we know is that it took at least this long
+            outcome, ms = TIMEOUT, (time.time() - sent) * 1000
+        except requests.exceptions.RequestException:
+            # also a reset stream or a broken body, the request failed all
+            # the same and has to count against goodput
+            outcome, ms = CONNECTION_ERROR, (time.time() - sent) * 1000
+        series.completed(time.time(), ms if outcome == SUCCESS else None,
+                         timeout=outcome == TIMEOUT)
+        if sink:
+            sink.record(sent, ms, outcome)
+        return outcome, ms
+
     with ThreadPoolExecutor(max_workers=threads) as p:
+        start = time.time()
         current = datetime.now()
         end = current + timedelta(seconds=run_time)
         while current < end:
-            results = list(p.map(request_func, range(qps)))
+            results = list(p.map(timed_request, range(qps)))
             current += timedelta(seconds=1)
-            output += [result for result in results if result]
+            for outcome, ms in results:
+                output.record(outcome, ms)
+            if writer:
+                writer.write(series.pop_rows(time.time()))
+        output.duration = time.time() - start
+    session.close()
+    if writer:
+        writer.write(series.pop_rows())
+        writer.close()
+    if sink:
+        sink.close()
     return output
 
 
-def build_and_deploy_filter(filter_dir):
-    res = kube_env.build_filter(filter_dir)
+async def _async_loadgen(url, qps, run_time, request_type, fresh_connections,
+                         series_file, records_file):
+    # imported here so the thread-based generator works without aiohttp
+    import aiohttp
+
+    if qps <= 0:
+        raise ValueError(f"The async load generator needs a positive rate,"
+                         f" got {qps} qps")
+    loop = asyncio.get_running_loop()
+    output = OutcomeHistograms()
+    writer = TimeSeriesWriter(series_file) if series_file else None
+    sink = ResultSink(records_file) if records_file else None
+    # the loop clock is monotonic, records carry wall clock send times
+    wall_offset = time.time() - loop.time()
+    timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+    connector = aiohttp.TCPConnector(limit=ASYNC_MAX_CONNECTIONS,
+                                     force_close=fresh_connections)
+
+    async def send(session, method, path, params):
+        async with session.request(method, path, params=params) as res:
+            await res.read()
+            return res.status
+
+    async def timed_request(session, intended):
+        # latency of every outcome is measured from the intended send time,
+        # not from the actual send time, so queueing in the client is
+        # accounted for
+        try:
+            if request_type == "CHECKOUT":
+                status = await send(session, "POST", url, CART_PARAMS)
+                if status_outcome(status) == SUCCESS:
+                    status = await send(session, "POST", url + "/checkout",
+                                        CHECKOUT_PARAMS)
+            else:
+                method = "POST" if request_type in (
+                    "POST", "CURRENCY", "ADD_TO_CART") else "GET"
+                params = None
+                if request_type == "CURRENCY":
+                    params = CURRENCY_PARAMS
+                elif request_type == "ADD_TO_CART":
+                    params = CART_PARAMS
+                status = await send(session, method, url, params)
+        except asyncio.TimeoutError:
+            # censored, all we know is that it took at least this long
+            outcome = TIMEOUT
+        except aiohttp.ClientError:
+            outcome = CONNECTION_ERROR
+        else:
+            outcome = status_outcome(status)
+        latency = (loop.time() - intended) * 1000
+        output.record(outcome, latency)
+        series.completed(loop.time(), latency if outcome == SUCCESS else None,
+                         timeout=outcome == TIMEOUT)
+        if sink:
+            sink.record(intended + wall_offset, latency, outcome)
+
+    async def flush_series():
+        # hand completed seconds to disk while the run is in progress
+        while True:
+            await asyncio.sleep(1)
+            writer.write(series.pop_rows(loop.time(), grace=4))
+
+    pending = set()
+    total = qps * run_time
+    interval = 1.0 / qps
+    async with aiohttp.ClientSession(
+            connector=connector, timeout=timeout,
+            headers=namespaces.gateway_headers()) as session:
+        start = loop.time()
+        series = TimeSeries(start)
+        if writer:
+            flusher = loop.create_task(flush_series())
+        sent = 0
+        while sent < total:
+            # open loop: dispatch every request that is due, independent of
+            # how many earlier requests are still outstanding
+            now = loop.time()
+            while sent < total and start + sent * interval <= now:
+                series.offered(start + sent * interval)
+                task = loop.create_task(
+                    timed_request(session, start + sent * interval))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                sent += 1
+            if sent < total:
+                await asyncio.sleep(start + sent * interval - loop.time())
+        behind = loop.time() - start - (total - 1) * interval
+        if behind > 1:
+            log.warning("Async load generator sent its last request %.2f s"
+                        " late, the client may be saturated.", behind)
+        if pending:
+            await asyncio.wait(pending)
+        output.duration = loop.time() - start
+    if writer:
+        flusher.cancel()
+        writer.write(series.pop_rows())
+        writer.close()
+    if sink:
+        sink.close()
+    return output
+
+
+def run_async_loadgen(url, platform, qps, run_time, request_type,
+                      fresh_connections=False, series_file=None,
+                      records_file=None):
+    return asyncio.run(_async_loadgen(url, qps, run_time, request_type,
+                                      fresh_connections, series_file,
+                                      records_file))
+
+
+def _loadgen_worker(idx, cpu, barrier, queue, custom, url, platform,
+                    threads, qps, run_time, request_type, fresh_connections,
+                    series_file, records_file):
+    if cpu is not None:
+        os.sched_setaffinity(0, {cpu})
+    # all workers start sending at the same time
+    barrier.wait()
+    start_wall = time.time()
+    start_cpu = time.process_time()
+    if custom == "async":
+        hist = run_async_loadgen(url, platform, qps, run_time, request_type,
+                                 fresh_connections, series_file, records_file)
+    else:
+        hist = run_loadgen(url, platform, threads, qps, run_time,
+                           request_type, fresh_connections, series_file,
+                           records_file)
+    cpu_util = (time.process_time() - start_cpu) / (time.time() - start_wall)
+    queue.put((idx, hist.to_dict(), cpu_util))
+
+
+def run_sharded_loadgen(url, platform, threads, qps, run_time, request_type,
+                        workers, custom="loadgen", fresh_connections=False,
+                        series_file=None, records_file=None):
+    # split the rate as evenly as possible, the first workers take the rest
+    rates = [qps // workers + (1 if i < qps % workers else 0)
+             for i in range(workers)]
+    rates = [rate for rate in rates if rate > 0]
+    cpus = None
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        if len(cpus) < len(rates):
+            log.warning("Only %d cores available for %d load generator"
+                        " workers.", len(cpus), len(rates))
+    barrier = multiprocessing.Barrier(len(rates))
+    queue = multiprocessing.Queue()
+    procs = []
+    for idx, rate in enumerate(rates):
+        cpu = cpus[idx % len(cpus)] if cpus else None
+        # every worker writes its own time series and records, see
+        # load_series and result_sink.shard_paths
+        worker_series = None
+        if series_file:
+            worker_series = series_file.replace(".series.csv",
+                                                f".w{idx}.series.csv")
+        worker_records = None
+        if records_file:
+            worker_records = records_file.replace(".records.bin",
+                                                  f".w{idx}.records.bin")
+        proc = multiprocessing.Process(
+            target=_loadgen_worker,
+            args=(idx, cpu, barrier, queue, custom, url, platform, threads,
+                  rate, run_time, request_type, fresh_connections,
+                  worker_series, worker_records))
+        proc.start()
+        procs.append(proc)
+
+    reports = _collect_reports(procs, queue)
+    for proc in procs:
+        proc.join()
+    if reports is None:
+        return None
+    merged = OutcomeHistograms()
+    for idx, (hist_data, cpu_util) in sorted(reports.items()):
+        merged.merge(OutcomeHistograms.from_dict(hist_data))
+        log.info("Load generator worker %d (%d qps): client CPU %.0f%%",
+                 idx, rates[idx], cpu_util * 100)
+        if cpu_util > CLIENT_CPU_WARN:
+            log.warning("Load generator worker %d is CPU bound, results"
+                        " may reflect the client. Add more workers.", idx)
+    return merged
+
+
+def _collect_reports(procs, queue):
+    """ The results of all workers by index, None if a worker exited
+    without reporting. The remaining workers are stopped in that case.
+    """
+    reports = {}
+
+    def receive(timeout):
+        idx, hist_data, cpu_util = queue.get(timeout=timeout)
+        reports[idx] = (hist_data, cpu_util)
+
+    # drain the queue before joining, large results would block the workers
+    while len(reports) < len(procs):
+        try:
+            receive(WORKER_POLL)
+            continue
+        except queue_module.Empty:
+            pass
+        exited = [idx for idx, proc in enumerate(procs)
+                  if proc.exitcode is not None and idx not in reports]
+        if not exited:
+            continue
+        # a worker may have reported right before it exited
+        try:
+            while True:
+                receive(0)
+        except queue_module.Empty:
+            pass
+        lost = [idx for idx in exited if idx not in reports]
+        if lost:
+            for idx in lost:
+                log.error("Load generator worker %d exited with %s without"
+                          " reporting its results.", idx,
+                          procs[idx].exitcode)
+            # the others may wait for it at the barrier forever
+            for proc in procs:
+                if proc.is_alive():
+                    proc.terminate()
+            return None
+    return reports
+
+
+def build_and_deploy_filter(filter_dir, ready_timeout=readiness.DEFAULT_TIMEOUT,
+                            build=None, hot_swap=False):
+    # build is the future of a build started ahead of time
+    if build is None:
+        res = kube_env.build_filter(filter_dir)
+    else:
+        res = util.EXIT_SUCCESS if kube_env.build_succeeded(
+            build) else util.EXIT_FAILURE
 
     if res != util.EXIT_SUCCESS:
         log.error(
@@ -258,18 +574,30 @@ def build_and_deploy_filter(filter_dir):
             " Make sure you give the right path", filter_dir)
         return util.EXIT_FAILURE
 
-    res = kube_env.refresh_filter(filter_dir)
+    # returns once all pods run the new filter and are ready
+    if hot_swap:
+        res = kube_env.swap_filter(filter_dir, ready_timeout=ready_timeout)
+    else:
+        res = kube_env.refresh_filter(filter_dir, ready_timeout)
     if res != util.EXIT_SUCCESS:
         log.error(
             "Deploying filter failed for %s."
             " Make sure you give the right path", filter_dir)
         return util.EXIT_FAILURE
-
-    # wait for kubernetes set up to finish
-    time.sleep(120)
     return util.EXIT_SUCCESS
 
 
+def store_frames(dfs, filters, filter_dirs, application, platform, custom,
+                 params):
+    # locust and fortio only report percentiles, store those per filter
+    for fname, filter_dir, df in zip(filters, filter_dirs, dfs):
+        columns = {col: df[col].to_numpy() for col in df.columns}
+        results_store.save_run(
+            columns, application, platform, fname, custom, params,
+            time.time(),
+            filter_dir=None if filter_dir == "no_filter" else filter_dir)
+
+
 def start_benchmark(filter_dirs, platform, threads, qps, run_time, **kwargs):
     if kube_env.check_kubernetes_status() != util.EXIT_SUCCESS:
         log.error("Kubernetes is not set up."
@@ -281,7 +609,15 @@ def start_benchmark(filter_dirs, platform, threads, qps, run_time, **kwargs):
     request = kwargs.get("request")
     output = kwargs.get("output_file")
     command_args = " ".join(kwargs.get("command_args"))
+    workers = kwargs.get("workers") or 1
+    fresh_connections = kwargs.get("fresh_connections", False)
+    ready_timeout = kwargs.get("ready_timeout", readiness.DEFAULT_TIMEOUT)
+    build_jobs = kwargs.get("build_jobs") or kube_env.BUILD_JOBS
     application = APPLICATIONS.get(kwargs.get("application"))
+    if custom in ("loadgen", "async") and qps <= 0:
+        log.error("The %s load generator needs a positive rate, got %s qps.",
+                  custom, qps)
+        return util.EXIT_FAILURE
 
     _, _, gateway_url = kube_env.get_gateway_info(platform)
     path = kwargs.get("subpath")
@@ -290,6 +626,25 @@ def start_benchmark(filter_dirs, platform, threads, qps, run_time, **kwargs):
 
     results = []
     filters = []
+    series_files = {}
+    timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime(time.time()))
+    npy_file = f"{custom}_{application}_{timestamp}_{output}"
+    npy_file_dir = str(NPY_DIR.joinpath(npy_file))
+    util.check_dir(NPY_DIR)
+
+    # the filters may already run, for example between runs of a matrix
+    deploy = kwargs.get("deploy", True)
+    # build all filters before spending cluster time on any of them
+    builds = {}
+    if deploy:
+        builds = kube_env.build_filters(filter_dirs, build_jobs,
+                                        optimize=kwargs.get("optimize"))
+    if deploy and not kwargs.get("overlap_builds"):
+        failed = kube_env.wait_for_builds(builds)
+        if failed:
+            log.error("Could not build %s, not benchmarking.",
+                      ", ".join(str(fd) for fd in failed))
+            return util.EXIT_FAILURE
 
     if kwargs.get("no_filter") == "ON":
         filter_dirs.insert(0, "no_filter")
@@ -299,18 +654,33 @@ def start_benchmark(filter_dirs, platform, threads, qps, run_time, **kwargs):
         if f.is_file():
             f.unlink()
 
+    # recorded in the manifest of every stored run
+    params = {"threads": threads, "qps": qps, "run_time": run_time,
+              "request": request, "subpath": path, "workers": workers,
+              "fresh_connections": fresh_connections, "output": output,
+              "num_users": kwargs.get("num_users"),
+              "spawn_rate": kwargs.get("spawn_rate"),
+              "command_args": command_args}
+
     for (idx, filter_dir) in enumerate(filter_dirs):
         log.info("Benchmarking %s", filter_dir)
         fname = Path(filter_dir).name
+        started = time.time()
         if filter_dir != "no_filter":
-            res = build_and_deploy_filter(filter_dir)
-            if res != util.EXIT_SUCCESS:
-                return util.EXIT_FAILURE
+            if deploy:
+                res = build_and_deploy_filter(filter_dir, ready_timeout,
+                                              builds[filter_dir],
+                                              kwargs.get("hot_swap", False))
+                if res != util.EXIT_SUCCESS:
+                    return util.EXIT_FAILURE
             filters.append(fname)
 
+        series_file = f"{npy_file_dir}_{fname}.series.csv"
+        records_file = f"{npy_file_dir}_{fname}.records.bin"
         log.info("Warming up...")
-        for i in range(10):
-            requests.get(url)
+        with util.make_session(1, fresh_connections) as session:
+            for i in range(10):
+                session.get(url)
 
         if custom == "locust":
             if not application:
@@ -329,36 +699,71 @@ def start_benchmark(filter_dirs, platform, threads, qps, run_time, **kwargs):
             if fortio_res != util.EXIT_SUCCESS:
                 log.error("Error benchmarking for %s", fd)
                 return util.EXIT_FAILURE
+        elif custom in ("loadgen", "async") and workers > 1:
+            log.info("Generating load with %d workers...", workers)
+            burst_res = run_sharded_loadgen(url, platform, threads, qps,
+                                            run_time, request, workers,
+                                            custom, fresh_connections,
+                                            series_file, records_file)
+            if burst_res is None:
+                log.error("Load generation for %s failed.", fname)
+                return util.EXIT_FAILURE
+            log.info("%s: %s", fname, burst_res.summary())
+            results.append(records_file)
+            series_files[fname] = series_file
         elif custom == "loadgen":
             log.info("Generating load...")
             burst_res = run_loadgen(url, platform, threads, qps, run_time,
-                                    request)
-            results.append(burst_res)
+                                    request, fresh_connections, series_file,
+                                    records_file)
+            log.info("%s: %s", fname, burst_res.summary())
+            results.append(records_file)
+            series_files[fname] = series_file
+        elif custom == "async":
+            log.info("Generating open-loop load...")
+            burst_res = run_async_loadgen(url, platform, qps, run_time,
+                                          request, fresh_connections,
+                                          series_file, records_file)
+            log.info("%s: %s", fname, burst_res.summary())
+            results.append(records_file)
+            series_files[fname] = series_file
         else:
             log.error("Invalid load generator")
             return util.EXIT_FAILURE
+        if custom in ("loadgen", "async"):
+            # store every filter run as soon as it is done
+            results_store.save_run(
+                records_to_columns(records_file), application, platform,
+                fname, custom, params, started,
+                filter_dir=None if filter_dir == "no_filter" else filter_dir,
+                extra={"outcome_codes": OUTCOMES})
 
     # Plot functions
-    timestamp = time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime(time.time()))
-    npy_file = f"{custom}_{application}_{timestamp}_{output}"
-    npy_file_dir = str(NPY_DIR.joinpath(npy_file))
+    import numpy as np
     graph_output = f"{custom}_{application}_{timestamp}_{output}"
-    util.check_dir(NPY_DIR)
     if custom == "locust":
         locust_df = transform_locust_data(filters, application, output)
         np.save(npy_file_dir, locust_df)
+        store_frames(locust_df, filters, filter_dirs, application, platform,
+                     custom, params)
         return plot(locust_df, filters, graph_output, custom)
     elif custom == "fortio":
         fortio_df, title = transform_fortio_data(filters)
         np.save(npy_file_dir, fortio_df)
+        store_frames(fortio_df, filters, filter_dirs, application, platform,
+                     custom, params)
         return plot(fortio_df, filters, graph_output, custom)
-    elif custom == "loadgen":
-        loadgen_df = transform_loadgen_data(filters, results)
-        np.save(npy_file_dir, loadgen_df)
-        return plot(loadgen_df, filters, graph_output, custom)
+    elif custom in ("loadgen", "async"):
+        loadgen_hists = transform_loadgen_data(filters, results)
+        dump_histograms(f"{npy_file_dir}.hist.json", loadgen_hists)
+        series = {fname: load_series(series_file)
+                  for fname, series_file in series_files.items()}
+        return plot(loadgen_hists, filters, graph_output, "loadgen", series)
 
 
 def main(args):
+    if args.namespace:
+        namespaces.set_namespace(args.namespace)
     return start_benchmark(args.filter_dirs,
                            args.platform,
                            args.threads,
@@ -373,7 +778,14 @@ def main(args):
                            custom=args.custom.lower(),
                            plot_name=args.plot_name,
                            num_users=args.users,
-                           spawn_rate=args.spawn_rate)
+                           spawn_rate=args.spawn_rate,
+                           workers=args.workers,
+                           fresh_connections=args.fresh_connections,
+                           ready_timeout=args.ready_timeout,
+                           build_jobs=args.build_jobs,
+                           overlap_builds=args.overlap_builds,
+                           optimize=args.optimize,
+                           hot_swap=args.hot_swap)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -396,6 +808,11 @@ if __name__ == '__main__':
                         choices=["MK", "GCP"],
                         help="Which platform to run the scripts on."
                         "MK is minikube, GCP is Google Cloud Compute")
+    parser.add_argument("-ns",
+                        "--namespace",
+                        dest="namespace",
+                        help="Namespace of the application instance to"
+                        " benchmark.")
     parser.add_argument("-m",
                         "--multi-zonal",
                         dest="multizonal",
@@ -415,6 +832,51 @@ if __name__ == '__main__':
                         type=int,
                         default=2,
                         help="Number of threads")
+    parser.add_argument("-w",
+                        "--workers",
+                        dest="workers",
+                        type=int,
+                        default=1,
+                        help="Number of load generator processes. The"
+                        " query rate is split across them.")
+    parser.add_argument("-fc",
+                        "--fresh-connections",
+                        dest="fresh_connections",
+                        action="store_true",
+                        help="Open a new connection for every request"
+                        " instead of reusing keep-alive connections.")
+    parser.add_argument("-rt",
+                        "--ready-timeout",
+                        dest="ready_timeout",
+                        type=int,
+                        default=readiness.DEFAULT_TIMEOUT,
+                        help="Seconds to wait at most for all pods to run"
+                        " a new filter before benchmarking it.")
+    parser.add_argument("-j",
+                        "--build-jobs",
+                        dest="build_jobs",
+                        type=int,
+                        default=kube_env.BUILD_JOBS,
+                        help="Number of filters to build at the same time.")
+    parser.add_argument("-ob",
+                        "--overlap-builds",
+                        dest="overlap_builds",
+                        action="store_true",
+                        help="Start benchmarking the first filter while the"
+                        " others are still building, instead of building"
+                        " all of them first.")
+    parser.add_argument("-hs",
+                        "--hot-swap",
+                        dest="hot_swap",
+                        action="store_true",
+                        help="Swap filters without restarting the pods where"
+                        " possible.")
+    parser.add_argument("-opt",
+                        "--optimize",
+                        dest="optimize",
+                        choices=wasm_tools.OPT_LEVELS,
+                        help="Run wasm-opt at this level on the built"
+                        " filters.")
     parser.add_argument("-u",
                         "--users",
                         dest="users",
@@ -452,7 +914,8 @@ if __name__ == '__main__':
                         "--use-custom",
                         dest="custom",
                         default="loadgen",
-                        help="Running custom load generator.")
+                        help="Running custom load generator. "
+                        "One of loadgen, async, fortio, or locust.")
     parser.add_argument("-nf",
                         "--no-filter",
                         dest="nf",
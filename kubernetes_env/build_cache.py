@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+import argparse
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import kube_util as util
+import results_store
+
+log = logging.getLogger(__name__)
+
+CACHE_DIR = Path(os.environ.get(
+    "KUBE_ENV_BUILD_CACHE",
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home().joinpath(".cache")),
+         "kube_env", "wasm")))
+STATS_NAME = "stats.json"
+META_NAME = "meta.json"
+# build outputs restored on a hit
+ARTIFACTS = ["filter.wasm", "agg_filter.wasm"]
+TOOLCHAIN_CMD = "rustc +nightly -vV"
+# filters are built concurrently, guards the stats and meta files
+LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def toolchain_version():
+    try:
+        return util.get_output_from_proc(
+            TOOLCHAIN_CMD, stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def cache_key(filter_dir, flags):
+    """ Hash of the filter sources, the toolchain and the build flags.
+    Returns None if any of them is unknown, such builds are not cached.
+    """
+    sources = results_store.filter_hash(filter_dir)
+    toolchain = toolchain_version()
+    if sources is None or toolchain is None:
+        return None
+    sha = hashlib.sha256()
+    for part in (sources, toolchain, flags):
+        sha.update(part.encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+def _write_json(data, json_file):
+    tmp_file = json_file.with_suffix(f".{uuid.uuid4().hex}.tmp")
+    with open(tmp_file, "w") as jfile:
+        json.dump(data, jfile)
+    tmp_file.replace(json_file)
+
+
+def _load_stats(stats_file):
+    stats = {"hits": 0, "misses": 0}
+    try:
+        with open(stats_file) as sfile:
+            stats.update(json.load(sfile))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as err:
+        log.warning("Ignoring corrupt build cache stats %s: %s",
+                    stats_file, err)
+    return stats
+
+
+def _update_stats(cache_dir, field):
+    stats_file = Path(cache_dir).joinpath(STATS_NAME)
+    with LOCK:
+        stats = _load_stats(stats_file)
+        stats[field] += 1
+        _write_json(stats, stats_file)
+
+
+def restore(key, out_dir, cache_dir=None):
+    """ Copy the artifacts of key into out_dir. Returns False on a miss. """
+    cache_dir = cache_dir or CACHE_DIR
+    if key is None:
+        return False
+    util.check_dir(Path(cache_dir))
+    entry = Path(cache_dir).joinpath(key)
+    meta_file = entry.joinpath(META_NAME)
+    if not meta_file.exists():
+        _update_stats(cache_dir, "misses")
+        return False
+    with LOCK:
+        with open(meta_file) as mfile:
+            meta = json.load(mfile)
+        meta["last_used"] = time.time()
+        _write_json(meta, meta_file)
+    util.check_dir(Path(out_dir))
+    for artifact in meta["artifacts"]:
+        shutil.copy2(entry.joinpath(artifact), Path(out_dir).joinpath(artifact))
+    _update_stats(cache_dir, "hits")
+    return True
+
+
+def store(key, out_dir, filter_dir=None, cache_dir=None):
+    """ Add the artifacts found in out_dir to the cache under key. """
+    cache_dir = cache_dir or CACHE_DIR
+    if key is None:
+        return
+    artifacts = [artifact for artifact in ARTIFACTS
+                 if Path(out_dir).joinpath(artifact).exists()]
+    # fill a temporary directory first so readers never see half an entry
+    tmp_entry = Path(cache_dir).joinpath(f".{key}.{uuid.uuid4().hex}")
+    util.check_dir(tmp_entry)
+    size = 0
+    for artifact in artifacts:
+        shutil.copy2(Path(out_dir).joinpath(artifact),
+                     tmp_entry.joinpath(artifact))
+        size += tmp_entry.joinpath(artifact).stat().st_size
+    meta = {"key": key, "filter_dir": str(filter_dir), "created": time.time(),
+            "last_used": time.time(), "size": size, "artifacts": artifacts}
+    with open(tmp_entry.joinpath(META_NAME), "w") as mfile:
+        json.dump(meta, mfile)
+    entry = Path(cache_dir).joinpath(key)
+    try:
+        tmp_entry.rename(entry)
+    except OSError:
+        # somebody else stored the same build in the meantime
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+
+
+def entries(cache_dir=None):
+    cache_dir = cache_dir or CACHE_DIR
+    metas = []
+    for meta_file in Path(cache_dir).glob(f"*/{META_NAME}"):
+        with open(meta_file) as mfile:
+            metas.append(json.load(mfile))
+    return metas
+
+
+def stats(cache_dir=None):
+    cache_dir = cache_dir or CACHE_DIR
+    metas = entries(cache_dir)
+    result = {"hits": 0, "misses": 0, "entries": len(metas),
+              "size": sum(meta["size"] for meta in metas)}
+    result.update(_load_stats(Path(cache_dir).joinpath(STATS_NAME)))
+    return result
+
+
+def evict(max_size=None, max_age=None, cache_dir=None):
+    """ Remove entries not used for max_age seconds, then the least recently
+    used ones until the cache is at most max_size bytes.
+    Returns the removed keys.
+    """
+    cache_dir = cache_dir or CACHE_DIR
+    now = time.time()
+    metas = sorted(entries(cache_dir), key=lambda meta: meta["last_used"])
+    removed = []
+    total = sum(meta["size"] for meta in metas)
+    for meta in metas:
+        too_old = max_age is not None and now - meta["last_used"] > max_age
+        too_big = max_size is not None and total > max_size
+        if not too_old and not too_big:
+            continue
+        shutil.rmtree(Path(cache_dir).joinpath(meta["key"]),
+                      ignore_errors=True)
+        total -= meta["size"]
+        removed.append(meta["key"])
+    return removed
+
+
+def main(args):
+    if args.clear:
+        util.del_dir(Path(args.cache_dir))
+        return util.EXIT_SUCCESS
+    if args.max_size is not None or args.max_age is not None:
+        max_size = None if args.max_size is None else args.max_size * 2**20
+        max_age = None if args.max_age is None else args.max_age * 86400
+        removed = evict(max_size, max_age, args.cache_dir)
+        log.info("Evicted %d entries.", len(removed))
+    cache_stats = stats(args.cache_dir)
+    lookups = cache_stats["hits"] + cache_stats["misses"]
+    hit_rate = cache_stats["hits"] / lookups if lookups else 0
+    log.info("%s: %d entries, %.1f MiB, %d hits, %d misses (%.0f%% hit rate)",
+             args.cache_dir, cache_stats["entries"],
+             cache_stats["size"] / 2**20, cache_stats["hits"],
+             cache_stats["misses"], hit_rate * 100)
+    return util.EXIT_SUCCESS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l",
+                        "--log-file",
+                        dest="log_file",
+                        default="build_cache.log",
+                        help="Specifies name of the log file.")
+    parser.add_argument(
+        "-ll",
+        "--log-level",
+        dest="log_level",
+        default="INFO",
+        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"],
+        help="The log level to choose.")
+    parser.add_argument("-cd",
+                        "--cache-dir",
+                        dest="cache_dir",
+                        default=CACHE_DIR,
+                        help="Directory of the build cache.")
+    parser.add_argument("-ms",
+                        "--max-size",
+                        dest="max_size",
+                        type=float,
+                        help="Evict the least recently used builds until the"
+                        " cache is at most this many MiB.")
+    parser.add_argument("-ma",
+                        "--max-age",
+                        dest="max_age",
+                        type=float,
+                        help="Evict builds not used for this many days.")
+    parser.add_argument("-c",
+                        "--clear",
+                        dest="clear",
+                        action="store_true",
+                        help="Remove all cached builds.")
+    # Parse options and process argv
+    arguments = parser.parse_args()
+    # configure logging
+    logging.basicConfig(filename=arguments.log_file,
+                        format="%(levelname)s:%(message)s",
+                        level=getattr(logging, arguments.log_level),
+                        filemode="w")
+    stderr_log = logging.StreamHandler()
+    stderr_log.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logging.getLogger().addHandler(stderr_log)
+    main(arguments)
@@ -0,0 +1,255 @@
+import itertools
+import json
+import logging
+import os
+import queue
+import subprocess
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import gateway_cache
+import kube_env
+import kube_util as util
+import matrix
+import namespaces
+import results_store
+import timing
+from benchmark.benchmark import WORK_DIR_ENV
+
+log = logging.getLogger(__name__)
+
+FILE_DIR = Path(__file__).parent.resolve()
+POOL_NAME = "pool"
+KUBECONFIG_NAME = "kubeconfig"
+# minikube marks the clusters and contexts it creates with this provider
+MINIKUBE_PROVIDER = "minikube.sigs.k8s.io"
+CELLS_NAME = "cells.json"
+# the worker runs the cells of one unit against one context
+WORKER = [sys.executable, str(FILE_DIR.joinpath("run_experiment.py"))]
+LOCK = threading.Lock()
+
+
+def pool_dir(spec_file, store_dir=None):
+    store_dir = store_dir or results_store.STORE_DIR
+    return Path(store_dir).joinpath(POOL_NAME,
+                                    matrix.campaign_name(spec_file))
+
+
+def current_context():
+    cmd = "kubectl config current-context"
+    return util.get_output_from_proc(cmd).decode("utf-8").strip()
+
+
+def pool_slots(contexts, namespace_list=None):
+    """ Places a unit can run in, every namespace on every context. Units in
+    different namespaces of one cluster run side by side on the same nodes.
+    """
+    return [(context, namespace) for context in contexts
+            for namespace in namespace_list or [None]]
+
+
+def slot_workdir(spec_file, context, namespace, idx):
+    # namespaces cannot contain underscores
+    unit = f"{namespace}_unit{idx}" if namespace else f"unit{idx}"
+    return pool_dir(spec_file).joinpath(context, unit)
+
+
+def write_kubeconfig(context, path):
+    """ A kubeconfig that only knows context, so every kubectl and API call
+    of a worker goes to its own cluster. It holds the credentials of the
+    cluster, only the user can read it and callers remove it after use.
+    """
+    cmd = f"kubectl config view --raw --minify --flatten --context {context}"
+    try:
+        config = util.get_output_from_proc(cmd, stderr=subprocess.PIPE)
+    except (subprocess.CalledProcessError, OSError) as err:
+        log.error("Cannot read the kubeconfig of context %s: %s", context,
+                  err)
+        return util.EXIT_FAILURE
+    Path(path).unlink(missing_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, "wb") as kubeconfig:
+        kubeconfig.write(config)
+    return util.EXIT_SUCCESS
+
+
+def split_units(jobs, workers):
+    """ Split ordered cells into units that can run on different clusters.
+    A unit holds cells of one application and all cells of its filters, the
+    filters of an application are spread over at most workers units.
+    """
+    units = []
+    for application, app_jobs in itertools.groupby(
+            jobs, key=lambda job: job["application"]):
+        app_jobs = list(app_jobs)
+        filters = list(dict.fromkeys(job["filter"] for job in app_jobs))
+        chunks = min(workers, len(filters))
+        for idx in range(chunks):
+            unit_filters = filters[idx::chunks]
+            units.append({"application": application,
+                          "jobs": [job for job in app_jobs
+                                   if job["filter"] in unit_filters]})
+    return units
+
+
+def is_minikube(kubeconfig):
+    try:
+        return MINIKUBE_PROVIDER in Path(kubeconfig).read_text()
+    except OSError:
+        return False
+
+
+def context_env(context, kubeconfig):
+    """ Environment of commands that talk to the cluster of context. """
+    env = dict(os.environ)
+    env["KUBECONFIG"] = str(kubeconfig)
+    # minikube names the context of a cluster after its profile, other
+    # clusters must not inherit the profile of the runner
+    env.pop(kube_env.MINIKUBE_PROFILE_ENV, None)
+    if is_minikube(kubeconfig):
+        env[kube_env.MINIKUBE_PROFILE_ENV] = context
+    return env
+
+
+def worker_env(context, workdir, namespace=None):
+    workdir = Path(workdir)
+    env = context_env(context, workdir.joinpath(KUBECONFIG_NAME))
+    env[results_store.RESULTS_DIR_ENV] = str(workdir.joinpath("results"))
+    env[WORK_DIR_ENV] = str(workdir)
+    if namespace:
+        env[namespaces.NAMESPACE_ENV] = namespace
+    return env
+
+
+def run_unit(spec_file, unit, context, workdir, namespace=None):
+    """ Run the cells of a unit in a worker process of their own, with its
+    own working directory, results and cluster.
+    """
+    workdir = Path(workdir)
+    util.del_dir(workdir)
+    util.check_dir(workdir)
+    kubeconfig = workdir.joinpath(KUBECONFIG_NAME)
+    result = write_kubeconfig(context, kubeconfig)
+    if result != util.EXIT_SUCCESS:
+        return result
+    try:
+        return _run_worker(spec_file, unit, context, workdir, namespace)
+    finally:
+        kubeconfig.unlink(missing_ok=True)
+
+
+def _run_worker(spec_file, unit, context, workdir, namespace):
+    cells_file = workdir.joinpath(CELLS_NAME)
+    with open(cells_file, "w") as cells:
+        json.dump([job["id"] for job in unit["jobs"]], cells)
+    cmd = WORKER + ["--spec", str(Path(spec_file).resolve()),
+                    "--cells-file", str(cells_file), "--attach",
+                    "--log-file", str(workdir.joinpath("experiment.log"))]
+    log.info("Running %d cells of %s on %s in %s", len(unit["jobs"]),
+             unit["application"], context, workdir)
+    with open(workdir.joinpath("worker.log"), "w") as worker_log:
+        proc = subprocess.run(cmd, cwd=workdir,
+                              env=worker_env(context, workdir, namespace),
+                              stdout=worker_log, stderr=subprocess.STDOUT)
+    if proc.returncode != util.EXIT_SUCCESS:
+        log.error("Cells of %s on %s failed, see %s", unit["application"],
+                  context, workdir)
+    return proc.returncode
+
+
+def merge_workdir(spec_file, workdir, context, checkpoint, completed,
+                  namespace=None):
+    """ Move the results of a worker into the shared results directory and
+    its completed cells into the shared checkpoint.
+    """
+    worker_store = Path(workdir).joinpath("results")
+    extra = {"context": context}
+    if namespace:
+        extra["namespace"] = namespace
+    with LOCK:
+        runs = results_store.import_runs(worker_store,
+                                         results_store.STORE_DIR,
+                                         extra=extra)
+        worker_timings = timing.timings_file(worker_store)
+        if worker_timings.exists():
+            with open(timing.timings_file(), "a") as timing_file:
+                timing_file.write(worker_timings.read_text())
+            worker_timings.unlink()
+        worker_cells = matrix.load_checkpoint(
+            matrix.checkpoint_file(spec_file, worker_store))
+        new_cells = {cell: dict(entry, context=context)
+                     for cell, entry in worker_cells.items()
+                     if cell not in completed}
+        if new_cells:
+            completed.update(new_cells)
+            matrix.save_checkpoint(checkpoint, completed)
+    return runs
+
+
+def merge_leftovers(spec_file, checkpoint, completed):
+    # results of workers that were interrupted together with the runner
+    for workdir in sorted(pool_dir(spec_file).glob("*/*")):
+        namespace = workdir.name.rpartition("_")[0] or None
+        merge_workdir(spec_file, workdir, workdir.parent.name, checkpoint,
+                      completed, namespace)
+
+
+def install_istio(spec_file, contexts):
+    """ Install istio on the cluster of every context before the workers
+    start, its workers would otherwise all install it at the same time.
+    Returns the contexts that are ready.
+    """
+    ready = []
+    for context in contexts:
+        # next to the work directories, not in them
+        kubeconfig = pool_dir(spec_file).joinpath(
+            f"{context}.{KUBECONFIG_NAME}")
+        util.check_dir(kubeconfig.parent)
+        if write_kubeconfig(context, kubeconfig) != util.EXIT_SUCCESS:
+            continue
+        log.info("Installing istio on %s", context)
+        try:
+            result = kube_env.install_istio(context_env(context, kubeconfig))
+        finally:
+            kubeconfig.unlink(missing_ok=True)
+        gateway_cache.invalidate_context(context)
+        if result != util.EXIT_SUCCESS:
+            log.error("Could not install istio on %s.", context)
+            continue
+        ready.append(context)
+    return ready
+
+
+def run_parallel(spec_file, jobs, contexts, checkpoint, completed,
+                 namespace_list=None):
+    """ Run the cells on a pool of kube contexts, one unit per context at a
+    time. With namespace_list every context runs one unit per namespace.
+    Returns the ids of the cells that did not complete.
+    """
+    contexts = install_istio(spec_file, contexts)
+    if not contexts:
+        log.error("None of the contexts can run cells.")
+        return [job["id"] for job in jobs]
+    slots = pool_slots(contexts, namespace_list)
+    units = split_units(jobs, len(slots))
+    free = queue.Queue()
+    for slot in slots:
+        free.put(slot)
+
+    def run(idx):
+        context, namespace = free.get()
+        try:
+            workdir = slot_workdir(spec_file, context, namespace, idx)
+            run_unit(spec_file, units[idx], context, workdir, namespace)
+            merge_workdir(spec_file, workdir, context, checkpoint, completed,
+                          namespace)
+        finally:
+            free.put((context, namespace))
+
+    log.info("Running %d units in %d slots on contexts %s", len(units),
+             len(slots), ", ".join(contexts))
+    with ThreadPoolExecutor(max_workers=len(slots)) as pool:
+        list(pool.map(run, range(len(units))))
+    return [job["id"] for job in jobs if job["id"] not in completed]
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from pathlib import Path
+
+import kube_util as util
+
+log = logging.getLogger(__name__)
+
+# resolving the gateway forks kubectl and minikube, short lived tools share
+# the result through this file
+STATE_ENV = "KUBE_ENV_GATEWAY_STATE"
+STATE_FILE = Path(os.environ.get(
+    STATE_ENV,
+    Path(os.environ.get("XDG_CACHE_HOME", Path.home().joinpath(".cache")),
+         "kube_env", "gateway.json")))
+TTL_ENV = "KUBE_ENV_GATEWAY_TTL"
+# seconds an entry is used without looking at the ingress service again
+DEFAULT_TTL = 300
+ENTRIES = {}
+LOCK = threading.Lock()
+
+
+def ttl():
+    return float(os.environ.get(TTL_ENV, DEFAULT_TTL))
+
+
+def current_context():
+    """ Kubeconfig and context the gateway belongs to. Read from the file,
+    asking kubectl would cost as much as resolving the gateway.
+    """
+    kubeconfig = (os.environ.get("KUBECONFIG")
+                  or str(Path.home().joinpath(".kube", "config")))
+    kubeconfig = kubeconfig.split(os.pathsep)[0]
+    context = None
+    try:
+        match = re.search(r"^\"?current-context\"?:\s*\"?([^\"\s,]+)",
+                          Path(kubeconfig).read_text(), re.MULTILINE)
+        context = match.group(1) if match else None
+    except OSError:
+        pass
+    # several minikube clusters are told apart by their profile
+    profile = os.environ.get("MINIKUBE_PROFILE", "")
+    return f"{kubeconfig}:{context}:{profile}"
+
+
+def cache_key(platform, context=None):
+    return f"{platform}|{context or current_context()}"
+
+
+def load_state(state_file=None):
+    state_file = Path(state_file or STATE_FILE)
+    if not state_file.exists():
+        return {}
+    try:
+        with open(state_file) as state:
+            return json.load(state)
+    except (OSError, ValueError):
+        # a broken file only costs us one lookup
+        return {}
+
+
+def save_state(entries, state_file=None):
+    state_file = Path(state_file or STATE_FILE)
+    try:
+        state_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = state_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "w") as state:
+            json.dump(entries, state, indent=1)
+        tmp_file.replace(state_file)
+    except OSError as err:
+        log.debug("Cannot save the gateway state: %s", err)
+
+
+def lookup(key, expired_ok=False):
+    """ The cached gateway of key, None if there is none or it expired. """
+    with LOCK:
+        entry = ENTRIES.get(key)
+        if entry is None:
+            entry = load_state().get(key)
+            if entry is not None:
+                ENTRIES[key] = entry
+    if entry is None:
+        return None
+    if not expired_ok and time.time() - entry["resolved"] > ttl():
+        return None
+    return entry
+
+
+def store(key, host, port, version=None):
+    """ Remember the gateway of key, version is the resource version of the
+    ingress service it was resolved from.
+    """
+    if not host or not port:
+        # the load balancer has no address yet
+        return None
+    entry = {"host": host, "port": str(port), "version": version,
+             "resolved": time.time()}
+    with LOCK:
+        ENTRIES[key] = entry
+        entries = load_state()
+        entries[key] = entry
+        save_state(entries)
+    return entry
+
+
+def invalidate(key=None):
+    """ Forget the gateway of key, or all gateways of the current context. """
+    context = current_context()
+    with LOCK:
+        entries = load_state()
+        for cached in set(ENTRIES) | set(entries):
+            if cached == key or (key is None
+                                 and cached.split("|", 1)[1] == context):
+                ENTRIES.pop(cached, None)
+                entries.pop(cached, None)
+        save_state(entries)
+
+
+def invalidate_context(context):
+    """ Forget the gateways of a kube context in any kubeconfig, for example
+    the per-worker kubeconfigs of a context pool.
+    """
+    with LOCK:
+        entries = load_state()
+        for cached in set(ENTRIES) | set(entries):
+            if cached.split("|", 1)[1].rsplit(":", 2)[-2] == context:
+                ENTRIES.pop(cached, None)
+                entries.pop(cached, None)
+        save_state(entries)
+
+
+def main(args):
+    if args.clear:
+        save_state({})
+        return util.EXIT_SUCCESS
+    for key, entry in load_state().items():
+        age = time.time() - entry["resolved"]
+        log.info("%s -> %s:%s (version %s, %.0f seconds old)", key,
+                 entry["host"], entry["port"], entry["version"], age)
+    return util.EXIT_SUCCESS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l",
+                        "--log-file",
+                        dest="log_file",
+                        default="gateway.log",
+                        help="Specifies name of the log file.")
+    parser.add_argument(
+        "-ll",
+        "--log-level",
+        dest="log_level",
+        default="INFO",
+        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"],
+        help="The log level to choose.")
+    parser.add_argument("-c",
+                        "--clear",
+                        dest="clear",
+                        action="store_true",
+                        help="Forget all cached gateways.")
+    # Parse options and process argv
+    arguments = parser.parse_args()
+    # configure logging
+    logging.basicConfig(filename=arguments.log_file,
+                        format="%(levelname)s:%(message)s",
+                        level=getattr(logging, arguments.log_level),
+                        filemode="w")
+    stderr_log = logging.StreamHandler()
+    stderr_log.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logging.getLogger().addHandler(stderr_log)
+    sys.exit(main(arguments))
@@ -0,0 +1,263 @@
+import json
+from array import array
+
+# values are stored as integer microseconds
+US_PER_MS = 1000
+# values from 2^8 on fall into 2^7 linear sub-buckets per power of two, which
+# bounds the relative error to 1/128
+SUB_BUCKET_BITS = 8
+# anything above one hour is clamped into the last bucket
+MAX_VALUE_US = 3600 * 1000 * US_PER_MS
+
+
+class LatencyHistogram:
+    """ A log-linear latency histogram in the spirit of HdrHistogram.
+    Values below 2^bits are counted exactly, larger values land in one of
+    2^(bits-1) linear sub-buckets per power of two. Memory is fixed at
+    construction, recording is O(1) and histograms with the same layout
+    can be merged by adding their counts.
+    """
+
+    def __init__(self, sub_bucket_bits=SUB_BUCKET_BITS,
+                 max_value=MAX_VALUE_US):
+        self.sub_bucket_bits = sub_bucket_bits
+        self.max_value = max_value
+        self.counts = array("q", [0] * (self._index(max_value) + 1))
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        shift = value.bit_length() - self.sub_bucket_bits
+        if shift <= 0:
+            return value
+        half = 1 << (self.sub_bucket_bits - 1)
+        return shift * half + (value >> shift)
+
+    def _bounds(self, index):
+        # inverse of _index, the inclusive value range of a bucket
+        if index < (1 << self.sub_bucket_bits):
+            return index, index
+        half = 1 << (self.sub_bucket_bits - 1)
+        shift = index // half - 1
+        low = (index - shift * half) << shift
+        return low, low + (1 << shift) - 1
+
+    def record(self, latency_ms, count=1):
+        value = min(max(int(latency_ms * US_PER_MS), 0), self.max_value)
+        self.counts[self._index(value)] += count
+        self.total += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def record_array(self, latencies_ms):
+        """ Record a numpy array of latencies at once, the same as calling
+        record for every element.
+        """
+        import numpy as np
+        values = np.asarray(latencies_ms, dtype=np.float64) * US_PER_MS
+        if not len(values):
+            return
+        values = np.clip(np.trunc(values), 0, self.max_value).astype(np.int64)
+        # values are below 2^53, so frexp returns their exact bit length
+        shift = np.frexp(values)[1] - self.sub_bucket_bits
+        half = 1 << (self.sub_bucket_bits - 1)
+        shifted = shift * half + (values >> np.maximum(shift, 0))
+        indices = np.where(shift <= 0, values, shifted)
+        counts = np.frombuffer(self.counts, dtype=np.int64)
+        counts += np.bincount(indices, minlength=len(counts))
+        self.total += len(values)
+        self.sum += int(values.sum())
+        low, high = int(values.min()), int(values.max())
+        if self.min is None or low < self.min:
+            self.min = low
+        if self.max is None or high > self.max:
+            self.max = high
+
+    def merge(self, other):
+        if (other.sub_bucket_bits != self.sub_bucket_bits
+                or other.max_value != self.max_value):
+            raise ValueError("Cannot merge histograms with different layouts")
+        for idx, count in enumerate(other.counts):
+            if count:
+                self.counts[idx] += count
+        self.total += other.total
+        self.sum += other.sum
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+        return self
+
+    def percentile(self, percent):
+        """ Return the latency in ms at or below which the given percentage
+        of samples fall. The value is the upper bound of the matching bucket,
+        except for the extremes which are tracked exactly.
+        """
+        if not self.total:
+            return None
+        if percent <= 0:
+            return self.min / US_PER_MS
+        if percent >= 100:
+            return self.max / US_PER_MS
+        rank = percent / 100 * self.total
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                _, high = self._bounds(idx)
+                return min(high, self.max) / US_PER_MS
+        return self.max / US_PER_MS
+
+    def mean(self):
+        if not self.total:
+            return None
+        return self.sum / self.total / US_PER_MS
+
+    def buckets(self):
+        """ Yield (lower ms, upper ms, count) for every non-empty bucket. """
+        for idx, count in enumerate(self.counts):
+            if count:
+                low, high = self._bounds(idx)
+                yield low / US_PER_MS, high / US_PER_MS, count
+
+    def to_dict(self):
+        # sparse representation, only non-empty buckets are stored
+        return {
+            "sub_bucket_bits": self.sub_bucket_bits,
+            "max_value": self.max_value,
+            "total": self.total,
+            "sum": self.sum,
+            "min": self.min,
+            "max": self.max,
+            "counts": [[idx, count] for idx, count in enumerate(self.counts)
+                       if count],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        hist = cls(data["sub_bucket_bits"], data["max_value"])
+        for idx, count in data["counts"]:
+            hist.counts[idx] = count
+        hist.total = data["total"]
+        hist.sum = data["sum"]
+        hist.min = data["min"]
+        hist.max = data["max"]
+        return hist
+
+    def __len__(self):
+        return self.total
+
+
+SUCCESS = "success"
+TIMEOUT = "timeout"
+CONNECTION_ERROR = "connection_error"
+
+
+def status_outcome(status):
+    if 200 <= status < 300:
+        return SUCCESS
+    return f"http_{status // 100}xx"
+
+
+class OutcomeHistograms:
+    """ The result of a load run, one latency histogram per outcome.
+    Timeouts are censored samples, they are recorded with the time until
+    they timed out since the real latency is only known to be at least that
+    long.
+    """
+
+    def __init__(self, duration=0):
+        self.duration = duration
+        self.hists = {}
+
+    def record(self, outcome, latency_ms):
+        hist = self.hists.get(outcome)
+        if hist is None:
+            hist = self.hists[outcome] = LatencyHistogram()
+        hist.record(latency_ms)
+
+    def record_array(self, outcome, latencies_ms):
+        hist = self.hists.get(outcome)
+        if hist is None:
+            hist = self.hists[outcome] = LatencyHistogram()
+        hist.record_array(latencies_ms)
+
+    def get(self, outcome):
+        return self.hists.get(outcome, LatencyHistogram())
+
+    @property
+    def offered(self):
+        return sum(hist.total for hist in self.hists.values())
+
+    def goodput(self):
+        # successful requests per second
+        if not self.duration:
+            return 0.0
+        return self.get(SUCCESS).total / self.duration
+
+    def offered_rate(self):
+        if not self.duration:
+            return 0.0
+        return self.offered / self.duration
+
+    def error_rate(self):
+        if not self.offered:
+            return 0.0
+        return 1 - self.get(SUCCESS).total / self.offered
+
+    def combined(self):
+        """ All outcomes in one histogram, including censored timeouts. """
+        combined = LatencyHistogram()
+        for hist in self.hists.values():
+            combined.merge(hist)
+        return combined
+
+    def merge(self, other):
+        # merged runs are assumed to have run side by side
+        self.duration = max(self.duration, other.duration)
+        for outcome, hist in other.hists.items():
+            self.hists.setdefault(outcome, LatencyHistogram()).merge(hist)
+        return self
+
+    def summary(self):
+        counts = ", ".join(f"{outcome}: {hist.total}"
+                           for outcome, hist in sorted(self.hists.items()))
+        return (f"offered {self.offered_rate():.1f} rps, goodput "
+                f"{self.goodput():.1f} rps, error rate "
+                f"{self.error_rate():.2%} ({counts}), success p50 "
+                f"{self.get(SUCCESS).percentile(50)} ms, p99 "
+                f"{self.get(SUCCESS).percentile(99)} ms")
+
+    def to_dict(self):
+        return {
+            "duration": self.duration,
+            "outcomes": {outcome: hist.to_dict()
+                         for outcome, hist in self.hists.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        result = cls(data["duration"])
+        for outcome, hist_data in data["outcomes"].items():
+            result.hists[outcome] = LatencyHistogram.from_dict(hist_data)
+        return result
+
+
+def dump_histograms(path, hists):
+    with open(path, "w") as hist_file:
+        json.dump({name: hist.to_dict() for name, hist in hists.items()},
+                  hist_file)
+
+
+def load_histograms(path):
+    with open(path) as hist_file:
+        data = json.load(hist_file)
+    return {name: OutcomeHistograms.from_dict(d) for name, d in data.items()}
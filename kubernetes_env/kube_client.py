@@ -0,0 +1,372 @@
+import base64
+import http.client
+import json
+import logging
+import os
+import ssl
+import subprocess
+import tempfile
+import threading
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import urlencode, urlsplit
+
+import kube_util as util
+
+log = logging.getLogger(__name__)
+
+# api prefix and resource name of every kind we work with
+RESOURCES = {
+    "deployments": ("/apis/apps/v1", "deployments"),
+    "pods": ("/api/v1", "pods"),
+    "services": ("/api/v1", "services"),
+    "endpoints": ("/api/v1", "endpoints"),
+    "configmaps": ("/api/v1", "configmaps"),
+    "namespaces": ("/api/v1", "namespaces"),
+    "horizontalpodautoscalers": ("/apis/autoscaling/v1",
+                                 "horizontalpodautoscalers"),
+    "envoyfilters": ("/apis/networking.istio.io/v1alpha3", "envoyfilters"),
+    "gateways": ("/apis/networking.istio.io/v1alpha3", "gateways"),
+    "virtualservices": ("/apis/networking.istio.io/v1alpha3",
+                        "virtualservices"),
+}
+KINDS = {
+    "Deployment": "deployments",
+    "Pod": "pods",
+    "Service": "services",
+    "Endpoints": "endpoints",
+    "ConfigMap": "configmaps",
+    "Namespace": "namespaces",
+    "HorizontalPodAutoscaler": "horizontalpodautoscalers",
+    "EnvoyFilter": "envoyfilters",
+    "Gateway": "gateways",
+    "VirtualService": "virtualservices",
+}
+PATCH_TYPES = {
+    "strategic": "application/strategic-merge-patch+json",
+    "merge": "application/merge-patch+json",
+    "json": "application/json-patch+json",
+    "apply": "application/apply-patch+yaml",
+}
+FIELD_MANAGER = "kube-env"
+TIMEOUT = 30
+# set to 0 to always use kubectl
+USE_API_ENV = "KUBE_ENV_USE_API"
+# requests that can be sent again without changing the outcome
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+CONFLICT = 409
+
+
+class KubeApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class KubeClient:
+    """ A minimal client for the Kubernetes API that keeps one
+    authenticated keep-alive connection open to the API server.
+    """
+
+    def __init__(self, server, token=None, ca_file=None, cert_file=None,
+                 key_file=None, insecure=False):
+        url = urlsplit(server)
+        self.https = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port or (443 if self.https else 80)
+        self.token = token
+        self.ssl_context = None
+        if self.https:
+            self.ssl_context = ssl.create_default_context(cafile=ca_file)
+            if insecure:
+                self.ssl_context.check_hostname = False
+                self.ssl_context.verify_mode = ssl.CERT_NONE
+            if cert_file:
+                self.ssl_context.load_cert_chain(cert_file, key_file)
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        if self.https:
+            return http.client.HTTPSConnection(self.host, self.port,
+                                               timeout=TIMEOUT,
+                                               context=self.ssl_context)
+        return http.client.HTTPConnection(self.host, self.port,
+                                          timeout=TIMEOUT)
+
+    def request(self, method, path, body=None, content_type=None,
+                query=None):
+        if query:
+            path += "?" + urlencode(query)
+        headers = {"Accept": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        if body is not None:
+            if not isinstance(body, (bytes, str)):
+                body = json.dumps(body)
+            headers["Content-Type"] = content_type or "application/json"
+        log.debug("API %s %s", method, path)
+        with self.lock:
+            # retry once, the server may have closed an idle connection
+            for attempt in range(2):
+                if self.conn is None:
+                    self.conn = self._connect()
+                sent = False
+                try:
+                    self.conn.request(method, path, body=body,
+                                      headers=headers)
+                    sent = True
+                    res = self.conn.getresponse()
+                    data = res.read()
+                    break
+                except (http.client.HTTPException, OSError):
+                    self.conn.close()
+                    self.conn = None
+                    # the server may have acted on a request it received,
+                    # only repeat those where that does not matter
+                    if attempt or (sent and method not in IDEMPOTENT_METHODS):
+                        raise
+        if res.status >= 400:
+            try:
+                message = json.loads(data).get("message", data)
+            except ValueError:
+                message = data.decode("utf-8", "replace")
+            raise KubeApiError(res.status, message)
+        return json.loads(data) if data else None
+
+    def close(self):
+        with self.lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+    def path(self, kind, namespace=None, name=None):
+        prefix, resource = RESOURCES[kind]
+        path = prefix
+        if namespace and kind != "namespaces":
+            path += f"/namespaces/{namespace}"
+        path += f"/{resource}"
+        if name:
+            path += f"/{name}"
+        return path
+
+    def list(self, kind, namespace=None, label_selector=None):
+        return self.list_versioned(kind, namespace, label_selector)[0]
+
+    def list_versioned(self, kind, namespace=None, label_selector=None):
+        """ The items and the resource version to start a watch from. """
+        query = {"labelSelector": label_selector} if label_selector else None
+        res = self.request("GET", self.path(kind, namespace), query=query)
+        return res["items"], res.get("metadata", {}).get("resourceVersion")
+
+    def watch(self, kind, namespace=None, resource_version=None,
+              label_selector=None, timeout=60):
+        """ Yield (event type, object) for every change after
+        resource_version until the server ends the watch after timeout
+        seconds. A watch holds its connection, so it gets its own.
+        """
+        query = {"watch": "1", "timeoutSeconds": str(int(timeout))}
+        if resource_version:
+            query["resourceVersion"] = resource_version
+        if label_selector:
+            query["labelSelector"] = label_selector
+        headers = {"Accept": "application/json"}
+        if self.token:
+            headers["Authorization"] = f"Bearer {self.token}"
+        conn = self._connect()
+        conn.timeout = timeout + TIMEOUT
+        try:
+            conn.request("GET", self.path(kind, namespace) + "?" +
+                         urlencode(query), headers=headers)
+            res = conn.getresponse()
+            if res.status >= 400:
+                raise KubeApiError(res.status, res.read().decode(
+                    "utf-8", "replace"))
+            for line in iter(res.readline, b""):
+                if line.strip():
+                    event = json.loads(line)
+                    yield event["type"], event["object"]
+        finally:
+            conn.close()
+
+    def get(self, kind, name, namespace=None):
+        return self.request("GET", self.path(kind, namespace, name))
+
+    def exists(self, kind, name, namespace=None):
+        try:
+            self.get(kind, name, namespace)
+        except KubeApiError as err:
+            if err.status == 404:
+                return False
+            raise
+        return True
+
+    def create(self, kind, body, namespace=None):
+        return self.request("POST", self.path(kind, namespace), body)
+
+    def delete(self, kind, name, namespace=None, missing_ok=False):
+        try:
+            return self.request("DELETE", self.path(kind, namespace, name))
+        except KubeApiError as err:
+            if missing_ok and err.status == 404:
+                return None
+            raise
+
+    def patch(self, kind, name, patch, namespace=None, patch_type="strategic"):
+        return self.request("PATCH", self.path(kind, namespace, name), patch,
+                            content_type=PATCH_TYPES[patch_type])
+
+    def apply(self, manifest):
+        """ Server-side apply of a single manifest. """
+        kind = KINDS[manifest["kind"]]
+        namespace = manifest["metadata"].get("namespace")
+        name = manifest["metadata"]["name"]
+        # JSON is valid YAML, so the manifest can be sent as is
+        return self.request("PATCH", self.path(kind, namespace, name),
+                            manifest, content_type=PATCH_TYPES["apply"],
+                            query={"fieldManager": FIELD_MANAGER,
+                                   "force": "true"})
+
+    def apply_all(self, manifests):
+        return [self.apply(manifest) for manifest in manifests]
+
+    def patch_all(self, kind, names, patch, namespace=None,
+                  patch_type="strategic"):
+        return [self.patch(kind, name, patch, namespace, patch_type)
+                for name in names]
+
+    def rollout_restart(self, kind, name, namespace=None, annotations=None):
+        # the same annotation kubectl rollout restart sets
+        now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+        pod_annotations = {"kubectl.kubernetes.io/restartedAt": now}
+        pod_annotations.update(annotations or {})
+        patch = {"spec": {"template": {"metadata": {
+            "annotations": pod_annotations}}}}
+        return self.patch(kind, name, patch, namespace)
+
+    def create_configmap(self, name, files, namespace=None):
+        """ Create a config map from files like kubectl --from-file does,
+        binary files end up in binaryData.
+        """
+        data = {}
+        binary_data = {}
+        for file_path in files:
+            file_path = Path(file_path)
+            content = file_path.read_bytes()
+            try:
+                data[file_path.name] = content.decode("utf-8")
+            except UnicodeDecodeError:
+                binary_data[file_path.name] = base64.b64encode(
+                    content).decode("ascii")
+        body = {"apiVersion": "v1", "kind": "ConfigMap",
+                "metadata": {"name": name}}
+        if data:
+            body["data"] = data
+        if binary_data:
+            body["binaryData"] = binary_data
+        try:
+            return self.create("configmaps", body, namespace)
+        except KubeApiError as err:
+            if err.status != CONFLICT:
+                raise
+        # like kubectl create would fail, but we know what it should hold
+        log.warning("Config map %s already exists, replacing it.", name)
+        return self.request("PUT", self.path("configmaps", namespace, name),
+                            body)
+
+
+def load_manifests(manifest_file):
+    import yaml
+    with open(manifest_file) as yaml_file:
+        return [doc for doc in yaml.safe_load_all(yaml_file) if doc]
+
+
+def _write_temp(content):
+    # ssl only loads certificates and keys from files
+    handle, name = tempfile.mkstemp(prefix="kube_client_")
+    with os.fdopen(handle, "wb") as temp:
+        temp.write(base64.b64decode(content))
+    return name
+
+
+def from_kubeconfig(context=None):
+    """ Build a client from the kubectl configuration. Returns None if the
+    configuration uses an authentication method we do not support, in that
+    case callers fall back to kubectl.
+    """
+    cmd = "kubectl config view --raw --minify --flatten -o json"
+    if context:
+        cmd += f" --context {context}"
+    try:
+        config = json.loads(util.get_output_from_proc(
+            cmd, stderr=subprocess.DEVNULL))
+    except (subprocess.CalledProcessError, OSError, ValueError):
+        return None
+    if not config.get("clusters") or not config.get("users"):
+        return None
+    cluster = config["clusters"][0]["cluster"]
+    user = config["users"][0]["user"]
+    if "exec" in user or "auth-provider" in user:
+        log.debug("Unsupported kubeconfig authentication, using kubectl.")
+        return None
+    ca_file = cert_file = key_file = None
+    try:
+        if "certificate-authority-data" in cluster:
+            ca_file = _write_temp(cluster["certificate-authority-data"])
+        if "client-certificate-data" in user:
+            cert_file = _write_temp(user["client-certificate-data"])
+            key_file = _write_temp(user["client-key-data"])
+        return KubeClient(cluster["server"], token=user.get("token"),
+                          ca_file=ca_file, cert_file=cert_file,
+                          key_file=key_file,
+                          insecure=cluster.get("insecure-skip-tls-verify",
+                                               False))
+    finally:
+        # the ssl context holds them now, do not leave keys on disk
+        for temp_file in (ca_file, cert_file, key_file):
+            if temp_file:
+                os.unlink(temp_file)
+
+
+CLIENT = None
+CLIENT_LOADED = False
+
+
+def get_client():
+    """ The shared client of this process, or None if kubectl is used. """
+    global CLIENT, CLIENT_LOADED
+    if os.environ.get(USE_API_ENV) == "0":
+        return None
+    if not CLIENT_LOADED:
+        CLIENT = from_kubeconfig()
+        CLIENT_LOADED = True
+    return CLIENT
+
+
+def set_client(client):
+    global CLIENT, CLIENT_LOADED
+    CLIENT = client
+    CLIENT_LOADED = True
+
+
+def with_fallback(api_call, fallback):
+    """ Run api_call with the shared client, or fallback if there is no
+    client or the API call fails.
+    """
+    client = get_client()
+    if client is not None:
+        try:
+            return api_call(client)
+        except KubeApiError as err:
+            if err.status == CONFLICT:
+                # kubectl would run into the same conflict, or repeat a
+                # change the API already made
+                log.error("Kubernetes API call conflicts with the cluster"
+                          " state: %s", err)
+                raise
+            log.warning("Kubernetes API call failed (%s),"
+                        " falling back to kubectl.", err)
+        except (OSError, http.client.HTTPException) as err:
+            log.warning("Kubernetes API call failed (%s),"
+                        " falling back to kubectl.", err)
+    return fallback()
@@ -1,16 +1,25 @@
 #!/usr/bin/env python3
 import argparse
-import csv
+import base64
+import hashlib
+import json
 import time
 import logging
 import sys
 import os
-from multiprocessing import Process
-from concurrent.futures import ThreadPoolExecutor
+import tempfile
 from pathlib import Path
-import requests
+from concurrent.futures import ThreadPoolExecutor
 
 import kube_util as util
+import build_cache
+import gateway_cache
+import kube_client
+import namespaces
+import readiness
+import timing
+import traffic
+import wasm_tools
 
 log = logging.getLogger(__name__)
 
@@ -75,42 +84,42 @@ FILTER_DIR = FILE_DIR.joinpath("../tracing_compiler/filter_envoy")
 DISTRIBUTED_FILTER_DIR = FILE_DIR.joinpath(
     "../tracing_compiler/distributed_filter_envoy")
 CM_FILTER_NAME = "rs-filter"
-# the kubernetes python API sucks, but keep this for later
-
-# from kubernetes import client
-# from kubernetes.client.configuration import Configuration
-# from kubernetes.utils import create_from_yaml
-# from kubernetes.config import kube_config
-# def get_e2e_configuration():
-#     config = Configuration()
-#     config.host = None
-#     kube_config.load_kube_config(client_configuration=config)
-#     log.info('Running test against : %s' % config.host)
-#     return config
-# conf = get_e2e_configuration()
-# k8s_client = client.api_client.ApiClient(configuration=conf)
-# create_from_yaml(k8s_client, f"{bookinfo_dir}/platform/kube/bookinfo.yaml")
-
+MINIKUBE_PROFILE_ENV = "MINIKUBE_PROFILE"
 
 
 ############## PLATFORM RELATED FUNCTIONS ###############################
 def inject_istio():
-    cmd = f"{ISTIO_BIN} install --set profile=demo "
-    cmd += "--set meshConfig.enableTracing=true --skip-confirmation "
-    result = util.exec_process(cmd)
+    result = install_istio()
     if result != util.EXIT_SUCCESS:
         return result
-    cmd = "kubectl label namespace default istio-injection=enabled --overwrite"
-    result = util.exec_process(cmd)
+    return enable_injection()
+
 
-    cmd = f"{ISTIO_BIN} install --set profile=demo -n storage "
+def install_istio(env=None):
+    """ Install the istio control plane, into the cluster of env if given.
+    """
+    cmd = f"{ISTIO_BIN} install --set profile=demo "
     cmd += "--set meshConfig.enableTracing=true --skip-confirmation "
-    result = util.exec_process(cmd)
+    result = util.exec_process(cmd, env=env)
     if result != util.EXIT_SUCCESS:
         return result
-    cmd = "kubectl label namespace storage istio-injection=enabled --overwrite"
-    result = util.exec_process(cmd)
+    # the install may have replaced the ingress gateway, the context pool
+    # forgets the gateways of the clusters it installs to itself
+    if env is None:
+        gateway_cache.invalidate()
+    cmd = f"{ISTIO_BIN} install --set profile=demo -n {namespaces.storage()} "
+    cmd += "--set meshConfig.enableTracing=true --skip-confirmation "
+    return util.exec_process(cmd, env=env)
 
+
+def enable_injection():
+    """ Add the sidecars to the pods of this instance. """
+    result = util.EXIT_SUCCESS
+    for namespace in (namespaces.app(), namespaces.storage()):
+        cmd = f"kubectl label namespace {namespace} "
+        cmd += "istio-injection=enabled --overwrite"
+        if util.exec_process(cmd) != util.EXIT_SUCCESS:
+            result = util.EXIT_FAILURE
     return result
 
 
@@ -131,13 +140,13 @@ def deploy_addons(addons):
     if result != util.EXIT_SUCCESS:
         return result
 
-    cmd = "kubectl get deploy -n istio-system -o name --all-namespaces "
-    deployments = util.get_output_from_proc(cmd).decode("utf-8").strip()
-    deployments = deployments.split("\n")
+    deployments = get_deployments("istio-system")
+    wait_cmds = {}
     for depl in deployments:
         wait_cmd = "kubectl rollout status -n istio-system "
         wait_cmd += f"{depl} -w --timeout=180s"
-        _ = util.exec_process(wait_cmd)
+        wait_cmds[depl] = wait_cmd
+    _ = util.exec_parallel(wait_cmds)
     log.info("Addons are ready.")
     return util.EXIT_SUCCESS
 
@@ -156,13 +165,83 @@ def remove_addons(addons):
     return util.exec_process(cmd)
 
 
+def get_deployments(namespace=None):
+    namespace = namespace or namespaces.app()
+
+    def api_call(client):
+        return [f"deployment.apps/{depl['metadata']['name']}"
+                for depl in client.list("deployments", namespace)]
+
+    def fallback():
+        cmd = f"kubectl get deploy -n {namespace} -o name"
+        deployments = util.get_output_from_proc(cmd).decode("utf-8").strip()
+        return [depl for depl in deployments.split("\n") if depl]
+
+    return kube_client.with_fallback(api_call, fallback)
+
+
+def deployment_name(depl):
+    # kubectl names deployments as deployment.apps/<name>
+    return depl.split("/")[-1]
+
+
+def kubectl_manifest(cmd, manifest_file):
+    """ Run a kubectl apply or delete command on a manifest file, moved to
+    the namespaces of this instance first.
+    """
+    if namespaces.is_default():
+        return util.exec_process(f"{cmd} {manifest_file}")
+    manifests = namespaces.rewrite(kube_client.load_manifests(manifest_file))
+    # kubectl takes JSON as well, a list holds all documents
+    handle, name = tempfile.mkstemp(prefix="manifest_", suffix=".json")
+    with os.fdopen(handle, "w") as manifest_list:
+        json.dump({"apiVersion": "v1", "kind": "List", "items": manifests},
+                  manifest_list)
+    try:
+        return util.exec_process(f"{cmd} {name}")
+    finally:
+        os.remove(name)
+
+
+def apply_manifest(manifest_file):
+    def api_call(client):
+        client.apply_all(namespaces.rewrite(
+            kube_client.load_manifests(manifest_file)))
+        return util.EXIT_SUCCESS
+
+    def fallback():
+        return kubectl_manifest(APPLY_CMD, manifest_file)
+
+    return kube_client.with_fallback(api_call, fallback)
+
+
+def namespaced_cmd(cmd):
+    """ Deploy commands of the applications use the current namespace. Other
+    instances run them in their own one, scripts get it as NAMESPACE.
+    """
+    if namespaces.is_default():
+        return cmd
+    namespace = namespaces.app()
+    cmd = cmd.replace("kubectl ", f"kubectl -n {namespace} ")
+    return f"export NAMESPACE={namespace} && {cmd}"
+
+
+def create_namespaces():
+    # namespaces may be left over from an earlier application
+    create_cmds = {}
+    for namespace in dict.fromkeys([namespaces.app(), namespaces.storage()]):
+        create_cmds[namespace] = (
+            f"kubectl create namespace {namespace} --dry-run=client -o yaml"
+            " | kubectl apply -f -")
+    return util.exec_parallel(create_cmds)
+
+
 def application_wait():
-    cmd = "kubectl get deploy -o name"
-    deployments = util.get_output_from_proc(cmd).decode("utf-8").strip()
-    deployments = deployments.split("\n")
-    for depl in deployments:
-        wait_cmd = f"kubectl rollout status {depl} -w --timeout=180s"
-        _ = util.exec_process(wait_cmd)
+    wait_cmds = {}
+    for depl in get_deployments():
+        wait_cmds[depl] = (f"kubectl rollout status {depl} "
+                           f"-n {namespaces.app()} -w --timeout=180s")
+    _ = util.exec_parallel(wait_cmds)
     log.info("Application is ready.")
     return util.EXIT_SUCCESS
 
@@ -203,9 +282,8 @@ def start_kubernetes(platform, multizonal, application):
         if result != util.EXIT_SUCCESS:
             return result
 
-        # 2. Create storage namespace
-        cmd = "kubectl create namespace storage"
-        result = util.exec_process(cmd)
+        # 2. Create application and storage namespaces
+        result = create_namespaces()
         if result != util.EXIT_SUCCESS:
             return result
 
@@ -219,9 +297,8 @@ def start_kubernetes(platform, multizonal, application):
         else:
             return "APPLICATION IS NOT SUPPORTED ON MINIKUBE"
 
-        # 2. Create storage namespace
-        cmd = "kubectl create namespace storage"
-        result = util.exec_process(cmd)
+        # 2. Create application and storage namespaces
+        result = create_namespaces()
         if result != util.EXIT_SUCCESS:
             return result
 
@@ -236,12 +313,36 @@ def stop_kubernetes(platform):
         # delete minikube
         cmd = "minikube delete"
     result = util.exec_process(cmd)
+    gateway_cache.invalidate()
     return result
 
 
-def get_gateway_info(platform):
-    ingress_host = ""
-    ingress_port = ""
+def minikube_ip():
+    # several minikube clusters are told apart by their profile
+    cmd = "minikube ip"
+    if os.environ.get(MINIKUBE_PROFILE_ENV):
+        cmd += f" -p {os.environ[MINIKUBE_PROFILE_ENV]}"
+    return util.get_output_from_proc(cmd).decode("utf-8").rstrip()
+
+
+def get_ingress_service(client):
+    return client.get("services", "istio-ingressgateway", "istio-system")
+
+
+def gateway_from_service(service, platform):
+    http2_port = next(port for port in service["spec"]["ports"]
+                      if port.get("name") == "http2")
+    if platform == "GCP":
+        ingress = service["status"]["loadBalancer"]["ingress"][0]
+        return ingress["ip"], str(http2_port["port"])
+    return minikube_ip(), str(http2_port["nodePort"])
+
+
+def get_gateway_info_api(client, platform):
+    return gateway_from_service(get_ingress_service(client), platform)
+
+
+def get_gateway_info_kubectl(platform):
     if platform == "GCP":
         cmd = "kubectl -n istio-system get service istio-ingressgateway "
         cmd += "-o jsonpath={.status.loadBalancer.ingress[0].ip} "
@@ -253,11 +354,43 @@ def get_gateway_info(platform):
         ingress_port = util.get_output_from_proc(cmd).decode("utf-8").replace(
             "'", "")
     else:
-        cmd = "minikube ip"
-        ingress_host = util.get_output_from_proc(cmd).decode("utf-8").rstrip()
+        ingress_host = minikube_ip()
         cmd = "kubectl -n istio-system get service istio-ingressgateway"
         cmd += " -o jsonpath={.spec.ports[?(@.name==\"http2\")].nodePort}"
         ingress_port = util.get_output_from_proc(cmd).decode("utf-8")
+    return ingress_host, ingress_port
+
+
+def resolve_gateway(platform, cached=None):
+    """ Look up the gateway and remember it. An expired entry is still good
+    if the ingress service did not change since it was resolved.
+    """
+    def api_call(client):
+        service = get_ingress_service(client)
+        version = service["metadata"].get("resourceVersion")
+        if cached and version and cached["version"] == version:
+            return cached["host"], cached["port"], version
+        return (*gateway_from_service(service, platform), version)
+
+    def fallback():
+        return (*get_gateway_info_kubectl(platform), None)
+
+    ingress_host, ingress_port, version = kube_client.with_fallback(
+        api_call, fallback)
+    gateway_cache.store(gateway_cache.cache_key(platform), ingress_host,
+                        ingress_port, version)
+    return ingress_host, ingress_port
+
+
+def get_gateway_info(platform, use_cache=True):
+    key = gateway_cache.cache_key(platform)
+    cached = gateway_cache.lookup(key) if use_cache else None
+    if cached is not None:
+        ingress_host, ingress_port = cached["host"], cached["port"]
+    else:
+        ingress_host, ingress_port = resolve_gateway(
+            platform, gateway_cache.lookup(key, expired_ok=True)
+            if use_cache else None)
 
     log.debug("Ingress Host: %s", ingress_host)
     log.debug("Ingress Port: %s", ingress_port)
@@ -267,98 +400,190 @@ def get_gateway_info(platform):
     return ingress_host, ingress_port, gateway_url
 
 
-def burst_loop(url):
-    NUM_REQUESTS = 500
-    MAX_THREADS = 32
+def run_traffic_profile(platform, profile, fresh_connections=False):
+    _, _, gateway_url = get_gateway_info(platform)
+    url = f"http://{gateway_url}/{profile.get('path', 'productpage')}"
+    return traffic.TrafficShaper(url, profile, fresh_connections).start()
 
-    def timeout_request(_):
-        try:
-            # the timeout effectively makes this request async
-            requests.get(url, timeout=0.001)
-        except requests.exceptions.ReadTimeout:
-            pass
 
+def do_burst(platform, fresh_connections=False):
     log.info("Starting burst...")
-    # quick hack until I found a better way
-    with ThreadPoolExecutor(max_workers=MAX_THREADS) as p:
-        for _ in p.map(timeout_request, range(NUM_REQUESTS)):
-            pass
-    log.info("Done with burst...")
+    return run_traffic_profile(platform, traffic.BURST_PROFILE,
+                               fresh_connections)
 
 
-def do_burst(platform):
-    _, _, gateway_url = get_gateway_info(platform)
-    url = f"http://{gateway_url}/productpage"
-    p = Process(target=burst_loop, args=(url, ))
-    p.start()
-    # do not care about killing that process
+def handle_traffic(shaper, output_file):
+    rows = shaper.join()
+    traffic.write_rows(rows, output_file)
+    for row in rows:
+        log.info("second %3d: offered %4d achieved %4d errors %3d p99 %s ms",
+                 row["second"], row["offered"], row["achieved"],
+                 row["errors"], row["p99"])
+    return util.EXIT_SUCCESS
 
 
-def start_fortio(gateway_url):
+def start_fortio(gateway_url, threads=50, qps=300):
     cmd = f"{FILE_DIR}/bin/fortio "
-    cmd += "load -c 50 -qps 300 -jitter -t 0 -loglevel Warning "
+    cmd += f"load -c {threads} -qps {qps} -jitter -t 0 -loglevel Warning "
+    cmd += namespaces.fortio_flags()
     cmd += f"http://{gateway_url}/productpage"
     fortio_proc = util.start_process(cmd, preexec_fn=os.setsid)
     return fortio_proc
 
 
 ############### FILTER RELATED FUNCTIONS ######################################
-def build_filter(filter_dir):
+CARGO_FLAGS = "+nightly build -Z unstable-options "
+CARGO_FLAGS += "--target=wasm32-unknown-unknown --release "
+
+
+# concurrent filter builds, each of them runs two cargo builds
+BUILD_JOBS = 2
+
+
+def cargo_build_cmd(filter_dir, manifest_path, target_dir):
+    cmd = f"cargo {CARGO_FLAGS}"
+    cmd += f"--out-dir {filter_dir}/wasm_bins "
+    cmd += f"--target-dir {target_dir} "
+    cmd += f"--manifest-path {manifest_path} "
+    return cmd
+
+
+def filter_cache_key(filter_dir, build_agg, optimize):
+    return build_cache.cache_key(
+        filter_dir, f"{CARGO_FLAGS} agg={build_agg} opt={optimize}")
+
+
+def build_filter(filter_dir, use_cache=True, optimize=None):
     # TODO: Move this into a script in the filter dir
     log.info("Building filter...")
-    cmd = "cargo +nightly build -Z unstable-options "
-    cmd += "--target=wasm32-unknown-unknown --release "
-    cmd += f"--out-dir {filter_dir}/wasm_bins "
-    cmd += f"--target-dir {filter_dir}/target "
-    cmd += f"--manifest-path {filter_dir}/Cargo.toml "
-    result = util.exec_process(cmd)
+    # Also build the aggregation filter if it's not an empty or loop filter
+    build_agg = ('rs-empty-filter' not in str(filter_dir)
+                 and 'rs-loop-filter' not in str(filter_dir))
+    out_dir = Path(filter_dir).joinpath("wasm_bins")
+    key = None
+    if use_cache:
+        key = filter_cache_key(filter_dir, build_agg, optimize)
+        if build_cache.restore(key, out_dir):
+            log.info("Restored filter %s from the build cache.", key[:12])
+            return util.EXIT_SUCCESS
+    # the aggregation filter has its own target dir, cargo would otherwise
+    # lock the shared one and run the builds one after the other
+    build_cmds = {f"{filter_dir}": cargo_build_cmd(
+        filter_dir, f"{filter_dir}/Cargo.toml", f"{filter_dir}/target")}
+    if build_agg:
+        build_cmds[f"{filter_dir}/agg"] = cargo_build_cmd(
+            filter_dir, f"{filter_dir}/agg/Cargo.toml",
+            f"{filter_dir}/agg/target")
+    result = util.exec_parallel(build_cmds)
     if result != util.EXIT_SUCCESS:
         return result
-    # Also build the aggregation filter if it's not an empty or loop filter
-    if 'rs-empty-filter' not in str(filter_dir) and 'rs-loop-filter' not in str(filter_dir):
-        cmd = "cargo +nightly build -Z unstable-options "
-        cmd += "--target=wasm32-unknown-unknown --release "
-        cmd += f"--out-dir {filter_dir}/wasm_bins "
-        cmd += f"--target-dir {filter_dir}/target "
-        cmd += f"--manifest-path {filter_dir}/agg/Cargo.toml "
-        result = util.exec_process(cmd)
-        if result != util.EXIT_SUCCESS:
-            return result
+    if optimize and wasm_tools.optimize_filter(
+            filter_dir, optimize) != util.EXIT_SUCCESS:
+        log.warning("Could not optimize %s, using the unoptimized build.",
+                    filter_dir)
+        # some modules may be optimized and others not, a build like this
+        # must not be restored in place of an optimized or a plain one
+        key = None
+    build_cache.store(key, out_dir, filter_dir)
     log.info("Build successful!")
     return result
 
 
+def build_filters(filter_dirs, jobs=BUILD_JOBS, use_cache=True,
+                  optimize=None):
+    """ Start building all filters in the background, at most jobs at a
+    time. Returns a dict of filter dir to the future of its build result.
+    """
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    builds = {}
+    for filter_dir in dict.fromkeys(filter_dirs):
+        build = executor.submit(build_filter, filter_dir, use_cache,
+                                optimize)
+        build.add_done_callback(
+            lambda done, filter_dir=filter_dir: _log_build(filter_dir, done))
+        builds[filter_dir] = build
+    # queued builds still run, we just do not block on them here
+    executor.shutdown(wait=False)
+    return builds
+
+
+def _log_build(filter_dir, build):
+    if build.exception() is not None:
+        log.error("Building filter %s failed: %s", filter_dir,
+                  build.exception())
+    elif build.result() != util.EXIT_SUCCESS:
+        log.error("Building filter %s failed.", filter_dir)
+
+
+def build_succeeded(build):
+    return build.exception() is None and build.result() == util.EXIT_SUCCESS
+
+
+def wait_for_builds(builds):
+    """ Wait for all builds and return the filter dirs that failed. """
+    return [filter_dir for filter_dir, build in builds.items()
+            if not build_succeeded(build)]
+
+
 def undeploy_filter(platform, multizonal):
     # delete the config map
     delete_config_map()
-    cmd = f"kubectl delete -f {YAML_DIR}/filter.yaml "
-    result = util.exec_process(cmd, allow_failures=True)
+    result = remove_filter()
     if result != util.EXIT_SUCCESS:
         log.warning("Failed to delete the filter.")
     # restore the original bookinfo
     return deploy_application()
 
 def patch_application():
-    cmd = "kubectl get deploy -o name"
-    deployments = util.get_output_from_proc(cmd).decode("utf-8").strip()
-    deployments = deployments.split("\n")
-    for depl in deployments:
-        patch_cmd = f"kubectl patch {depl} "
+    def api_call(client):
+        patch = kube_client.load_manifests(f"{YAML_DIR}/cm_patch.yaml")[0]
+        names = [deployment_name(depl) for depl in get_deployments()]
+        client.patch_all("deployments", names, patch, namespaces.app())
+        # we also patch storage
+        client.patch("deployments", "storage-upstream", patch,
+                     namespaces.storage())
+        return util.EXIT_SUCCESS
+
+    return kube_client.with_fallback(api_call, patch_application_kubectl)
+
+
+def patch_application_kubectl():
+    patch_cmds = {}
+    for depl in get_deployments():
+        patch_cmd = f"kubectl patch -n {namespaces.app()} {depl} "
         patch_cmd += f"--patch-file {YAML_DIR}/cm_patch.yaml "
-        result = util.exec_process(patch_cmd)
-        if result != util.EXIT_SUCCESS:
-            log.error("Failed to patch %s.", depl)
+        patch_cmds[depl] = patch_cmd
     # we also patch storage
-    patch_cmd = "kubectl patch -n storage deployment.apps/storage-upstream "
+    patch_cmd = f"kubectl patch -n {namespaces.storage()} "
+    patch_cmd += "deployment.apps/storage-upstream "
     patch_cmd += f"--patch-file {YAML_DIR}/cm_patch.yaml "
-    result = util.exec_process(patch_cmd)
+    patch_cmds["storage"] = patch_cmd
+    result = util.exec_parallel(patch_cmds)
     if result != util.EXIT_SUCCESS:
-        log.error("Failed to patch storage.")
+        log.error("Failed to patch the application.")
     return result
 
 
 def create_conf_map(filter_dir):
-    cmd = f"kubectl create configmap {CM_FILTER_NAME} "
+    for wasm_file in wasm_tools.wasm_modules(filter_dir):
+        wasm_tools.check_size(wasm_file)
+
+    def api_call(client):
+        client.create_configmap(CM_FILTER_NAME,
+                                [f"{filter_dir}/wasm_bins/filter.wasm"],
+                                namespaces.app())
+        # also refresh the aggregation filter
+        client.create_configmap(CM_FILTER_NAME,
+                                [f"{filter_dir}/wasm_bins/agg_filter.wasm"],
+                                namespaces.storage())
+        return util.EXIT_SUCCESS
+
+    return kube_client.with_fallback(
+        api_call, lambda: create_conf_map_kubectl(filter_dir))
+
+
+def create_conf_map_kubectl(filter_dir):
+    cmd = f"kubectl -n {namespaces.app()} create configmap {CM_FILTER_NAME} "
     cmd += f"--from-file {filter_dir}/wasm_bins/filter.wasm "
     result = util.exec_process(cmd)
     if result != util.EXIT_SUCCESS:
@@ -366,42 +591,67 @@ def create_conf_map(filter_dir):
         return result
 
     # also refresh the aggregation filter
-    cmd = f"kubectl -n storage create configmap {CM_FILTER_NAME} "
+    cmd = f"kubectl -n {namespaces.storage()} create configmap "
+    cmd += f"{CM_FILTER_NAME} "
     cmd += f"--from-file {filter_dir}/wasm_bins/agg_filter.wasm "
     return util.exec_process(cmd)
 
 
 def delete_config_map():
-    cmd = f"kubectl delete configmap {CM_FILTER_NAME} "
+    def api_call(client):
+        if client.delete("configmaps", CM_FILTER_NAME, namespaces.app(),
+                         missing_ok=True) is None:
+            log.warning("Failed to delete the config map, it does not exist.")
+        # repeat this process for stage
+        if client.delete("configmaps", CM_FILTER_NAME, namespaces.storage(),
+                         missing_ok=True) is None:
+            return util.EXIT_FAILURE
+        return util.EXIT_SUCCESS
+
+    return kube_client.with_fallback(api_call, delete_config_map_kubectl)
+
+
+def delete_config_map_kubectl():
+    cmd = f"kubectl delete -n {namespaces.app()} configmap {CM_FILTER_NAME} "
     result = util.exec_process(cmd, allow_failures=True)
     if result != util.EXIT_SUCCESS:
         log.warning("Failed to delete the config map, it does not exist.")
     # repeat this process for stage
-    cmd = f"kubectl delete -n storage configmap {CM_FILTER_NAME} "
+    cmd = f"kubectl delete -n {namespaces.storage()} configmap "
+    cmd += f"{CM_FILTER_NAME} "
     return util.exec_process(cmd, allow_failures=True)
 
 
 def update_conf_map(filter_dir):
     # delete the config map
-    result = delete_config_map()
+    with timing.phase("configmap_delete"):
+        result = delete_config_map()
     if result != util.EXIT_SUCCESS:
         log.warning("Assuming a patch is required.")
-        result = create_conf_map(filter_dir)
+        with timing.phase("configmap_create"):
+            result = create_conf_map(filter_dir)
         if result != util.EXIT_SUCCESS:
             return result
         # update the containers with the config map
-        return patch_application()
+        with timing.phase("patch_application"):
+            return patch_application()
     # "refresh" the filter by recreating the config map
-    return create_conf_map(filter_dir)
+    with timing.phase("configmap_create"):
+        return create_conf_map(filter_dir)
 
 
 def deploy_filter(filter_dir):
     # check if the config map already exists
     # we assume that if the config map does not exist in default
     # it also does not exist in storage
-    cmd = f"kubectl get configmaps {CM_FILTER_NAME} "
-    result = util.exec_process(cmd, allow_failures=True)
-    if result == util.EXIT_SUCCESS:
+    def fallback():
+        cmd = f"kubectl get configmaps {CM_FILTER_NAME} -n {namespaces.app()}"
+        result = util.exec_process(cmd, allow_failures=True)
+        return result == util.EXIT_SUCCESS
+
+    if kube_client.with_fallback(
+            lambda client: client.exists("configmaps", CM_FILTER_NAME,
+                                         namespaces.app()), fallback):
         # Config map exists, assume that the deployment is already modded
         log.warning("Config map %s already exists!", CM_FILTER_NAME)
         # delete and recreate the config map
@@ -415,52 +665,245 @@ def deploy_filter(filter_dir):
     if result != util.EXIT_SUCCESS:
         return result
     # now activate the filter
-    cmd = f"kubectl apply -f {YAML_DIR}/filter.yaml"
-    return util.exec_process(cmd)
+    return apply_manifest(f"{YAML_DIR}/filter.yaml")
+
 
+def filter_revision(filter_dir):
+    # the revision of a filter is the hash of its binaries
+    sha = hashlib.sha256()
+    for wasm in ("filter.wasm", "agg_filter.wasm"):
+        wasm_file = Path(filter_dir).joinpath("wasm_bins", wasm)
+        if wasm_file.exists():
+            sha.update(wasm_file.read_bytes())
+    return sha.hexdigest()[:16]
 
-def refresh_filter(filter_dir):
 
+def restart_deployments(revision=None):
+    # the pods are labelled with the revision so we can tell when all of them
+    # run the new filter
+    annotations = {readiness.REVISION_ANNOTATION: revision} if revision else {}
+    targets = [(namespaces.app(), deployment_name(depl))
+               for depl in get_deployments()]
+    # also reset storage since we are working with a different filter now
+    targets.append((namespaces.storage(), "storage-upstream"))
+
+    def api_call(client):
+        for namespace, name in targets:
+            client.rollout_restart("deployments", name, namespace,
+                                   annotations)
+        return util.EXIT_SUCCESS
+
+    def fallback():
+        now = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        pod_annotations = {"kubectl.kubernetes.io/restartedAt": now}
+        pod_annotations.update(annotations)
+        patch = json.dumps({"spec": {"template": {"metadata": {
+            "annotations": pod_annotations}}}})
+        restart_cmds = {}
+        for namespace, name in targets:
+            restart_cmds[f"{namespace}/{name}"] = (
+                f"kubectl patch deployment {name} -n {namespace} "
+                f"-p '{patch}'")
+        return util.exec_parallel(restart_cmds)
+
+    return kube_client.with_fallback(api_call, fallback)
+
+
+def refresh_filter(filter_dir, timeout=readiness.DEFAULT_TIMEOUT):
     start_time = time.time()
+    with timing.run("refresh_filter", filter=Path(filter_dir).name) as run:
+        result = _refresh_filter(filter_dir, timeout)
+        run["result"] = result
+    log.info("To update filter, took %d", time.time() - start_time)
+    return result
+
+
+def _refresh_filter(filter_dir, timeout):
     # delete and recreate the config map
     update_conf_map(filter_dir)
 
     # activate the filter
-    cmd = f"kubectl apply -f {YAML_DIR}/filter.yaml"
-    result = util.exec_process(cmd)
+    with timing.phase("envoyfilter_apply"):
+        result = apply_manifest(f"{YAML_DIR}/filter.yaml")
     if result != util.EXIT_SUCCESS:
         return result
     # this is equivalent to a deployment restart right now
-    cmd = "kubectl rollout restart  deployments --namespace=default"
-    result = util.exec_process(cmd)
+    revision = filter_revision(filter_dir)
+    with timing.phase("rollout_restart"):
+        result = restart_deployments(revision)
     if result != util.EXIT_SUCCESS:
         return result
-
-    # also reset storage since we are working with a different filter now
-    cmd = "kubectl rollout restart deployment storage-upstream -n=storage "
-    result = util.exec_process(cmd)
-    if result != util.EXIT_SUCCESS:
-        return result
-    result = application_wait()
-    if result != util.EXIT_SUCCESS:
-        return result
-    end_time = time.time()
-    log.info("To update filter, took %d", end_time-start_time)
-    with open("update_times.csv", 'a+') as csv_file:
-        w = csv.writer(csv_file)
-        w.writerow([end_time-start_time])
-    return application_wait()
+    # wait until every pod runs the new filter and is ready
+    return readiness.wait_for_application(revision, timeout)
+
+
+# hot swapping publishes versioned modules next to the running ones and
+# points the EnvoyFilters at them, the sidecars load them without a restart
+SWAP_TIMEOUT = 120
+SWAP_POLL_INTERVAL = 1
+WASM_MOUNT = "/var/local/lib/wasm-filters"
+ENVOY_FILTER_NAME = "ui-examplefilter"
+
+
+def base_module(module):
+    # filter-<revision>.wasm is a version of filter.wasm
+    return f"{Path(module).stem.split('-')[0]}.wasm"
+
+
+def versioned_module(module, revision):
+    return f"{Path(base_module(module)).stem}-{revision}.wasm"
+
+
+def _vm_config(manifest):
+    value = manifest["spec"]["configPatches"][0]["patch"]["value"]
+    return value["typed_config"]["value"]["config"]["vm_config"]
+
+
+def hot_swap_manifests(manifests, revision):
+    """ Point the EnvoyFilters at the modules of the given revision. A new
+    vm_id makes envoy start a fresh VM instead of reusing the old one.
+    """
+    swapped = json.loads(json.dumps(manifests))
+    for manifest in swapped:
+        vm_config = _vm_config(manifest)
+        module = Path(vm_config["code"]["local"]["filename"]).name
+        vm_config["code"]["local"]["filename"] = (
+            f"{WASM_MOUNT}/{versioned_module(module, revision)}")
+        vm_id = vm_config["vm_id"].split("-rev-")[0]
+        vm_config["vm_id"] = f"{vm_id}-rev-{revision}"
+    return swapped
+
+
+def publish_module(client, filter_dir, namespace, in_use, revision):
+    """ Add the versioned module to the config map, keeping only the module
+    that is in use next to it. Returns the new module name, or None if both
+    would not fit into the config map.
+    """
+    config_map = client.get("configmaps", CM_FILTER_NAME, namespace)
+    new_module = versioned_module(in_use, revision)
+    wasm_file = Path(filter_dir).joinpath("wasm_bins", base_module(in_use))
+    content = base64.b64encode(wasm_file.read_bytes()).decode("ascii")
+    binary_data = {}
+    size = len(content)
+    for key, value in (config_map.get("binaryData") or {}).items():
+        if key == in_use:
+            size += len(value)
+        elif key != new_module:
+            # older versions nobody refers to anymore
+            binary_data[key] = None
+    if size >= wasm_tools.CONFIGMAP_LIMIT:
+        log.warning("Old and new module do not fit into config map %s/%s.",
+                    namespace, CM_FILTER_NAME)
+        return None
+    binary_data[new_module] = content
+    client.patch("configmaps", CM_FILTER_NAME, {"binaryData": binary_data},
+                 namespace, patch_type="merge")
+    return new_module
+
+
+def _app_pods(client):
+    pods = []
+    for namespace, selector in namespaces.targets():
+        for pod in client.list("pods", namespace, label_selector=selector):
+            if readiness.pod_ready(pod):
+                pods.append((namespace, pod["metadata"]["name"]))
+    return pods
+
+
+def _wait_for_proxies(cmds, deadline):
+    # poll, neither kubelet syncing the volume nor envoy loading a module
+    # can be watched through the API
+    while time.time() < deadline:
+        if util.exec_parallel(cmds, allow_failures=True) == util.EXIT_SUCCESS:
+            return True
+        time.sleep(SWAP_POLL_INTERVAL)
+    return False
+
+
+def _hot_swap(client, filter_dir, revision, deadline):
+    manifests = namespaces.rewrite(
+        kube_client.load_manifests(f"{YAML_DIR}/filter.yaml"))
+    modules = {}
+    with timing.phase("configmap_publish"):
+        for manifest in manifests:
+            namespace = manifest["metadata"]["namespace"]
+            current = client.get("envoyfilters",
+                                 manifest["metadata"]["name"], namespace)
+            in_use = Path(
+                _vm_config(current)["code"]["local"]["filename"]).name
+            new_module = publish_module(client, filter_dir, namespace,
+                                        in_use, revision)
+            if new_module is None:
+                return False
+            modules[namespace] = new_module
+    pods = _app_pods(client)
+    # the config map volume is synced by the kubelet with some delay
+    exists_cmds = {}
+    for namespace, pod in pods:
+        exists_cmds[f"{namespace}/{pod}"] = (
+            f"kubectl exec -n {namespace} {pod} -c istio-proxy -- "
+            f"test -f {WASM_MOUNT}/{modules[namespace]}")
+    with timing.phase("module_sync"):
+        if not _wait_for_proxies(exists_cmds, deadline):
+            log.warning("The new module did not reach all sidecars.")
+            return False
+    with timing.phase("envoyfilter_apply"):
+        client.apply_all(hot_swap_manifests(manifests, revision))
+    loaded_cmds = {}
+    for namespace, pod in pods:
+        loaded_cmds[f"{namespace}/{pod}"] = (
+            f"kubectl exec -n {namespace} {pod} -c istio-proxy -- "
+            "pilot-agent request GET config_dump | "
+            f"grep -q {modules[namespace]}")
+    with timing.phase("module_load"):
+        if not _wait_for_proxies(loaded_cmds, deadline):
+            log.warning("Not all sidecars loaded the new module.")
+            return False
+    return True
+
+
+def swap_filter(filter_dir, timeout=SWAP_TIMEOUT,
+                ready_timeout=readiness.DEFAULT_TIMEOUT):
+    """ Replace the running filter without restarting the pods. Falls back to
+    refresh_filter if the module cannot be reloaded in place.
+    """
+    start_time = time.time()
+    revision = filter_revision(filter_dir)
+    with timing.run("swap_filter", filter=Path(filter_dir).name,
+                    revision=revision) as run:
+        run["mode"] = "hot"
+        client = kube_client.get_client()
+        try:
+            swapped = client is not None and _hot_swap(
+                client, filter_dir, revision, start_time + timeout)
+        except (kube_client.KubeApiError, OSError, KeyError,
+                IndexError) as err:
+            log.warning("Hot swap failed: %s", err)
+            swapped = False
+        result = util.EXIT_SUCCESS
+        if not swapped:
+            log.warning("Cannot reload the filter in place,"
+                        " restarting instead.")
+            run["mode"] = "restart"
+            result = refresh_filter(filter_dir, ready_timeout)
+        run["result"] = result
+    log.info("Swapping the filter (%s) took %.1f seconds.", run["mode"],
+             time.time() - start_time)
+    return result
 
 
 def handle_filter(args):
     if args.build_filter:
-        return build_filter(args.filter_dir)
+        return build_filter(args.filter_dir, not args.no_build_cache,
+                            args.optimize)
     if args.deploy_filter:
         return deploy_filter(args.filter_dir)
     if args.undeploy_filter:
         return undeploy_filter()
+    if args.hot_swap:
+        return swap_filter(args.filter_dir, ready_timeout=args.ready_timeout)
     if args.refresh_filter:
-        return refresh_filter(args.filter_dir)
+        return refresh_filter(args.filter_dir, args.ready_timeout)
     log.warning("No command line input provided. Doing nothing.")
     return util.EXIT_SUCCESS
 
@@ -472,48 +915,273 @@ def deploy_application(application):
         log.error("Kubernetes is not set up."
                   " Did you run the deployment script?")
         sys.exit(util.EXIT_FAILURE)
-    cmd = CONFIG_MATRIX[application]['deploy_cmd']
-    cmd += f" && {APPLY_CMD} {YAML_DIR}/storage.yaml && "
-    cmd += f"{APPLY_CMD} {YAML_DIR}/istio-config.yaml && "
-    cmd += f"{APPLY_CMD} {YAML_DIR}/root-cluster.yaml "
-    result = util.exec_process(cmd)
-    application_wait()
-    cmd = "kubectl get deployments -o name "
-    deployments = util.get_output_from_proc(cmd).decode("utf-8").strip()
-    deployments = deployments.split("\n")
+    cmd = namespaced_cmd(CONFIG_MATRIX[application]['deploy_cmd'])
+    with timing.phase("app_deploy"):
+        result = util.exec_process(cmd)
+        for manifest in ("storage.yaml", "istio-config.yaml",
+                         "root-cluster.yaml"):
+            if result == util.EXIT_SUCCESS:
+                result = apply_manifest(f"{YAML_DIR}/{manifest}")
+        if result == util.EXIT_SUCCESS:
+            result = route_gateway()
+    with timing.phase("app_ready"):
+        application_wait()
     log.info("Starting horizontal autoscaling")
-    for depl in deployments:
+    autoscale_cmds = {}
+    for depl in get_deployments():
+        cmd = f"kubectl autoscale -n {namespaces.app()} {depl} "
         if "front" in depl:
-            cmd = f"kubectl autoscale {depl} --min=1 --max=30 --cpu-percent=40"
+            cmd += "--min=1 --max=30 --cpu-percent=40"
         else:
-            cmd = f"kubectl autoscale {depl} --min=1 --max=10 --cpu-percent=40"
-        result = util.exec_process(cmd)
-        if result != util.EXIT_SUCCESS:
-            return result
-    application_wait()
+            cmd += "--min=1 --max=10 --cpu-percent=40"
+        autoscale_cmds[depl] = cmd
+    with timing.phase("hpa_create"):
+        result = util.exec_parallel(autoscale_cmds)
+    if result != util.EXIT_SUCCESS:
+        return result
+    with timing.phase("hpa_ready"):
+        application_wait()
 
     return result
 
 def remove_application(application):
-    cmd = CONFIG_MATRIX[application]['undeploy_cmd']
-    cmd += f" && {DELETE_CMD} {YAML_DIR}/storage.yaml && "
-    cmd += f"{DELETE_CMD} {YAML_DIR}/root-cluster.yaml "
+    cmd = namespaced_cmd(CONFIG_MATRIX[application]['undeploy_cmd'])
     result = util.exec_process(cmd)
+    for manifest in ("storage.yaml", "root-cluster.yaml"):
+        if result == util.EXIT_SUCCESS:
+            result = kubectl_manifest(DELETE_CMD, f"{YAML_DIR}/{manifest}")
     return result
 
-def setup_application_deployment(platform, multizonal, application):
-    result = start_kubernetes(platform, multizonal, application)
+
+def _route_hosts(hosts, host):
+    # only the catch-all entries route gateway traffic to the application
+    return [host if entry == "*" else entry for entry in hosts]
+
+
+def route_gateway_api(client, host):
+    namespace = namespaces.app()
+    for gateway in client.list("gateways", namespace):
+        servers = gateway["spec"].get("servers") or []
+        for server in servers:
+            server["hosts"] = _route_hosts(server.get("hosts") or [], host)
+        client.patch("gateways", gateway["metadata"]["name"],
+                     {"spec": {"servers": servers}}, namespace,
+                     patch_type="merge")
+    for service in client.list("virtualservices", namespace):
+        if not service["spec"].get("gateways"):
+            continue
+        client.patch("virtualservices", service["metadata"]["name"],
+                     {"spec": {"hosts": _route_hosts(
+                         service["spec"].get("hosts") or [], host)}},
+                     namespace, patch_type="merge")
+    return util.EXIT_SUCCESS
+
+
+def route_gateway_kubectl(host):
+    namespace = namespaces.app()
+    patch_cmds = {}
+    for kind in ("gateways", "virtualservices"):
+        cmd = f"kubectl get {kind} -n {namespace} -o json"
+        for item in json.loads(util.get_output_from_proc(cmd))["items"]:
+            spec = item["spec"]
+            if kind == "gateways":
+                for server in spec.get("servers") or []:
+                    server["hosts"] = _route_hosts(server.get("hosts") or [],
+                                                   host)
+                patch = {"spec": {"servers": spec.get("servers") or []}}
+            elif spec.get("gateways"):
+                patch = {"spec": {"hosts": _route_hosts(
+                    spec.get("hosts") or [], host)}}
+            else:
+                continue
+            name = item["metadata"]["name"]
+            patch_cmds[f"{kind}/{name}"] = (
+                f"kubectl patch {kind} {name} -n {namespace} --type merge "
+                f"-p '{json.dumps(patch)}'")
+    return util.exec_parallel(patch_cmds)
+
+
+def route_gateway():
+    """ All instances share the ingress gateway. The default instance gets
+    every request, the others only those for their own host.
+    """
+    host = namespaces.gateway_host()
+    if host is None:
+        return util.EXIT_SUCCESS
+    log.info("Routing requests for host %s to namespace %s.", host,
+             namespaces.app())
+    return kube_client.with_fallback(
+        lambda client: route_gateway_api(client, host),
+        lambda: route_gateway_kubectl(host))
+
+def setup_application_deployment(platform, multizonal, application,
+                                 start_cluster=True):
+    """ Start a cluster and deploy the application with istio. Without
+    start_cluster the application is deployed to the current cluster, which
+    must already run istio.
+    """
+    with timing.run("setup", platform=platform,
+                    application=application) as run:
+        run["result"] = _setup_application_deployment(platform, multizonal,
+                                                      application,
+                                                      start_cluster)
+    return run["result"]
+
+
+def _setup_application_deployment(platform, multizonal, application,
+                                  start_cluster):
+    with timing.phase("cluster_start"):
+        if start_cluster:
+            result = start_kubernetes(platform, multizonal, application)
+        else:
+            result = create_namespaces()
     if result != util.EXIT_SUCCESS:
         return result
-    result = inject_istio()
+    with timing.phase("istio_injection"):
+        if start_cluster:
+            result = inject_istio()
+        else:
+            # installed once per cluster, see context_pool.install_istio
+            result = enable_injection()
     if result != util.EXIT_SUCCESS:
         return result
-    result = deploy_application(application)
+    return deploy_application(application)
+
+
+def remove_filter():
+    """ Deactivate the filter but keep the config map, the pods mount it. """
+    def api_call(client):
+        for manifest in namespaces.rewrite(
+                kube_client.load_manifests(f"{YAML_DIR}/filter.yaml")):
+            client.delete(kube_client.KINDS[manifest["kind"]],
+                          manifest["metadata"]["name"],
+                          manifest["metadata"].get("namespace"),
+                          missing_ok=True)
+        return util.EXIT_SUCCESS
+
+    def fallback():
+        return kubectl_manifest(f"{DELETE_CMD} --ignore-not-found",
+                                f"{YAML_DIR}/filter.yaml")
+
+    return kube_client.with_fallback(api_call, fallback)
+
+
+def scale_deployments(replicas=1):
+    # the autoscalers keep their bounds and scale up again under load
+    def api_call(client):
+        names = [deployment_name(depl) for depl in get_deployments()]
+        client.patch_all("deployments", names,
+                         {"spec": {"replicas": replicas}}, namespaces.app())
+        return util.EXIT_SUCCESS
+
+    def fallback():
+        scale_cmds = {}
+        for depl in get_deployments():
+            scale_cmds[depl] = (f"kubectl scale -n {namespaces.app()} {depl} "
+                                f"--replicas={replicas}")
+        return util.exec_parallel(scale_cmds)
+
+    return kube_client.with_fallback(api_call, fallback)
+
+
+def replica_counts():
+    """ Ready replicas of every deployment of the application. """
+    def api_call(client):
+        return {depl["metadata"]["name"]:
+                (depl.get("status", {}).get("readyReplicas") or 0)
+                for depl in client.list("deployments", namespaces.app())}
+
+    def fallback():
+        cmd = f"kubectl get deployments -n {namespaces.app()} -o jsonpath="
+        cmd += "{range.items[*]}{.metadata.name}={.status.readyReplicas},{end}"
+        output = util.get_output_from_proc(cmd).decode("utf-8")
+        counts = {}
+        for entry in filter(None, output.split(",")):
+            name, ready = entry.split("=")
+            counts[name] = int(ready or 0)
+        return counts
+
+    return kube_client.with_fallback(api_call, fallback)
+
+
+def clean_storage():
+    # imported here, query_storage itself depends on this module
+    import query_storage
+    storage_proc = query_storage.init_storage_mon()
+    try:
+        response = query_storage.query_storage("clean")
+    finally:
+        query_storage.kill_storage_mon(storage_proc)
+    if not response.ok:
+        log.error("Could not clean storage: %s", response.status_code)
+        return util.EXIT_FAILURE
+    return util.EXIT_SUCCESS
+
+
+def reset_application(timeout=readiness.DEFAULT_TIMEOUT, replicas=1):
+    """ Bring a running application back to the state right after setup,
+    so the next scenario can reuse the cluster: no filter, fresh pods with
+    the given number of replicas and empty storage.
+    """
+    with timing.run("reset") as run:
+        run["result"] = _reset_application(timeout, replicas)
+    return run["result"]
+
+
+def _reset_application(timeout, replicas):
+    with timing.phase("filter_remove"):
+        result = remove_filter()
     if result != util.EXIT_SUCCESS:
         return result
-    return result
+    with timing.phase("scale_down"):
+        result = scale_deployments(replicas)
+    if result != util.EXIT_SUCCESS:
+        return result
+    # new pods drop all state the last scenario left in the application and
+    # in storage
+    revision = f"reset-{int(time.time())}"
+    with timing.phase("rollout_restart"):
+        result = restart_deployments(revision)
+    if result != util.EXIT_SUCCESS:
+        return result
+    result = readiness.wait_for_application(revision, timeout)
+    if result != util.EXIT_SUCCESS:
+        return result
+    with timing.phase("storage_clean"):
+        result = clean_storage()
+    if result != util.EXIT_SUCCESS:
+        return result
+    with timing.phase("verify"):
+        return verify_reset(replicas)
+
+
+def verify_reset(replicas=1):
+    counts = replica_counts()
+    unexpected = {name: count for name, count in counts.items()
+                  if count != replicas}
+    if unexpected:
+        log.error("Reset failed, deployments with unexpected replicas: %s",
+                  unexpected)
+        return util.EXIT_FAILURE
+    filter_active = kube_client.with_fallback(
+        lambda client: client.exists("envoyfilters", ENVOY_FILTER_NAME,
+                                     namespaces.app()),
+        lambda: util.exec_process(
+            f"kubectl get envoyfilters {ENVOY_FILTER_NAME} "
+            f"-n {namespaces.app()}",
+            allow_failures=True, stdout=util.subprocess.PIPE,
+            stderr=util.subprocess.PIPE) == util.EXIT_SUCCESS)
+    if filter_active:
+        log.error("Reset failed, the filter is still active.")
+        return util.EXIT_FAILURE
+    log.info("Application reset, %d deployments with %d replicas.",
+             len(counts), replicas)
+    return util.EXIT_SUCCESS
+
 
 def main(args):
+    if args.namespace:
+        namespaces.set_namespace(args.namespace)
     # single commands to execute
     if args.setup:
         return setup_application_deployment(args.platform, args.multizonal, args.application)
@@ -521,6 +1189,8 @@ def main(args):
         return deploy_application(args.application)
     if args.remove_application:
         return remove_application(args.application)
+    if args.reset:
+        return reset_application(args.ready_timeout)
     if args.deploy_addons:
         return deploy_addons(args.deploy_addons)
     if args.remove_addons:
@@ -528,7 +1198,13 @@ def main(args):
     if args.clean:
         return stop_kubernetes(args.platform)
     if args.burst:
-        return do_burst(args.platform)
+        shaper = do_burst(args.platform, args.fresh_connections)
+        return handle_traffic(shaper, args.traffic_output)
+    if args.traffic_profile:
+        profile = traffic.load_profile(args.traffic_profile)
+        shaper = run_traffic_profile(args.platform, profile,
+                                     args.fresh_connections)
+        return handle_traffic(shaper, args.traffic_output)
     return handle_filter(args)
 
 
@@ -560,6 +1236,12 @@ if __name__ == '__main__':
                         choices=["BK", "HR", "OB", "TT"],
                         help="Which application to deploy."
                         "BK is bookinfo, HR is hotel reservation, and OB is online boutique")
+    parser.add_argument("-ns",
+                        "--namespace",
+                        dest="namespace",
+                        help="Namespace of the application instance to work"
+                        " on, its storage runs in <namespace>-storage."
+                        " Instances in different namespaces share a cluster.")
     parser.add_argument("-m",
                         "--multi-zonal",
                         dest="multizonal",
@@ -573,6 +1255,13 @@ if __name__ == '__main__':
                         help="Just do a deployment. "
                         "This means installing the application and Kubernetes."
                         " Do not run any experiments.")
+    parser.add_argument("-rs",
+                        "--reset",
+                        dest="reset",
+                        action="store_true",
+                        help="Remove the filter, scale the application back"
+                        " to one replica, restart its pods and clean storage,"
+                        " as after a fresh setup.")
     parser.add_argument("-c",
                         "--clean",
                         dest="clean",
@@ -598,6 +1287,18 @@ if __name__ == '__main__':
                         dest="build_filter",
                         action="store_true",
                         help="Build the WASM filter. ")
+    parser.add_argument("-nbc",
+                        "--no-build-cache",
+                        dest="no_build_cache",
+                        action="store_true",
+                        help="Always rebuild the filter instead of restoring"
+                        " an identical earlier build from the cache.")
+    parser.add_argument("-opt",
+                        "--optimize",
+                        dest="optimize",
+                        choices=wasm_tools.OPT_LEVELS,
+                        help="Run wasm-opt at this level on the built"
+                        " filter, it needs binaryen to be installed.")
     parser.add_argument("-df",
                         "--deploy-filter",
                         dest="deploy_filter",
@@ -613,12 +1314,42 @@ if __name__ == '__main__':
                         dest="refresh_filter",
                         action="store_true",
                         help="Refresh the WASM filter. ")
+    parser.add_argument("-hs",
+                        "--hot-swap",
+                        dest="hot_swap",
+                        action="store_true",
+                        help="Replace the running filter without restarting"
+                        " the pods, falls back to a refresh if that fails.")
+    parser.add_argument("-rt",
+                        "--ready-timeout",
+                        dest="ready_timeout",
+                        type=int,
+                        default=readiness.DEFAULT_TIMEOUT,
+                        help="Seconds to wait at most for all pods to run"
+                        " a refreshed filter.")
     parser.add_argument("-b",
                         "--burst",
                         dest="burst",
                         action="store_true",
                         help="Burst with HTTP requests to cause"
                         " congestion and queue buildup.")
+    parser.add_argument("-tp",
+                        "--traffic-profile",
+                        dest="traffic_profile",
+                        help="Send traffic following the shape described"
+                        " in this JSON or YAML profile file.")
+    parser.add_argument("-to",
+                        "--traffic-output",
+                        dest="traffic_output",
+                        default="traffic.csv",
+                        help="Where to write the per-second rate and latency"
+                        " of a burst or traffic profile.")
+    parser.add_argument("-fc",
+                        "--fresh-connections",
+                        dest="fresh_connections",
+                        action="store_true",
+                        help="Open a new connection for every request"
+                        " instead of reusing keep-alive connections.")
     parser.add_argument("-da",
                         "--deploy-addons",
                         dest="deploy_addons",
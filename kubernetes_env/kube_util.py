@@ -4,12 +4,19 @@ import shutil
 import logging as log
 from pathlib import Path
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import threading
 import time
 
+import namespaces
+import tracing
+
 EXIT_SUCCESS = 0
 EXIT_FAILURE = 1
 
 TO_NANOSECONDS = 1e9  # everything is in nanoseconds
+# how many commands exec_parallel runs at the same time by default
+DEFAULT_PARALLELISM = 8
 
 
 def is_valid_file(parser, arg):
@@ -56,13 +63,56 @@ def move_file(src, dst):
         shutil.move(src, dst)
 
 
+def make_session(pool_size=10, fresh_connections=False):
+    # imported here so pure cluster commands do not need requests
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    # keep one reusable connection per worker
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if fresh_connections:
+        # the server closes the connection after every response, which forces
+        # a new TCP handshake per request
+        session.headers["Connection"] = "close"
+    # requests to the gateway have to name the instance they are meant for
+    session.headers.update(namespaces.gateway_headers())
+    return session
+
+
 def get_output_from_proc(cmd, *args, **kwargs):
     log.debug("Executing %s ", cmd)
-    return subprocess.check_output(cmd.split(), *args, **kwargs)
+    cmd_span = tracing.command_span(cmd)
+    try:
+        output = subprocess.check_output(cmd.split(), *args, **kwargs)
+    except subprocess.CalledProcessError as err:
+        tracing.end_command(cmd_span, err.returncode, err.output)
+        raise
+    except OSError:
+        tracing.end_command(cmd_span, EXIT_FAILURE)
+        raise
+    tracing.end_command(cmd_span, EXIT_SUCCESS, output)
+    return output
+
+
+def _trace_process(proc, cmd_span, out_file=None):
+    # long running processes end their span once they exit
+    def wait():
+        returncode = proc.wait()
+        size = 0
+        if out_file is not None:
+            size = sum(Path(path).stat().st_size
+                       for path in (out_file + ".out", out_file + ".err")
+                       if Path(path).exists())
+        tracing.end_span(cmd_span, exit_code=returncode, output_size=size,
+                         error=returncode != EXIT_SUCCESS)
+    threading.Thread(target=wait, daemon=True).start()
 
 
 def start_process(cmd, *args, out_file=subprocess.PIPE, **kwargs):
     log.debug("Executing %s ", cmd)
+    cmd_span = tracing.command_span(cmd)
     if out_file is subprocess.STDOUT:
         proc = subprocess.Popen(cmd.split(), *args, **kwargs)
     elif out_file is subprocess.PIPE:
@@ -80,12 +130,18 @@ def start_process(cmd, *args, out_file=subprocess.PIPE, **kwargs):
                                     stderr=f_err,
                                     *args,
                                     **kwargs)
+    if cmd_span is not None:
+        _trace_process(proc, cmd_span,
+                       out_file if isinstance(out_file, str) else None)
     return proc
 
 
 def exec_process(cmd, *args, allow_failures=False, **kwargs):
     log.debug("Executing %s ", cmd)
+    cmd_span = tracing.command_span(cmd)
     result = subprocess.run(cmd, shell=True, *args, **kwargs)
+    tracing.end_command(cmd_span, result.returncode, result.stdout,
+                        result.stderr)
     if result.stdout:
         log.debug("Process output: %s", result.stdout.decode("utf-8"))
     if result.returncode != EXIT_SUCCESS and not allow_failures:
@@ -97,6 +153,51 @@ def exec_process(cmd, *args, allow_failures=False, **kwargs):
     return result.returncode
 
 
+def exec_parallel(cmds, max_workers=DEFAULT_PARALLELISM,
+                  allow_failures=False):
+    """ Run independent commands concurrently. cmds maps a target name, for
+    example a deployment, to its command. Output is captured per target so
+    logs do not interleave. Returns EXIT_SUCCESS if all commands succeeded,
+    otherwise the return code of the first failed target.
+    """
+    if not cmds:
+        return EXIT_SUCCESS
+
+    # the worker threads do not see the span of the caller
+    parent = tracing.current()
+
+    def run(target):
+        log.debug("Executing %s ", cmds[target])
+        cmd_span = tracing.command_span(cmds[target], parent)
+        result = subprocess.run(cmds[target], shell=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        tracing.end_command(cmd_span, result.returncode, result.stdout,
+                            result.stderr)
+        return result
+
+    targets = list(cmds)
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = dict(zip(targets, pool.map(run, targets)))
+    # report per target once everything is done, in the order of cmds
+    failed = []
+    for target in targets:
+        result = results[target]
+        if result.stdout:
+            log.debug("Process output of %s: %s", target,
+                      result.stdout.decode("utf-8"))
+        if result.returncode == EXIT_SUCCESS:
+            continue
+        failed.append(target)
+        if not allow_failures:
+            log.error("BEGIN %s\nFailed while executing:\n%s\n\n"
+                      "Output:\n%s\nEND %s", 40 * "#", cmds[target],
+                      result.stderr.decode("utf-8"), 40 * "#")
+    if failed and not allow_failures:
+        log.error("Failed targets: %s", ", ".join(failed))
+    return results[failed[0]].returncode if failed else EXIT_SUCCESS
+
+
 def ns_to_timestamp(str_ns):
     ns = int(str_ns)
     dt = datetime.fromtimestamp(ns / 1e9)
@@ -0,0 +1,159 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import time
+from pathlib import Path
+
+import results_store
+
+log = logging.getLogger(__name__)
+
+NO_FILTER = "no_filter"
+DEFAULT_LOAD = {"qps": 10, "threads": 2}
+SPEC_KEYS = {"platform", "multizonal", "run_time", "repetitions",
+             "applications", "filters", "loads"}
+
+
+def load_spec(spec_file):
+    """ Read an experiment matrix from a YAML, TOML or JSON file. """
+    spec_file = Path(spec_file)
+    if spec_file.suffix == ".toml":
+        try:
+            import tomllib
+        except ModuleNotFoundError:
+            # tomllib is part of the standard library since python 3.11
+            import tomli as tomllib
+        with open(spec_file, "rb") as toml_file:
+            spec = tomllib.load(toml_file)
+    elif spec_file.suffix == ".json":
+        with open(spec_file) as json_file:
+            spec = json.load(json_file)
+    else:
+        # imported here so the runner does not need pyyaml for other specs
+        import yaml
+        with open(spec_file) as yaml_file:
+            spec = yaml.safe_load(yaml_file)
+    return validate_spec(spec, spec_file.parent)
+
+
+def validate_spec(spec, base_dir=None):
+    if not isinstance(spec, dict):
+        raise ValueError("The matrix spec must be a mapping.")
+    unknown = set(spec) - SPEC_KEYS
+    if unknown:
+        raise ValueError(f"Unknown keys in matrix spec: {sorted(unknown)}")
+    if not spec.get("applications"):
+        raise ValueError("The matrix spec lists no applications.")
+    spec = dict(spec)
+    spec.setdefault("platform", "MK")
+    spec.setdefault("multizonal", False)
+    spec.setdefault("repetitions", 1)
+    spec["loads"] = [dict(DEFAULT_LOAD, **load)
+                     for load in spec.get("loads") or [{}]]
+    # filter directories are relative to the spec
+    filters = []
+    for filter_dir in spec.get("filters") or [NO_FILTER]:
+        if filter_dir != NO_FILTER and base_dir is not None:
+            filter_dir = str(Path(base_dir).joinpath(filter_dir).resolve())
+        filters.append(filter_dir)
+    spec["filters"] = filters
+    # an application is either its name or a mapping selecting scenarios
+    spec["applications"] = [
+        app if isinstance(app, dict) else {"name": app}
+        for app in spec["applications"]]
+    return spec
+
+
+def filter_name(filter_dir):
+    return NO_FILTER if filter_dir == NO_FILTER else Path(filter_dir).name
+
+
+def job_id(job):
+    return "/".join([job["application"], job["scenario"]["output"],
+                     filter_name(job["filter"]),
+                     f"q{job['qps']}t{job['threads']}",
+                     f"r{job['repetition']}"])
+
+
+def expand(spec, scenarios):
+    """ All cells of the matrix: applications x scenarios x filters x loads x
+    repetitions. scenarios maps an application to its known scenarios.
+    """
+    jobs = []
+    for app in spec["applications"]:
+        known = scenarios.get(app["name"])
+        if not known:
+            raise ValueError(f"No scenarios for application {app['name']}")
+        selected = known
+        if app.get("scenarios"):
+            by_output = {scenario["output"]: scenario for scenario in known}
+            missing = set(app["scenarios"]) - set(by_output)
+            if missing:
+                raise ValueError(f"Unknown scenarios for {app['name']}: "
+                                 f"{sorted(missing)}")
+            selected = [by_output[output] for output in app["scenarios"]]
+        for scenario, filter_dir, load, repetition in itertools.product(
+                selected, spec["filters"], spec["loads"],
+                range(spec["repetitions"])):
+            job = {"application": app["name"], "scenario": scenario,
+                   "filter": filter_dir, "qps": load["qps"],
+                   "threads": load["threads"], "repetition": repetition}
+            job["id"] = job_id(job)
+            jobs.append(job)
+    return jobs
+
+
+def order_jobs(jobs):
+    """ Order the cells so every application needs one cluster and every
+    filter is deployed once per cluster. Runs without a filter go first,
+    while nothing is deployed yet.
+    """
+    apps = list(dict.fromkeys(job["application"] for job in jobs))
+    filters = list(dict.fromkeys(job["filter"] for job in jobs))
+    if NO_FILTER in filters:
+        filters.remove(NO_FILTER)
+        filters.insert(0, NO_FILTER)
+    # sorted is stable, the spec order is kept within each group
+    return sorted(jobs, key=lambda job: (apps.index(job["application"]),
+                                         filters.index(job["filter"])))
+
+
+def campaign_name(spec_file):
+    """ The name of the spec followed by a hash of its resolved contents, so
+    specs with the same name and edited specs do not share progress.
+    """
+    spec = json.dumps(load_spec(spec_file), sort_keys=True)
+    digest = hashlib.sha256(spec.encode("utf-8")).hexdigest()[:12]
+    return f"{Path(spec_file).stem}-{digest}"
+
+
+def checkpoint_file(spec_file, store_dir=None):
+    store_dir = store_dir or results_store.STORE_DIR
+    return Path(store_dir).joinpath(
+        f"{campaign_name(spec_file)}.checkpoint.json")
+
+
+def load_checkpoint(path):
+    """ Ids of the cells completed so far. """
+    if not Path(path).exists():
+        return {}
+    with open(path) as checkpoint:
+        return json.load(checkpoint).get("completed", {})
+
+
+def save_checkpoint(path, completed):
+    # replace the file at once, an interrupted write must not lose progress
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as checkpoint:
+        json.dump({"updated": time.time(), "completed": completed},
+                  checkpoint, indent=1)
+    tmp_path.replace(path)
+
+
+def mark_completed(path, completed, job, result):
+    completed[job["id"]] = {"time": time.time(), "result": result}
+    save_checkpoint(path, completed)
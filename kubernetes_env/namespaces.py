@@ -0,0 +1,74 @@
+import copy
+import os
+
+# every process works on one instance of the application, which runs in its
+# own namespace next to a namespace for its storage. Several instances can so
+# share a cluster. The default instance uses default and storage.
+NAMESPACE_ENV = "KUBE_ENV_NAMESPACE"
+DEFAULT_NAMESPACE = "default"
+DEFAULT_STORAGE = "storage"
+# other instances are told apart by host name at the ingress gateway
+GATEWAY_DOMAIN = "kube-env.local"
+STORAGE_SELECTOR = "app=storage-upstream"
+
+
+def app():
+    return os.environ.get(NAMESPACE_ENV) or DEFAULT_NAMESPACE
+
+
+def storage():
+    namespace = app()
+    if namespace == DEFAULT_NAMESPACE:
+        return DEFAULT_STORAGE
+    return f"{namespace}-storage"
+
+
+def is_default():
+    return app() == DEFAULT_NAMESPACE
+
+
+def set_namespace(namespace):
+    # through the environment, so workers and subprocesses inherit it
+    os.environ[NAMESPACE_ENV] = namespace or DEFAULT_NAMESPACE
+
+
+def gateway_host():
+    """ Host header that routes to this instance, None for the default
+    instance which gets all other requests.
+    """
+    if is_default():
+        return None
+    return f"{app()}.{GATEWAY_DOMAIN}"
+
+
+def gateway_headers():
+    host = gateway_host()
+    return {"Host": host} if host else {}
+
+
+def fortio_flags():
+    host = gateway_host()
+    return f"-H Host:{host} " if host else ""
+
+
+def targets():
+    """ Namespace and label selector of the pods that run a filter. """
+    return [(app(), None), (storage(), STORAGE_SELECTOR)]
+
+
+def rewrite(manifests):
+    """ Move manifests written for default and storage to the namespaces of
+    this instance. Manifests without a namespace go to the application.
+    """
+    mapping = {DEFAULT_NAMESPACE: app(), DEFAULT_STORAGE: storage()}
+    manifests = copy.deepcopy(manifests)
+    for manifest in manifests:
+        metadata = manifest.setdefault("metadata", {})
+        namespace = metadata.get("namespace", DEFAULT_NAMESPACE)
+        metadata["namespace"] = mapping.get(namespace, namespace)
+        spec = manifest.get("spec") or {}
+        # the storage service of the application points to its storage
+        if spec.get("externalName"):
+            spec["externalName"] = spec["externalName"].replace(
+                f".{DEFAULT_STORAGE}.svc", f".{storage()}.svc")
+    return manifests
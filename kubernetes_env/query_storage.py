@@ -3,35 +3,80 @@ import signal
 import os
 import argparse
 import logging
-import requests
+import socket
+import sys
 import kube_env
+import kube_client
 import kube_util as util
-import time
+import namespaces
+import readiness
 
 log = logging.getLogger(__name__)
 
+# local port of the port-forward to storage
+STORAGE_PORT = 8090
+# ports of the other instances, picked when they first query their storage
+PORTS = {}
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("localhost", 0))
+        return sock.getsockname()[1]
+
+
+def storage_port():
+    # instances sharing a cluster may query their storage at the same time,
+    # each of them gets a port nobody else uses
+    if namespaces.is_default():
+        return STORAGE_PORT
+    namespace = namespaces.app()
+    if namespace not in PORTS:
+        PORTS[namespace] = free_port()
+    return PORTS[namespace]
+
+
+def get_storage_pod():
+    def api_call(client):
+        pods = client.list("pods", namespaces.storage(),
+                           label_selector="app=storage-upstream")
+        return pods[0]["metadata"]["name"]
+
+    def fallback():
+        cmd = "kubectl get pods -lapp=storage-upstream "
+        cmd += " -o jsonpath={.items[0].metadata.name} "
+        cmd += f"-n={namespaces.storage()}"
+        return util.get_output_from_proc(cmd).decode("utf-8")
+
+    return kube_client.with_fallback(api_call, fallback)
+
+
 def launch_storage_mon():                                                       
     if kube_env.check_kubernetes_status() != util.EXIT_SUCCESS:                 
         log.error("Kubernetes is not set up."                                   
                   " Did you run the deployment script?")                        
         sys.exit(util.EXIT_FAILURE)                                             
-    cmd = "kubectl get pods -lapp=storage-upstream "                            
-    cmd += " -o jsonpath={.items[0].metadata.name} -n=storage"                  
-    storage_pod_name = util.get_output_from_proc(cmd).decode("utf-8")           
-    cmd = f"kubectl -n=storage port-forward {storage_pod_name} 8090:8080"       
+    storage_pod_name = get_storage_pod()
+    cmd = f"kubectl -n={namespaces.storage()} port-forward {storage_pod_name} "
+    cmd += f"{storage_port()}:8080"
     storage_proc = util.start_process(cmd, preexec_fn=os.setsid)                
-    # Let settle things in a bit                                                
-    time.sleep(2)                                                               
+    # the port-forward is usable once it accepts connections
+    readiness.wait_for_port("localhost", storage_port())
     return storage_proc
 
 def init_storage_mon():
-    util.kill_tcp_proc(8090)
+    if namespaces.is_default():
+        # a port-forward left over by an earlier run
+        util.kill_tcp_proc(storage_port())
+    else:
+        PORTS[namespaces.app()] = free_port()
     storage_proc = launch_storage_mon()
     return storage_proc
 
 
 def query_storage(cmd="list"):
-    storage_content = requests.get(f"http://localhost:8090/{cmd}")
+    import requests
+    storage_content = requests.get(f"http://localhost:{storage_port()}/{cmd}")
     return storage_content
 
 
@@ -40,6 +85,8 @@ def kill_storage_mon(storage_proc):
 
 
 def main(args):
+    if args.namespace:
+        namespaces.set_namespace(args.namespace)
     storage_proc = init_storage_mon()
     ret = query_storage(args.cmd)
     if args.cmd == "list":
@@ -69,6 +116,11 @@ if __name__ == '__main__':
                         choices=["MK", "GCP"],
                         help="Which platform to run the scripts on."
                         "MK is minikube, GCP is Google Cloud Compute")
+    parser.add_argument("-ns",
+                        "--namespace",
+                        dest="namespace",
+                        help="Namespace of the application instance whose"
+                        " storage to query.")
     parser.add_argument("-c",
                         "--cmd",
                         dest="cmd",
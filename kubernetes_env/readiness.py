@@ -0,0 +1,211 @@
+import json
+import logging
+import math
+import socket
+import subprocess
+import time
+
+import kube_client
+import kube_util as util
+import namespaces
+import timing
+
+log = logging.getLogger(__name__)
+
+# pod template annotation carrying the revision of the deployed filter
+REVISION_ANNOTATION = "kube-env/filter-revision"
+# upper bound in seconds for the cluster to become ready
+DEFAULT_TIMEOUT = 300
+PORT_TIMEOUT = 30
+PORT_POLL_INTERVAL = 0.05
+
+
+def pod_ready(pod, revision=None):
+    if pod["metadata"].get("deletionTimestamp"):
+        # a terminating pod may still serve with the old filter
+        return False
+    if revision is not None:
+        annotations = pod["metadata"].get("annotations") or {}
+        if annotations.get(REVISION_ANNOTATION) != revision:
+            return False
+    conditions = pod.get("status", {}).get("conditions") or []
+    return any(cond["type"] == "Ready" and cond["status"] == "True"
+               for cond in conditions)
+
+
+def pods_ready(pods, revision=None):
+    # finished pods of jobs never become ready again
+    pods = [pod for pod in pods
+            if pod.get("status", {}).get("phase") not in ("Succeeded",
+                                                          "Failed")]
+    return bool(pods) and all(pod_ready(pod, revision) for pod in pods)
+
+
+def endpoints_ready(endpoints):
+    return all(not subset.get("notReadyAddresses")
+               for endpoint in endpoints
+               for subset in endpoint.get("subsets") or [])
+
+
+def watch_until(client, kind, namespace, predicate, deadline,
+                label_selector=None):
+    """ List the objects and follow their changes until predicate holds
+    for the current set of objects. Returns False once the deadline passes.
+    """
+    while True:
+        items, version = client.list_versioned(kind, namespace,
+                                               label_selector)
+        objects = {obj["metadata"]["name"]: obj for obj in items}
+        if predicate(list(objects.values())):
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        for event, obj in client.watch(kind, namespace, version,
+                                       label_selector,
+                                       timeout=math.ceil(remaining)):
+            if event == "ERROR":
+                # most likely an expired resource version, list again
+                break
+            name = obj["metadata"]["name"]
+            if event == "DELETED":
+                objects.pop(name, None)
+            else:
+                objects[name] = obj
+            if predicate(list(objects.values())):
+                return True
+            if time.time() >= deadline:
+                return False
+
+
+def wait_for_port(host, port, timeout=PORT_TIMEOUT):
+    """ Wait until something accepts connections on host:port, for example
+    a kubectl port-forward.
+    """
+    with timing.phase(f"port:{port}") as port_phase:
+        port_phase["ready"] = False
+        start = time.time()
+        while time.time() - start < timeout:
+            try:
+                with socket.create_connection((host, port), timeout=1):
+                    port_phase["ready"] = True
+                    break
+            except OSError:
+                time.sleep(PORT_POLL_INTERVAL)
+    return port_phase["ready"]
+
+
+def _replica_set(pod):
+    for owner in pod["metadata"].get("ownerReferences") or []:
+        if owner["kind"] == "ReplicaSet":
+            return owner["name"]
+    return None
+
+
+def pod_deployment(pod):
+    # pods of a deployment are owned by a replica set named <deployment>-<hash>
+    replica_set = _replica_set(pod)
+    if replica_set is not None:
+        return replica_set.rsplit("-", 1)[0]
+    return pod["metadata"]["name"]
+
+
+def _wait_api(client, revision, deadline, targets):
+    start = time.time()
+    ready_at = {}
+
+    def predicate(pods):
+        # remember when each deployment was ready for the first time
+        deployments = {}
+        for pod in pods:
+            deployments.setdefault(pod_deployment(pod), []).append(pod)
+        for depl, depl_pods in deployments.items():
+            if depl not in ready_at and pods_ready(depl_pods, revision):
+                ready_at[depl] = time.time()
+        return pods_ready(pods, revision)
+
+    for namespace, selector in targets:
+        if not watch_until(client, "pods", namespace, predicate, deadline,
+                           selector):
+            log.warning("Pods in namespace %s are not ready.", namespace)
+            return False
+    for depl, ready in sorted(ready_at.items(), key=lambda item: item[1]):
+        timing.record(f"ready:{depl}", ready - start)
+    for namespace in sorted({namespace for namespace, _ in targets}):
+        if not watch_until(client, "endpoints", namespace, endpoints_ready,
+                           deadline):
+            log.warning("Endpoints in namespace %s are not ready.", namespace)
+            return False
+    return True
+
+
+def _kubectl_waits(namespace, selector):
+    """ The kubectl resources to wait for in namespace, deployments for
+    pods that belong to one.
+    """
+    cmd = f"kubectl get pods -n {namespace} -o json"
+    if selector:
+        cmd += f" -l {selector}"
+    pods = json.loads(util.get_output_from_proc(cmd))["items"]
+    waits = {}
+    for pod in pods:
+        if pod.get("status", {}).get("phase") in ("Succeeded", "Failed"):
+            continue
+        if _replica_set(pod) is not None:
+            waits[f"deployment/{pod_deployment(pod)}"] = "rollout"
+        else:
+            waits[f"pod/{pod['metadata']['name']}"] = "pod"
+    return waits
+
+
+def _wait_kubectl(deadline, targets):
+    # kubectl wait on the pods would accept the old pods, which are still
+    # Ready right after a restart. A rollout only completes once every pod
+    # runs the new template, and with it the new filter revision.
+    for namespace, selector in targets:
+        try:
+            waits = _kubectl_waits(namespace, selector)
+        except (subprocess.CalledProcessError, OSError, ValueError) as err:
+            log.warning("Cannot list pods in namespace %s: %s", namespace,
+                        err)
+            return False
+        if not waits:
+            log.warning("No pods in namespace %s.", namespace)
+            return False
+        for resource, kind in waits.items():
+            remaining = max(math.ceil(deadline - time.time()), 1)
+            if kind == "rollout":
+                cmd = f"kubectl rollout status -n {namespace} {resource} "
+            else:
+                cmd = "kubectl wait --for=condition=Ready "
+                cmd += f"-n {namespace} {resource} "
+            cmd += f"--timeout={remaining}s"
+            result = util.exec_process(cmd, allow_failures=True)
+            if result != util.EXIT_SUCCESS:
+                log.warning("%s in namespace %s is not ready.", resource,
+                            namespace)
+                return False
+    return True
+
+
+def wait_for_application(revision=None, timeout=DEFAULT_TIMEOUT,
+                         targets=None):
+    """ Block until all pods of the application and storage are Ready and,
+    if a revision is given, run that filter revision. Waits at most timeout
+    seconds and records how long it actually took.
+    """
+    targets = targets or namespaces.targets()
+    start = time.time()
+    deadline = start + timeout
+    with timing.phase("ready") as ready_phase:
+        ready = kube_client.with_fallback(
+            lambda client: _wait_api(client, revision, deadline, targets),
+            lambda: _wait_kubectl(deadline, targets))
+        ready_phase["ready"] = ready
+    waited = time.time() - start
+    if not ready:
+        log.error("Application was not ready after %d seconds.", timeout)
+        return util.EXIT_FAILURE
+    log.info("Application ready after %.1f seconds.", waited)
+    return util.EXIT_SUCCESS
+
@@ -0,0 +1,116 @@
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+from histogram import (OutcomeHistograms, SUCCESS, TIMEOUT, CONNECTION_ERROR)
+
+# send time (epoch seconds), latency (ms), outcome code
+RECORD = struct.Struct("<dfB")
+OUTCOMES = [SUCCESS, TIMEOUT, CONNECTION_ERROR, "http_1xx", "http_3xx",
+            "http_4xx", "http_5xx", "http_other"]
+OUTCOME_CODES = {outcome: code for code, outcome in enumerate(OUTCOMES)}
+# write to disk after this many records or seconds, whatever comes first
+FLUSH_RECORDS = 4096
+FLUSH_INTERVAL = 1.0
+# records processed at once when reading a file back
+READ_CHUNK = 1 << 20
+
+
+class ResultSink:
+    """ Appends fixed-size binary records to a file as requests complete.
+    Buffers are flushed and synced at least every FLUSH_INTERVAL seconds.
+    A crash loses at most that window, and a torn last record is ignored
+    by the reader.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sink_file = open(path, "ab")
+        self.buffer = bytearray()
+        self.buffered = 0
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, sent_at, latency_ms, outcome):
+        code = OUTCOME_CODES.get(outcome, OUTCOME_CODES["http_other"])
+        with self.lock:
+            self.buffer += RECORD.pack(sent_at, latency_ms, code)
+            self.buffered += 1
+            if (self.buffered >= FLUSH_RECORDS
+                    or time.time() - self.last_flush >= FLUSH_INTERVAL):
+                self._flush()
+
+    def _flush(self):
+        self.sink_file.write(self.buffer)
+        self.sink_file.flush()
+        os.fsync(self.sink_file.fileno())
+        self.buffer = bytearray()
+        self.buffered = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.sink_file.close()
+
+
+def shard_paths(path):
+    """ The files of a run, either the file itself or the per-worker shards
+    written by a sharded run.
+    """
+    path = Path(path)
+    shards = sorted(path.parent.glob(path.name.replace(".records.bin",
+                                                       ".w*.records.bin")))
+    return shards or [path]
+
+
+def read_records(path):
+    """ Memory-map the complete records of a file as a structured array.
+    Nothing is read from disk until the array is accessed.
+    """
+    import numpy as np
+    dtype = np.dtype([("sent_at", "<f8"), ("latency_ms", "<f4"),
+                      ("outcome", "u1")])
+    count = os.path.getsize(path) // dtype.itemsize
+    if not count:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(count, ))
+
+
+def histograms_from_records(path):
+    import numpy as np
+    result = OutcomeHistograms()
+    first_sent = None
+    last_done = None
+    for shard in shard_paths(path):
+        records = read_records(shard)
+        for start in range(0, len(records), READ_CHUNK):
+            chunk = records[start:start + READ_CHUNK]
+            if not len(chunk):
+                continue
+            codes = chunk["outcome"]
+            for code in np.unique(codes):
+                result.record_array(OUTCOMES[code],
+                                    chunk["latency_ms"][codes == code])
+            sent = chunk["sent_at"]
+            done = sent + chunk["latency_ms"] / 1000
+            first = float(sent.min())
+            last = float(done.max())
+            first_sent = first if first_sent is None else min(first_sent,
+                                                              first)
+            last_done = last if last_done is None else max(last_done, last)
+    if first_sent is not None:
+        result.duration = last_done - first_sent
+    return result
+
+
+def records_to_columns(path):
+    """ All records of a run, including worker shards, as separate columns.
+    Every column is a tuple with the memory-mapped values of each shard,
+    results_store.save_run writes them out one shard at a time.
+    """
+    shards = [read_records(shard) for shard in shard_paths(path)]
+    return {name: tuple(records[name] for records in shards)
+            for name in shards[0].dtype.names}
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import kube_util as util
+
+log = logging.getLogger(__name__)
+
+FILE_DIR = Path(__file__).parent.resolve()
+# workers running next to each other each get their own results directory
+RESULTS_DIR_ENV = "KUBE_ENV_RESULTS_DIR"
+STORE_DIR = Path(os.environ.get(RESULTS_DIR_ENV)
+                 or FILE_DIR.joinpath("benchmark/results"))
+INDEX_NAME = "index.db"
+MANIFEST_NAME = "manifest.json"
+# manifest fields that are indexed and can be queried
+INDEX_FIELDS = ["run_id", "started", "finished", "application", "platform",
+                "filter", "filter_hash", "git_revision", "load_generator",
+                "params", "path"]
+# files that make up the source of a filter
+FILTER_SOURCES = ["*.rs", "Cargo.toml", "Cargo.lock"]
+# sections of a Cargo.toml that may point to local crates
+CARGO_DEPENDENCIES = ["dependencies", "dev-dependencies", "build-dependencies"]
+
+
+def git_revision():
+    cmd = f"git -C {FILE_DIR} rev-parse HEAD"
+    try:
+        return util.get_output_from_proc(
+            cmd, stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def _path_dependencies(manifest):
+    """ Directories of the local crates a Cargo.toml depends on. """
+    try:
+        import tomllib
+    except ModuleNotFoundError:
+        # tomllib is part of the standard library since python 3.11
+        import tomli as tomllib
+    with open(manifest, "rb") as mfile:
+        cargo = tomllib.load(mfile)
+    tables = [cargo] + list(cargo.get("target", {}).values())
+    crates = []
+    for table in tables:
+        for section in CARGO_DEPENDENCIES:
+            for dep in table.get(section, {}).values():
+                if isinstance(dep, dict) and "path" in dep:
+                    crates.append(
+                        manifest.parent.joinpath(dep["path"]).resolve())
+    return crates
+
+
+def _source_files(crate_dir):
+    files = set()
+    for pattern in FILTER_SOURCES:
+        files.update(crate_dir.rglob(pattern))
+    # build output is not part of the source
+    return [src for src in files
+            if "target" not in src.relative_to(crate_dir).parts]
+
+
+def filter_hash(filter_dir):
+    """ Hash of the sources of a filter and of all local crates it depends
+    on, wherever they are. None if a dependency cannot be resolved.
+    """
+    if filter_dir is None or not Path(filter_dir).is_dir():
+        return None
+    filter_dir = Path(filter_dir).resolve()
+    files = set()
+    crates = [filter_dir]
+    seen = set()
+    while crates:
+        crate_dir = crates.pop()
+        if crate_dir in seen:
+            continue
+        seen.add(crate_dir)
+        if not crate_dir.is_dir():
+            log.warning("Cannot find crate %s, not hashing %s.", crate_dir,
+                        filter_dir)
+            return None
+        for src in _source_files(crate_dir):
+            files.add(src)
+            if src.name != "Cargo.toml":
+                continue
+            try:
+                crates.extend(_path_dependencies(src))
+            except (OSError, ValueError) as err:
+                log.warning("Cannot read %s: %s", src, err)
+                return None
+    sha = hashlib.sha256()
+    for src in sorted(files):
+        sha.update(os.path.relpath(src, filter_dir).encode("utf-8"))
+        sha.update(src.read_bytes())
+    return sha.hexdigest()
+
+
+def open_index(store_dir=STORE_DIR):
+    util.check_dir(Path(store_dir))
+    conn = sqlite3.connect(str(Path(store_dir).joinpath(INDEX_NAME)))
+    conn.row_factory = sqlite3.Row
+    conn.execute("CREATE TABLE IF NOT EXISTS runs ("
+                 "run_id TEXT PRIMARY KEY, started REAL, finished REAL, "
+                 "application TEXT, platform TEXT, filter TEXT, "
+                 "filter_hash TEXT, git_revision TEXT, load_generator TEXT, "
+                 "params TEXT, path TEXT)")
+    return conn
+
+
+def _index_run(conn, manifest):
+    row = dict(manifest, params=json.dumps(manifest["params"],
+                                           sort_keys=True))
+    placeholders = ", ".join("?" for _ in INDEX_FIELDS)
+    conn.execute(f"INSERT OR REPLACE INTO runs ({', '.join(INDEX_FIELDS)}) "
+                 f"VALUES ({placeholders})",
+                 [row.get(field) for field in INDEX_FIELDS])
+
+
+def save_column(path, values):
+    """ Save a column as .npy file. A tuple of arrays is stored as their
+    concatenation, written one array at a time.
+    """
+    import numpy as np
+    if not isinstance(values, tuple):
+        np.save(path, np.asarray(values))
+        return
+    length = sum(len(chunk) for chunk in values)
+    if not length:
+        np.save(path, np.zeros(0, dtype=values[0].dtype if values else None))
+        return
+    column = np.lib.format.open_memmap(path, mode="w+", dtype=values[0].dtype,
+                                       shape=(length, ))
+    offset = 0
+    for chunk in values:
+        column[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    column.flush()
+    del column
+
+
+def save_run(columns, application, platform, filter_name, load_generator,
+             params, started, filter_dir=None, extra=None,
+             store_dir=STORE_DIR):
+    """ Store the columns of one run, a dict of name to 1-d array (or tuple
+    of arrays, see save_column), as one .npy file per column plus a
+    manifest, and add the run to the index.
+    """
+    run_id = time.strftime("%Y%m%d-%H%M%S", time.localtime(started))
+    run_id += f"-{uuid.uuid4().hex[:8]}"
+    run_dir = Path(store_dir).joinpath(run_id)
+    util.check_dir(run_dir)
+    files = {}
+    for name, values in columns.items():
+        fname = re.sub(r"\W+", "_", name).strip("_") + ".npy"
+        save_column(run_dir.joinpath(fname), values)
+        files[name] = fname
+    manifest = {
+        "run_id": run_id,
+        "started": started,
+        "finished": time.time(),
+        "application": application,
+        "platform": platform,
+        "filter": filter_name,
+        "filter_hash": filter_hash(filter_dir),
+        "git_revision": git_revision(),
+        "load_generator": load_generator,
+        "params": params,
+        "path": str(run_dir),
+        "columns": files,
+    }
+    manifest.update(extra or {})
+    # the manifest goes last, a run without one is incomplete
+    with open(run_dir.joinpath(MANIFEST_NAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    with open_index(store_dir) as conn:
+        _index_run(conn, manifest)
+    conn.close()
+    log.info("Stored run %s in %s", run_id, run_dir)
+    return run_id
+
+
+def query_runs(store_dir=STORE_DIR, **where):
+    """ Return the index rows matching all given field values. """
+    for field in where:
+        if field not in INDEX_FIELDS:
+            raise ValueError(f"Cannot query runs by {field}")
+    sql = "SELECT * FROM runs"
+    if where:
+        sql += " WHERE " + " AND ".join(f"{field} = ?" for field in where)
+    sql += " ORDER BY started"
+    conn = open_index(store_dir)
+    rows = [dict(row) for row in conn.execute(sql, list(where.values()))]
+    conn.close()
+    for row in rows:
+        row["params"] = json.loads(row["params"])
+    return rows
+
+
+def load_manifest(run_id, store_dir=STORE_DIR):
+    with open(Path(store_dir).joinpath(run_id, MANIFEST_NAME)) as mfile:
+        return json.load(mfile)
+
+
+def load_columns(run_id, columns=None, store_dir=STORE_DIR):
+    """ Memory-map the requested columns of a run, all if none are given. """
+    import numpy as np
+    manifest = load_manifest(run_id, store_dir)
+    files = manifest["columns"]
+    if columns is None:
+        columns = list(files)
+    run_dir = Path(store_dir).joinpath(run_id)
+    return {name: np.load(run_dir.joinpath(files[name]), mmap_mode="r")
+            for name in columns}
+
+
+def compare(run_ids, column="latency_ms",
+            percentiles=(50, 90, 99, 99.9), store_dir=STORE_DIR):
+    """ Percentiles of a column of every run. Raises ValueError if a run
+    has no such column, locust and fortio runs for example only store the
+    percentiles they report.
+    """
+    import numpy as np
+    rows = []
+    for run_id in run_ids:
+        manifest = load_manifest(run_id, store_dir)
+        if column not in manifest["columns"]:
+            raise ValueError(
+                f"Run {run_id} ({manifest['load_generator']}) has no column"
+                f" {column}, it has {', '.join(manifest['columns'])}")
+        values = load_columns(run_id, [column], store_dir)[column]
+        row = {"run_id": run_id, "filter": manifest["filter"],
+               "samples": len(values)}
+        if len(values):
+            for pct, value in zip(percentiles,
+                                  np.percentile(values, percentiles)):
+                row[f"p{pct}"] = round(float(value), 3)
+        rows.append(row)
+    return rows
+
+
+def rebuild_index(store_dir=STORE_DIR):
+    """ Recreate the index from the manifests on disk. """
+    conn = open_index(store_dir)
+    with conn:
+        conn.execute("DELETE FROM runs")
+        for manifest_file in sorted(Path(store_dir).glob(f"*/{MANIFEST_NAME}")):
+            with open(manifest_file) as mfile:
+                _index_run(conn, json.load(mfile))
+    conn.close()
+
+
+def import_runs(src_dir, store_dir=STORE_DIR, extra=None):
+    """ Move the runs stored in src_dir, for example by a worker, into
+    store_dir and add them to its index. extra is added to their manifests.
+    Returns the ids of the imported runs.
+    """
+    imported = []
+    conn = open_index(store_dir)
+    with conn:
+        for manifest_file in sorted(Path(src_dir).glob(f"*/{MANIFEST_NAME}")):
+            with open(manifest_file) as mfile:
+                manifest = json.load(mfile)
+            run_dir = Path(store_dir).joinpath(manifest["run_id"])
+            shutil.move(str(manifest_file.parent), str(run_dir))
+            manifest.update(extra or {})
+            manifest["path"] = str(run_dir)
+            with open(run_dir.joinpath(MANIFEST_NAME), "w") as mfile:
+                json.dump(manifest, mfile, indent=2)
+            _index_run(conn, manifest)
+            imported.append(manifest["run_id"])
+    conn.close()
+    return imported
+
+
+def main(args):
+    if args.rebuild:
+        rebuild_index(args.store_dir)
+    if args.compare:
+        try:
+            rows = compare(args.compare, args.column,
+                           store_dir=args.store_dir)
+        except ValueError as err:
+            log.error("Cannot compare the runs: %s", err)
+            return util.EXIT_FAILURE
+        for row in rows:
+            log.info("%s", row)
+        return util.EXIT_SUCCESS
+    where = {}
+    for field in ("application", "platform", "filter", "git_revision",
+                  "load_generator"):
+        if getattr(args, field):
+            where[field] = getattr(args, field)
+    for row in query_runs(args.store_dir, **where):
+        log.info("%s %s %s %s %s %s", row["run_id"], row["application"],
+                 row["platform"], row["filter"], row["load_generator"],
+                 row["params"])
+    return util.EXIT_SUCCESS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l",
+                        "--log-file",
+                        dest="log_file",
+                        default="results.log",
+                        help="Specifies name of the log file.")
+    parser.add_argument(
+        "-ll",
+        "--log-level",
+        dest="log_level",
+        default="INFO",
+        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"],
+        help="The log level to choose.")
+    parser.add_argument("-sd",
+                        "--store-dir",
+                        dest="store_dir",
+                        default=STORE_DIR,
+                        help="Directory of the results store.")
+    parser.add_argument("-a",
+                        "--application",
+                        dest="application",
+                        help="Only list runs of this application.")
+    parser.add_argument("-p",
+                        "--platform",
+                        dest="platform",
+                        help="Only list runs on this platform.")
+    parser.add_argument("-f",
+                        "--filter",
+                        dest="filter",
+                        help="Only list runs of this filter.")
+    parser.add_argument("-g",
+                        "--git-revision",
+                        dest="git_revision",
+                        help="Only list runs of this git revision.")
+    parser.add_argument("-cu",
+                        "--load-generator",
+                        dest="load_generator",
+                        help="Only list runs of this load generator.")
+    parser.add_argument("-c",
+                        "--compare",
+                        dest="compare",
+                        nargs="+",
+                        help="Compare the latency percentiles of these runs.")
+    parser.add_argument("-col",
+                        "--column",
+                        dest="column",
+                        default="latency_ms",
+                        help="The column to compare.")
+    parser.add_argument("-r",
+                        "--rebuild-index",
+                        dest="rebuild",
+                        action="store_true",
+                        help="Rebuild the index from the run manifests.")
+    # Parse options and process argv
+    arguments = parser.parse_args()
+    # configure logging
+    logging.basicConfig(filename=arguments.log_file,
+                        format="%(levelname)s:%(message)s",
+                        level=getattr(logging, arguments.log_level),
+                        filemode="w")
+    stderr_log = logging.StreamHandler()
+    stderr_log.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logging.getLogger().addHandler(stderr_log)
+    sys.exit(main(arguments))
@@ -1,17 +1,20 @@
 #!/usr/bin/env python3
 import argparse
+import itertools
+import json
 import logging
 import sys
 import os
 import time
-from multiprocessing import Process
-from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from kube_env import setup_application_deployment, stop_kubernetes
 from benchmark.benchmark import start_benchmark
-import requests
 
+import context_pool
+import kube_env
 import kube_util as util
+import matrix
+import tracing
 
 log = logging.getLogger(__name__)
 
@@ -31,85 +34,122 @@ QPS = 10
 THREADS = 2
 RUNTIME = 50
 
-def application_experiment(platform, multizonal, application, empty_filter, arg_no_filter, filter_dirs):
+def application_experiment(platform, multizonal, application, empty_filter, arg_no_filter, filter_dirs, reuse_cluster=True):
     if application == "BK":
-        bookinfo_experiment(platform, multizonal, empty_filter, arg_no_filter, filter_dirs)
+        return bookinfo_experiment(platform, multizonal, empty_filter,
+                                   arg_no_filter, filter_dirs, reuse_cluster)
     if application == "OB":
-        online_boutique_experiment(platform, multizonal, empty_filter, arg_no_filter, filter_dirs)
+        return online_boutique_experiment(platform, multizonal, empty_filter,
+                                          arg_no_filter, filter_dirs,
+                                          reuse_cluster)
     if application == "TT":
         if platform == "MK":
             log.error("Train ticket is not supported on minikube")
         elif platform == "GCP": 
             train_ticket_experiment(multizonal, empty_filter, arg_no_filter, filter_dirs)
 
-def bookinfo_experiment(platform, multizonal, empty_filter, arg_no_filter, filter_dirs):
-    filters = filter_dirs
-    if arg_no_filter:
-        filters = []
-    no_filter = 'ON'
-    if empty_filter:
-        filters.append(EMPTY_FILTER_DIR)
-    setup_application_deployment(platform, multizonal, "BK")
-    output = platform + "bookinfo"
-    start_benchmark(filters, platform, THREADS, QPS, RUNTIME, application = "BK",
-        output_file=output, no_filter= no_filter, subpath='productpage',
-        request='GET', custom='loadgen',
-        command_args=[], plot_name="BookInfo")
-    stop_kubernetes(platform)
-
-def online_boutique_experiment(platform, multizonal, empty_filter, arg_no_filter, filter_dirs):
-    filters = filter_dirs
-    if arg_no_filter:
-        filters = []
-    no_filter = 'ON'
+# the endpoints benchmarked per application, all scenarios of an application
+# share one cluster. run_experiment.py skips those that are not default, a
+# matrix spec can still select them
+SCENARIOS = {
+    "BK": [
+        {"output": "bookinfo", "subpath": "productpage", "request": "GET",
+         "plot_name": "BookInfo"},
+    ],
+    "OB": [
+        {"output": "online_boutique_index", "subpath": "",
+         "request": "GET", "plot_name": "Index - Online Boutique",
+         "default": False},
+        {"output": "online_boutique_set_currency", "subpath": "setCurrency",
+         "request": "CURRENCY", "plot_name": "Set Currency - Online Boutique",
+         "default": False},
+        {"output": "online_boutique_browse_product",
+         "subpath": "product/6E92ZMYYFZ", "request": "GET",
+         "plot_name": "Browse Product - Online Boutique", "default": False},
+        {"output": "online_boutique_view_cart", "subpath": "cart",
+         "request": "GET", "plot_name": "View Cart - Online Boutique"},
+        {"output": "online_boutique_add_to_cart", "subpath": "cart",
+         "request": "ADD_TO_CART", "plot_name": "Add to Cart - Online Boutique"},
+    ],
+    "TT": [
+        {"output": "train_ticket_home", "subpath": "index.html",
+         "request": "GET", "plot_name": "Home - Train Ticket"},
+    ],
+}
+
+
+def run_scenarios(platform, multizonal, application, filters, no_filter,
+                  scenarios, reuse_cluster=True):
+    """ Benchmark every scenario of an application. The cluster is set up
+    once and reset between scenarios, unless reuse_cluster is False.
+    """
+    failed = []
+    cluster_up = False
+    try:
+        for idx, scenario in enumerate(scenarios):
+            if cluster_up and reuse_cluster:
+                log.info("Resetting %s for %s", application,
+                         scenario["output"])
+                result = kube_env.reset_application()
+                if result != util.EXIT_SUCCESS:
+                    log.error("Could not reset the cluster, stopping.")
+                    return result
+            else:
+                if cluster_up:
+                    stop_kubernetes(platform)
+                    cluster_up = False
+                result = setup_application_deployment(platform, multizonal,
+                                                      application)
+                cluster_up = True
+                if result != util.EXIT_SUCCESS:
+                    return result
+            # start_benchmark modifies the list of filters
+            result = start_benchmark(list(filters), platform, THREADS, QPS,
+                                     RUNTIME, application=application,
+                                     output_file=platform + scenario["output"],
+                                     no_filter=no_filter,
+                                     subpath=scenario["subpath"],
+                                     request=scenario["request"],
+                                     custom="loadgen", command_args=[],
+                                     plot_name=scenario["plot_name"])
+            if result != util.EXIT_SUCCESS:
+                log.error("Scenario %s failed.", scenario["output"])
+                failed.append(scenario["output"])
+    finally:
+        if cluster_up:
+            stop_kubernetes(platform)
+    if failed:
+        log.error("%d of %d scenarios failed: %s", len(failed),
+                  len(scenarios), ", ".join(failed))
+        return util.EXIT_FAILURE
+    return util.EXIT_SUCCESS
+
+
+def default_scenarios(application):
+    return [scenario for scenario in SCENARIOS[application]
+            if scenario.get("default", True)]
+
+
+def scenario_filters(empty_filter, arg_no_filter, filter_dirs):
+    filters = [] if arg_no_filter else list(filter_dirs)
     if empty_filter:
         filters.append(EMPTY_FILTER_DIR)
+    return filters
+
+
+def bookinfo_experiment(platform, multizonal, empty_filter, arg_no_filter,
+                        filter_dirs, reuse_cluster=True):
+    filters = scenario_filters(empty_filter, arg_no_filter, filter_dirs)
+    return run_scenarios(platform, multizonal, "BK", filters, "ON",
+                         default_scenarios("BK"), reuse_cluster)
+
 
-    #setup_application_deployment(platform, multizonal, "OB")
-    #output = platform + "online_boutique_index"
-    #start_benchmark(filters, platform, THREADS, QPS, RUNTIME, application="OB",
-    #    output_file=output, no_filter=no_filter, subpath='', request='GET',
-    #    custom='loadgen', plot_name = "Index - Online Boutique", command_args=[])
-    #stop_kubernetes(platform)
-    #time.sleep(20)
-
-
-    #setup_application_deployment(platform, multizonal, "OB")
-    #output = platform + "online_boutique_set_currency"
-    #start_benchmark(filters, platform, THREADS, QPS, RUNTIME, application="OB",
-    #    output=output, no_filter= no_filter, subpath='setCurrency',
-    #    request='CURRENCY', custom='loadgen', 
-    #    plot_name = "Set Currency - Online Boutique", command_args=[])
-    #stop_kubernetes(platform)
-    #time.sleep(20)
-
-
-    #setup_application_deployment(platform, multizonal, "OB")
-    #output = platform + "online_boutique_browse_product"
-    #start_benchmark(filters, platform, THREADS, QPS, RUNTIME, application="OB",
-    #    output=output, no_filter=no_filter, subpath='product/6E92ZMYYFZ',
-    #    request='GET', custom='loadgen',
-    #    plot_name="Browse Product - Online Boutique", command_args=[])
-    #stop_kubernetes(platform)
-
-    #time.sleep(20)
-
-    setup_application_deployment(platform, multizonal, "OB")
-    output = platform + "online_boutique_view_cart"
-    start_benchmark(filters, platform, THREADS, QPS, RUNTIME, application="OB",
-        output=output, no_filter=no_filter, subpath='cart', request='GET',
-        custom='loadgen', plot_name="View Cart - Online Boutique", command_args=[])
-    stop_kubernetes(platform)
-
-    time.sleep(20)
-
-    setup_application_deployment(platform, multizonal, "OB")
-    output = platform + "online_boutique_add_to_cart"
-    start_benchmark(filters, platform, THREADS, QPS, RUNTIME, application="OB",
-        output=output, no_filter=no_filter, subpath='cart',
-        request='ADD_TO_CART', custom='loadgen',
-        plot_name="Add to Cart - Online Boutique", command_args=[])
-    stop_kubernetes(platform)
+def online_boutique_experiment(platform, multizonal, empty_filter,
+                               arg_no_filter, filter_dirs,
+                               reuse_cluster=True):
+    filters = scenario_filters(empty_filter, arg_no_filter, filter_dirs)
+    return run_scenarios(platform, multizonal, "OB", filters, "ON",
+                         default_scenarios("OB"), reuse_cluster)
 
 
 def train_ticket_experiment(multizonal, empty_filter, arg_no_filter, filter_dirs):
@@ -137,7 +177,123 @@ def train_ticket_experiment(multizonal, empty_filter, arg_no_filter, filter_dirs
     #time.sleep(60)
     #stop_kubernetes('GCP')
 
+def run_matrix_jobs(spec, application, jobs, checkpoint, completed,
+                    attach=False):
+    """ Run the cells of one application on a single cluster. Returns the
+    ids of the failed cells. With attach the cluster already exists, only
+    the application is deployed and removed.
+    """
+    platform = spec["platform"]
+    if application == "TT" and platform == "MK":
+        log.error("Train ticket is not supported on minikube")
+        return [job["id"] for job in jobs]
+    result = setup_application_deployment(platform, spec["multizonal"],
+                                          application,
+                                          start_cluster=not attach)
+    failed = []
+    try:
+        if result != util.EXIT_SUCCESS:
+            log.error("Could not set up %s.", application)
+            return [job["id"] for job in jobs]
+        # the filter the pods currently run, None if unknown
+        deployed = matrix.NO_FILTER
+        for job in jobs:
+            log.info("Running cell %s", job["id"])
+            no_filter = job["filter"] == matrix.NO_FILTER
+            if no_filter and deployed != matrix.NO_FILTER:
+                deployed = None
+                if kube_env.reset_application() != util.EXIT_SUCCESS:
+                    failed.append(job["id"])
+                    continue
+                deployed = matrix.NO_FILTER
+            scenario = job["scenario"]
+            output = (f"{platform}{scenario['output']}_"
+                      f"{matrix.filter_name(job['filter'])}_"
+                      f"q{job['qps']}t{job['threads']}_r{job['repetition']}")
+            result = start_benchmark([] if no_filter else [job["filter"]],
+                                     platform, job["threads"], job["qps"],
+                                     spec.get("run_time", RUNTIME),
+                                     application=application,
+                                     output_file=output,
+                                     no_filter="ON" if no_filter else "OFF",
+                                     subpath=scenario["subpath"],
+                                     request=scenario["request"],
+                                     custom="loadgen", command_args=[],
+                                     plot_name=scenario["plot_name"],
+                                     deploy=job["filter"] != deployed)
+            if result != util.EXIT_SUCCESS:
+                log.error("Cell %s failed.", job["id"])
+                failed.append(job["id"])
+                # deploy the filter again for the next cell
+                deployed = None
+                continue
+            deployed = job["filter"]
+            matrix.mark_completed(checkpoint, completed, job, result)
+    finally:
+        if attach:
+            kube_env.remove_application(application)
+        else:
+            stop_kubernetes(platform)
+    return failed
+
+
+def run_matrix(spec_file, resume=True, cells_file=None, attach=False,
+               contexts=None, namespace_list=None):
+    """ Run every cell of an experiment matrix that has not completed yet.
+    Progress is checkpointed after every cell, so an interrupted campaign
+    continues where it stopped. cells_file restricts the run to the cell
+    ids it lists. With contexts the cells run concurrently on the clusters
+    of these kube contexts, with namespace_list also concurrently in these
+    namespaces of every cluster.
+    """
+    try:
+        spec = matrix.load_spec(spec_file)
+        jobs = matrix.order_jobs(matrix.expand(spec, SCENARIOS))
+    except (OSError, ValueError) as err:
+        log.error("Invalid experiment matrix %s: %s", spec_file, err)
+        return util.EXIT_FAILURE
+    if cells_file:
+        with open(cells_file) as cells:
+            selected = set(json.load(cells))
+        jobs = [job for job in jobs if job["id"] in selected]
+    if namespace_list and not contexts:
+        contexts = [context_pool.current_context()]
+    checkpoint = matrix.checkpoint_file(spec_file)
+    completed = matrix.load_checkpoint(checkpoint) if resume else {}
+    if contexts and resume:
+        context_pool.merge_leftovers(spec_file, checkpoint, completed)
+    pending = [job for job in jobs if job["id"] not in completed]
+    log.info("%d of %d cells done, running %d. Checkpoint: %s",
+             len(jobs) - len(pending), len(jobs), len(pending), checkpoint)
+    if contexts:
+        failed = context_pool.run_parallel(spec_file, pending, contexts,
+                                           checkpoint, completed,
+                                           namespace_list)
+    else:
+        failed = []
+        for application, app_jobs in itertools.groupby(
+                pending, key=lambda job: job["application"]):
+            failed += run_matrix_jobs(spec, application, list(app_jobs),
+                                      checkpoint, completed, attach)
+    if failed:
+        log.error("%d cells failed, rerun to retry them: %s", len(failed),
+                  ", ".join(failed))
+        return util.EXIT_FAILURE
+    return util.EXIT_SUCCESS
+
+
 def main(args):
+    if args.trace_file:
+        tracing.enable(args.trace_file, args.trace_format)
+    with tracing.span("run_experiment", "run",
+                      application=args.application or "all"):
+        return run_experiments(args)
+
+
+def run_experiments(args):
+    if args.spec:
+        return run_matrix(args.spec, not args.no_resume, args.cells_file,
+                          args.attach, args.contexts, args.namespaces)
     # single commands to execute
     if args.application:
         return application_experiment(args.platform,
@@ -145,23 +301,20 @@ def main(args):
                                       args.application,
                                       args.empty_filter,
                                       args.no_filter,
-                                      args.filter_dirs)
-    else:
-        bookinfo_experiment(args.platform,
-                            args.multizonal,
-                            args.empty_filter,
-                            args.no_filter,
-                            args.filter_dirs)
-        online_boutique_experiment(args.platform,
-                                   args.multizonal,
-                                   args.empty_filter,
-                                   args.no_filter,
-                                   args.filter_dirs)
-        train_ticket_experiment(args.multizonal,
-                                args.emtpy_filter,
-                                args.no_isomorphism_filter,
-                                args.no_filter,
-                                args.filter_dirs)
+                                      args.filter_dirs,
+                                      not args.fresh_cluster)
+    result = util.EXIT_SUCCESS
+    for application in ("BK", "OB", "TT"):
+        res = application_experiment(args.platform,
+                                     args.multizonal,
+                                     application,
+                                     args.empty_filter,
+                                     args.no_filter,
+                                     args.filter_dirs,
+                                     not args.fresh_cluster)
+        if res not in (None, util.EXIT_SUCCESS):
+            result = res
+    return result
 
 
 if __name__ == '__main__':
@@ -214,6 +367,58 @@ if __name__ == '__main__':
                         action="store_true",
                         help="If you are running on GCP,"
                         " do you want a multi-zone cluster?")
+    parser.add_argument("-fc",
+                        "--fresh-cluster",
+                        dest="fresh_cluster",
+                        action="store_true",
+                        help="Set up a new cluster for every scenario instead"
+                        " of resetting the one of the previous scenario.")
+    parser.add_argument("-sp",
+                        "--spec",
+                        dest="spec",
+                        help="Run an experiment matrix described in a YAML,"
+                        " TOML or JSON file, see experiments/.")
+    parser.add_argument("-nr",
+                        "--no-resume",
+                        dest="no_resume",
+                        action="store_true",
+                        help="Run all cells of the matrix again instead of"
+                        " continuing from its checkpoint.")
+    parser.add_argument("-ctx",
+                        "--contexts",
+                        dest="contexts",
+                        nargs="+",
+                        help="Run the cells of the matrix concurrently on the"
+                        " clusters of these kube contexts.")
+    parser.add_argument("-ns",
+                        "--namespaces",
+                        dest="namespaces",
+                        nargs="+",
+                        help="Run the cells of the matrix concurrently in"
+                        " these namespaces of the running cluster, or of"
+                        " every cluster given with --contexts.")
+    parser.add_argument("-cf",
+                        "--cells-file",
+                        dest="cells_file",
+                        help="Only run the matrix cells listed in this JSON"
+                        " file.")
+    parser.add_argument("--attach",
+                        dest="attach",
+                        action="store_true",
+                        help="Use the running cluster of the current context,"
+                        " which already runs istio, instead of creating one"
+                        " per application.")
+    parser.add_argument("-tf",
+                        "--trace-file",
+                        dest="trace_file",
+                        help="Trace every external command of the run into"
+                        " this file, for example trace.json.")
+    parser.add_argument("-tfmt",
+                        "--trace-format",
+                        dest="trace_format",
+                        default="chrome",
+                        choices=tracing.FORMATS,
+                        help="Chrome trace events or OTLP JSON.")
     # Parse options and process argv
     arguments = parser.parse_args()
     # configure logging
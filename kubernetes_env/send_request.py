@@ -1,23 +1,141 @@
 #!/usr/bin/env python3
 import argparse
 import logging
-import requests
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+import gateway_cache
 import kube_env
+import kube_util as util
+import timing
 
 log = logging.getLogger(__name__)
 
+# shared by all requests of this process so connections are reused, one
+# session and its pool size with and one without fresh connections
+SESSIONS = {}
+POOL_SIZE = 10
+DEFAULT_PATH = "productpage"
+METHODS = ["GET", "HEAD", "POST", "PUT", "DELETE"]
+# response headers that show what the filters did to a request
+SHOWN_HEADERS = ["x-request-id", "x-envoy-upstream-service-time"]
+REQUEST_TIMEOUT = 10
 
-def send_request(platform="MK"):
+
+def get_session(fresh_connections=False, pool_size=1):
+    session, size = SESSIONS.get(fresh_connections, (None, 0))
+    # a batch with more concurrent requests needs a larger pool
+    if session is None or size < pool_size:
+        if session is not None:
+            session.close()
+        size = max(pool_size, POOL_SIZE)
+        session = util.make_session(size, fresh_connections)
+        SESSIONS[fresh_connections] = (session, size)
+    return session
+
+
+def request_url(platform, path=DEFAULT_PATH):
     _, _, gateway_url = kube_env.get_gateway_info(platform)
-    url = f"http://{gateway_url}/productpage"
-    print("url: ", url)
-    response = requests.get(url)
+    return f"http://{gateway_url}/{path.lstrip('/')}"
+
+
+def forget_gateway(platform, err):
+    log.warning("Request failed, resolving the gateway again: %s", err)
+    gateway_cache.invalidate(gateway_cache.cache_key(platform))
+
+
+def send_request(platform="MK", fresh_connections=False, path=DEFAULT_PATH,
+                 method="GET"):
+    import requests
+    url = request_url(platform, path)
+    log.debug("Sending %s %s", method, url)
+    try:
+        response = get_session(fresh_connections).request(method, url)
+    except requests.exceptions.ConnectionError as err:
+        # the cached gateway may be outdated
+        forget_gateway(platform, err)
+        url = request_url(platform, path)
+        response = get_session(fresh_connections).request(method, url)
     return response
 
 
+def timed_request(session, method, url, idx, shown_headers):
+    import requests
+    row = {"request": idx, "status": None, "error": None, "headers": {}}
+    start = time.perf_counter()
+    try:
+        response = session.request(method, url, timeout=REQUEST_TIMEOUT)
+        row["status"] = response.status_code
+        row["headers"] = {header: response.headers.get(header)
+                          for header in shown_headers}
+    except requests.exceptions.RequestException as err:
+        row["error"] = type(err).__name__
+    row["latency"] = (time.perf_counter() - start) * 1000
+    return row
+
+
+def send_requests(platform="MK", count=1, concurrency=1, path=DEFAULT_PATH,
+                  method="GET", shown_headers=None, fresh_connections=False):
+    """ Send count requests, at most concurrency at a time, over the shared
+    connection pool. Returns status, latency in ms and the shown headers of
+    every request.
+    """
+    shown_headers = SHOWN_HEADERS if shown_headers is None else shown_headers
+    concurrency = max(min(concurrency, count), 1)
+    session = get_session(fresh_connections, concurrency)
+
+    def run(url):
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            return list(pool.map(
+                lambda idx: timed_request(session, method, url, idx,
+                                          shown_headers), range(count)))
+
+    rows = run(request_url(platform, path))
+    if all(row["error"] == "ConnectionError" for row in rows):
+        # the cached gateway may be outdated
+        forget_gateway(platform, "no request got through")
+        rows = run(request_url(platform, path))
+    return rows
+
+
+def format_table(rows, shown_headers=None):
+    shown_headers = SHOWN_HEADERS if shown_headers is None else shown_headers
+    table = [["#", "status", "ms"] + list(shown_headers)]
+    for row in rows:
+        table.append([str(row["request"]), str(row["status"] or row["error"]),
+                      f"{row['latency']:.1f}"]
+                     + [row["headers"].get(header) or "-"
+                        for header in shown_headers])
+    widths = [max(len(line[col]) for line in table)
+              for col in range(len(table[0]))]
+    return "\n".join("  ".join(cell.ljust(width)
+                               for cell, width in zip(line, widths)).rstrip()
+                     for line in table)
+
+
+def summarize(rows):
+    latencies = [row["latency"] for row in rows if row["status"] is not None]
+    ok = sum(1 for row in rows
+             if row["status"] is not None and row["status"] < 400)
+    summary = f"{ok}/{len(rows)} ok"
+    if latencies:
+        summary += (f", p50 {timing.percentile(latencies, 50):.1f} ms"
+                    f", p99 {timing.percentile(latencies, 99):.1f} ms")
+    return summary
+
+
 def main(args):
-    log.info(send_request(args.platform).headers)
+    rows = send_requests(args.platform, args.count, args.concurrency,
+                         args.path, args.method, args.shown_headers,
+                         args.fresh_connections)
+    log.info("%s %s:\n%s", args.method, args.path,
+             format_table(rows, args.shown_headers))
+    log.info(summarize(rows))
+    if all(row["status"] is not None and row["status"] < 400
+           for row in rows):
+        return util.EXIT_SUCCESS
+    return util.EXIT_FAILURE
 
 
 if __name__ == '__main__':
@@ -35,6 +153,25 @@ if __name__ == '__main__':
                         choices=["MK", "GCP"],
                         help="Which platform to run the scripts on."
                         "MK is minikube, GCP is Google Cloud Compute")
+    parser.add_argument("-fc", "--fresh-connections",
+                        dest="fresh_connections",
+                        action="store_true",
+                        help="Do not reuse a keep-alive connection.")
+    parser.add_argument("-n", "--count", dest="count", type=int, default=1,
+                        help="Number of requests to send.")
+    parser.add_argument("-c", "--concurrency", dest="concurrency", type=int,
+                        default=1,
+                        help="Number of requests in flight at a time.")
+    parser.add_argument("-pa", "--path", dest="path", default=DEFAULT_PATH,
+                        help="Path to request from the gateway.")
+    parser.add_argument("-X", "--method", dest="method", default="GET",
+                        choices=METHODS,
+                        help="HTTP method of the requests.")
+    parser.add_argument("-H", "--show-header", dest="shown_headers",
+                        action="append",
+                        help="Response header to show for every request,"
+                        " can be repeated. Defaults to "
+                        f"{', '.join(SHOWN_HEADERS)}.")
 
     # Parse options and process argv
     arguments = parser.parse_args()
@@ -46,4 +183,4 @@ if __name__ == '__main__':
     stderr_log = logging.StreamHandler()
     stderr_log.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
     logging.getLogger().addHandler(stderr_log)
-    main(arguments)
+    sys.exit(main(arguments))
@@ -0,0 +1,98 @@
+import csv
+import threading
+
+from histogram import LatencyHistogram
+
+
+class SecondStats:
+    def __init__(self, second):
+        self.second = second
+        self.offered = 0
+        self.completed = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.hist = LatencyHistogram()
+
+    def row(self):
+        return {
+            "second": self.second,
+            "offered": self.offered,
+            "achieved": self.completed,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "p50": self.hist.percentile(50),
+            "p90": self.hist.percentile(90),
+            "p99": self.hist.percentile(99),
+            "max": self.hist.percentile(100),
+        }
+
+
+class TimeSeries:
+    """ Per-second rollup of a load run. Requests count as offered in the
+    second they were scheduled and as achieved in the second they completed.
+    Safe to record into from several threads.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.lock = threading.Lock()
+        self.seconds = {}
+
+    def _get(self, timestamp):
+        second = max(int(timestamp - self.start), 0)
+        stats = self.seconds.get(second)
+        if stats is None:
+            stats = self.seconds[second] = SecondStats(second)
+        return stats
+
+    def offered(self, timestamp):
+        with self.lock:
+            self._get(timestamp).offered += 1
+
+    def completed(self, timestamp, latency_ms=None, timeout=False):
+        # a missing latency marks a failed request
+        with self.lock:
+            stats = self._get(timestamp)
+            if timeout:
+                stats.timeouts += 1
+            elif latency_ms is None:
+                stats.errors += 1
+            else:
+                stats.completed += 1
+                stats.hist.record(latency_ms)
+
+    def pop_rows(self, now=None, grace=0):
+        """ Remove and return the rows of all seconds that ended more than
+        grace seconds before now. Without now, everything is returned.
+        """
+        with self.lock:
+            if now is None:
+                done = sorted(self.seconds)
+            else:
+                cutoff = int(now - self.start) - grace
+                done = sorted(sec for sec in self.seconds if sec < cutoff)
+            return [self.seconds.pop(sec).row() for sec in done]
+
+
+class TimeSeriesWriter:
+    """ Appends per-second rows to a csv file while a run is in progress.
+    Every write is flushed so the file is usable if the run dies.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.csv_file = open(output_file, "w", newline="")
+        self.writer = None
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.csv_file,
+                                         fieldnames=list(rows[0]))
+            self.writer.writeheader()
+        self.writer.writerows(rows)
+        self.csv_file.flush()
+
+    def close(self):
+        self.csv_file.close()
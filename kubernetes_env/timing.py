@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+import argparse
+import contextvars
+import json
+import logging
+import math
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import kube_util as util
+import results_store
+import tracing
+
+log = logging.getLogger(__name__)
+
+TIMINGS_NAME = "timings.jsonl"
+# the run phases are currently recorded into, None outside of a run. Every
+# thread has its own, so concurrent runs do not mix up their phases.
+RUN = contextvars.ContextVar("timing_run", default=None)
+LOCK = threading.Lock()
+
+
+def new_run_id():
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def timings_file(store_dir=None):
+    return Path(store_dir or results_store.STORE_DIR).joinpath(TIMINGS_NAME)
+
+
+def record(name, duration, **fields):
+    """ Append one phase as a JSON line. Outside of a run the phase is a
+    run of its own.
+    """
+    run = RUN.get() or {"run_id": new_run_id(), "kind": name}
+    line = {"run_id": run["run_id"], "kind": run["kind"], "phase": name,
+            "duration": round(duration, 3), "time": time.time()}
+    line.update(fields)
+    output_file = timings_file()
+    with LOCK:
+        util.check_dir(output_file.parent)
+        with open(output_file, "a") as timing_file:
+            timing_file.write(json.dumps(line) + "\n")
+
+
+@contextmanager
+def phase(name, span_name=None, **fields):
+    """ Time the enclosed block. The yielded dict is recorded with it, so
+    the block can add its result. span_name names the phase in a trace.
+    """
+    start = time.time()
+    fields = dict(fields)
+    try:
+        # commands run in the block are children of the phase in a trace
+        with tracing.span(span_name or name, "phase"):
+            yield fields
+    except BaseException:
+        fields["error"] = True
+        raise
+    finally:
+        record(name, time.time() - start, **fields)
+
+
+@contextmanager
+def run(kind, **fields):
+    """ Group all phases recorded in the enclosed block under one run id,
+    and record the total duration at the end. Nested runs are part of the
+    outer run.
+    """
+    if RUN.get() is not None:
+        with tracing.span(kind, "phase"):
+            yield dict(fields)
+        return
+    current_run = {"run_id": new_run_id(), "kind": kind}
+    token = RUN.set(current_run)
+    try:
+        with phase("total", span_name=kind, **fields) as total:
+            total["run_id"] = current_run["run_id"]
+            yield total
+    finally:
+        RUN.reset(token)
+
+
+def load_timings(store_dir=None):
+    path = timings_file(store_dir)
+    if not path.exists():
+        return []
+    with open(path) as timing_file:
+        return [json.loads(line) for line in timing_file if line.strip()]
+
+
+def percentile(values, percent):
+    # nearest rank, good enough for a handful of runs
+    values = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+def summarize(timings, kind=None):
+    """ Count, p50, p95 and max of every phase across runs. """
+    phases = {}
+    for line in timings:
+        if kind and line["kind"] != kind:
+            continue
+        phases.setdefault((line["kind"], line["phase"]), []).append(
+            line["duration"])
+    return [{"kind": phase_kind, "phase": name, "count": len(durations),
+             "p50": percentile(durations, 50),
+             "p95": percentile(durations, 95), "max": max(durations)}
+            for (phase_kind, name), durations in sorted(phases.items())]
+
+
+def main(args):
+    rows = summarize(load_timings(args.store_dir), args.kind)
+    if not rows:
+        log.warning("No timings recorded in %s.", timings_file(args.store_dir))
+        return util.EXIT_SUCCESS
+    log.info("%-16s %-32s %5s %9s %9s %9s", "kind", "phase", "runs", "p50",
+             "p95", "max")
+    for row in rows:
+        log.info("%-16s %-32s %5d %8.1fs %8.1fs %8.1fs", row["kind"],
+                 row["phase"], row["count"], row["p50"], row["p95"],
+                 row["max"])
+    return util.EXIT_SUCCESS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l",
+                        "--log-file",
+                        dest="log_file",
+                        default="timing.log",
+                        help="Specifies name of the log file.")
+    parser.add_argument(
+        "-ll",
+        "--log-level",
+        dest="log_level",
+        default="INFO",
+        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"],
+        help="The log level to choose.")
+    parser.add_argument("-sd",
+                        "--store-dir",
+                        dest="store_dir",
+                        default=results_store.STORE_DIR,
+                        help="Results directory holding the timings.")
+    parser.add_argument("-k",
+                        "--kind",
+                        dest="kind",
+                        help="Only summarize runs of this kind, for example"
+                        " refresh_filter or setup.")
+    # Parse options and process argv
+    arguments = parser.parse_args()
+    # configure logging
+    logging.basicConfig(filename=arguments.log_file,
+                        format="%(levelname)s:%(message)s",
+                        level=getattr(logging, arguments.log_level),
+                        filemode="w")
+    stderr_log = logging.StreamHandler()
+    stderr_log.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logging.getLogger().addHandler(stderr_log)
+    main(arguments)
@@ -0,0 +1,189 @@
+import atexit
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+log = logging.getLogger(__name__)
+
+# set to a file to trace every external command of a process
+TRACE_ENV = "KUBE_ENV_TRACE"
+TRACE_FORMAT_ENV = "KUBE_ENV_TRACE_FORMAT"
+FORMATS = ["chrome", "otlp"]
+SERVICE_NAME = "kube_env"
+# recorded spans, None while tracing is disabled
+SPANS = None
+TRACE = {"file": None, "format": "chrome", "trace_id": None}
+LOCK = threading.Lock()
+CURRENT = contextvars.ContextVar("current_span", default=None)
+
+
+def enabled():
+    return SPANS is not None
+
+
+def enable(trace_file, trace_format="chrome"):
+    """ Start recording spans, they are written to trace_file when the
+    process exits or flush is called.
+    """
+    global SPANS
+    if trace_format not in FORMATS:
+        raise ValueError(f"Unknown trace format {trace_format}")
+    with LOCK:
+        if SPANS is None:
+            SPANS = []
+            atexit.register(flush)
+        TRACE["file"] = Path(trace_file)
+        TRACE["format"] = trace_format
+        TRACE["trace_id"] = uuid.uuid4().hex
+
+
+def disable():
+    global SPANS
+    with LOCK:
+        SPANS = None
+
+
+def current():
+    return CURRENT.get()
+
+
+def new_span(name, category, parent=None, **attrs):
+    """ Create an open span below parent, or below the current span. Returns
+    None while tracing is disabled.
+    """
+    if SPANS is None:
+        return None
+    parent = parent or CURRENT.get()
+    return {"name": name, "cat": category, "span_id": uuid.uuid4().hex[:16],
+            "parent_id": parent["span_id"] if parent else None,
+            "parent": parent["name"] if parent else None,
+            "start": time.time_ns(), "end": None,
+            "tid": threading.get_ident(), "attrs": dict(attrs)}
+
+
+def end_span(span, **attrs):
+    if span is None:
+        return
+    span["end"] = time.time_ns()
+    span["attrs"].update(attrs)
+    with LOCK:
+        if SPANS is not None:
+            SPANS.append(span)
+
+
+@contextmanager
+def span(name, category="phase", parent=None, **attrs):
+    """ Trace the enclosed block. Spans opened inside of it, also those of
+    commands, are its children. The yielded dict holds its attributes.
+    """
+    current_span = new_span(name, category, parent, **attrs)
+    if current_span is None:
+        yield dict(attrs)
+        return
+    token = CURRENT.set(current_span)
+    try:
+        yield current_span["attrs"]
+    except BaseException:
+        current_span["attrs"]["error"] = True
+        raise
+    finally:
+        CURRENT.reset(token)
+        end_span(current_span)
+
+
+def command_span(cmd, parent=None):
+    # commands only show their executable in the span name, the full
+    # command line is an attribute
+    parts = str(cmd).split()
+    return new_span(parts[0] if parts else "command", "command", parent,
+                    cmd=str(cmd))
+
+
+def end_command(cmd_span, returncode, *outputs):
+    size = sum(len(output) for output in outputs if output)
+    end_span(cmd_span, exit_code=returncode, output_size=size,
+             error=returncode != 0)
+
+
+def chrome_trace(spans):
+    """ Trace Event Format as understood by chrome://tracing and Perfetto.
+    Timestamps are in microseconds.
+    """
+    pid = os.getpid()
+    events = []
+    for trace_span in sorted(spans, key=lambda item: item["start"]):
+        args = dict(trace_span["attrs"])
+        args["parent"] = trace_span["parent"]
+        events.append({"name": trace_span["name"], "cat": trace_span["cat"],
+                       "ph": "X", "ts": trace_span["start"] / 1000,
+                       "dur": (trace_span["end"] - trace_span["start"]) / 1000,
+                       "pid": pid, "tid": trace_span["tid"], "args": args})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp_trace(spans, trace_id=None):
+    """ OTLP/JSON export request, as accepted by an OpenTelemetry collector
+    on /v1/traces.
+    """
+    trace_id = trace_id or uuid.uuid4().hex
+    otlp_spans = []
+    for trace_span in sorted(spans, key=lambda item: item["start"]):
+        attrs = dict(trace_span["attrs"], category=trace_span["cat"])
+        otlp_span = {
+            "traceId": trace_id, "spanId": trace_span["span_id"],
+            "name": trace_span["name"], "kind": 1,
+            "startTimeUnixNano": str(trace_span["start"]),
+            "endTimeUnixNano": str(trace_span["end"]),
+            "attributes": [{"key": key, "value": _otlp_value(value)}
+                           for key, value in attrs.items()
+                           if value is not None],
+            # 1 is ok, 2 is error
+            "status": {"code": 2 if attrs.get("error") else 1}}
+        if trace_span["parent_id"]:
+            otlp_span["parentSpanId"] = trace_span["parent_id"]
+        otlp_spans.append(otlp_span)
+    resource = {"attributes": [
+        {"key": "service.name", "value": {"stringValue": SERVICE_NAME}},
+        {"key": "process.pid", "value": {"intValue": str(os.getpid())}}]}
+    return {"resourceSpans": [{
+        "resource": resource,
+        "scopeSpans": [{"scope": {"name": SERVICE_NAME},
+                        "spans": otlp_spans}]}]}
+
+
+def flush():
+    """ Write all spans recorded so far to the trace file. """
+    with LOCK:
+        if not SPANS or TRACE["file"] is None:
+            return None
+        spans = list(SPANS)
+    if TRACE["format"] == "otlp":
+        trace = otlp_trace(spans, TRACE["trace_id"])
+    else:
+        trace = chrome_trace(spans)
+    TRACE["file"].parent.mkdir(parents=True, exist_ok=True)
+    with open(TRACE["file"], "w") as trace_file:
+        json.dump(trace, trace_file)
+    log.info("Wrote %d spans to %s.", len(spans), TRACE["file"])
+    return TRACE["file"]
+
+
+if os.environ.get(TRACE_ENV):
+    enable(os.environ[TRACE_ENV],
+           os.environ.get(TRACE_FORMAT_ENV, "chrome"))
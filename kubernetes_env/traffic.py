@@ -0,0 +1,224 @@
+import csv
+import json
+import logging
+import multiprocessing
+import queue as queue_module
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import kube_util as util
+from timeseries import TimeSeries
+
+log = logging.getLogger(__name__)
+
+DEFAULT_THREADS = 32
+DEFAULT_TIMEOUT = 3
+# how often a paused (zero rate) profile checks whether traffic resumes
+IDLE_STEP = 0.1
+# how often join checks that the shaping process is still alive
+JOIN_POLL = 1
+
+# the old kube_env burst: 500 requests as fast as possible
+BURST_PROFILE = {
+    "path": "productpage",
+    "phases": [{"type": "spike", "base": 0, "peak": 1000, "at": 0,
+                "width": 0.5, "duration": 1}],
+}
+
+
+def step_rate(phase, t):
+    levels = phase["levels"]
+    idx = min(int(t // phase["hold"]), len(levels) - 1)
+    return levels[idx]
+
+
+def ramp_rate(phase, t):
+    return phase["start"] + (phase["end"] - phase["start"]) * (
+        t / phase["duration"])
+
+
+def square_rate(phase, t):
+    high = (t % phase["period"]) < phase["period"] * phase.get("duty", 0.5)
+    return phase["high"] if high else phase["low"]
+
+
+def spike_rate(phase, t):
+    in_spike = phase["at"] <= t < phase["at"] + phase["width"]
+    return phase["peak"] if in_spike else phase["base"]
+
+
+RATE_FUNCTIONS = {
+    "step": step_rate,
+    "ramp": ramp_rate,
+    "square": square_rate,
+    "spike": spike_rate,
+}
+
+
+def phase_duration(phase):
+    if phase["type"] == "step" and "duration" not in phase:
+        return phase["hold"] * len(phase["levels"])
+    return phase["duration"]
+
+
+def arrivals(phases):
+    """ Yield the send offsets in seconds of a whole profile. """
+    offset = 0.0
+    for phase in phases:
+        duration = phase_duration(phase)
+        t = 0.0
+        if phase["type"] == "poisson":
+            while True:
+                t += random.expovariate(phase["rate"])
+                if t >= duration:
+                    break
+                yield offset + t
+        else:
+            rate_fn = RATE_FUNCTIONS[phase["type"]]
+            while t < duration:
+                rate = rate_fn(phase, t)
+                if rate <= 0:
+                    t += IDLE_STEP
+                    continue
+                yield offset + t
+                t += 1.0 / rate
+        offset += duration
+
+
+def load_profile(profile_file):
+    profile_file = Path(profile_file)
+    with open(profile_file) as prof:
+        if profile_file.suffix in (".yaml", ".yml"):
+            import yaml
+            profile = yaml.safe_load(prof)
+        else:
+            profile = json.load(prof)
+    for phase in profile["phases"]:
+        if phase["type"] not in RATE_FUNCTIONS and phase["type"] != "poisson":
+            raise ValueError(f"Unknown traffic shape {phase['type']}")
+    return profile
+
+
+def _shape_loop(url, profile, fresh_connections, stop_event, queue):
+    series = None
+    try:
+        series = _shape(url, profile, fresh_connections, stop_event, queue)
+    except Exception:
+        log.exception("Traffic profile failed.")
+        raise
+    finally:
+        if series is not None:
+            for row in series.pop_rows():
+                queue.put(row)
+        # signal the end of the run, also after a failure
+        queue.put(None)
+
+
+def _shape(url, profile, fresh_connections, stop_event, queue):
+    import requests
+    threads = profile.get("threads", DEFAULT_THREADS)
+    timeout = profile.get("timeout", DEFAULT_TIMEOUT)
+    session = util.make_session(threads, fresh_connections)
+    start = time.time()
+    series = TimeSeries(start)
+
+    def timed_request(intended):
+        if stop_event.is_set():
+            return
+        try:
+            res = session.get(url, timeout=timeout)
+            ok = res.status_code == 200
+        except requests.exceptions.Timeout:
+            series.completed(time.time(), timeout=True)
+            return
+        except requests.exceptions.RequestException:
+            ok = False
+        done = time.time()
+        # latency counts from the scheduled send time
+        series.completed(done, (done - intended) * 1000 if ok else None)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for offset in arrivals(profile["phases"]):
+            intended = start + offset
+            delay = intended - time.time()
+            if delay > 0 and stop_event.wait(delay):
+                break
+            if stop_event.is_set():
+                break
+            series.offered(intended)
+            pool.submit(timed_request, intended)
+            for row in series.pop_rows(time.time(), grace=timeout + 1):
+                queue.put(row)
+        if stop_event.is_set():
+            # requests still waiting for a thread are never sent, only the
+            # ones in flight finish
+            pool.shutdown(wait=False, cancel_futures=True)
+    session.close()
+    return series
+
+
+class TrafficShaper:
+    """ Runs a traffic profile against a url in a separate process.
+    start() begins sending, stop() ends the run early and join() waits
+    for the end of the run and returns the per-second records.
+    """
+
+    def __init__(self, url, profile, fresh_connections=False):
+        self.url = url
+        self.profile = profile
+        self.stop_event = multiprocessing.Event()
+        self.queue = multiprocessing.Queue()
+        self.proc = multiprocessing.Process(
+            target=_shape_loop,
+            args=(url, profile, fresh_connections, self.stop_event,
+                  self.queue))
+        self.rows = []
+
+    def start(self):
+        log.info("Starting traffic profile against %s", self.url)
+        self.proc.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def join(self):
+        # drain the queue first, the process cannot exit while it is full
+        while True:
+            try:
+                row = self.queue.get(timeout=JOIN_POLL)
+            except queue_module.Empty:
+                if self.proc.is_alive():
+                    continue
+                # killed before it could signal the end
+                self._drain()
+                log.error("Traffic process exited with %s without finishing"
+                          " the profile.", self.proc.exitcode)
+                break
+            if row is None:
+                break
+            self.rows.append(row)
+        self.proc.join()
+        log.info("Traffic profile finished after %d seconds.",
+                 len(self.rows))
+        return self.rows
+
+    def _drain(self):
+        while True:
+            try:
+                row = self.queue.get_nowait()
+            except queue_module.Empty:
+                return
+            if row is not None:
+                self.rows.append(row)
+
+
+def write_rows(rows, output_file):
+    if not rows:
+        return
+    with open(output_file, "w") as csv_file:
+        w = csv.DictWriter(csv_file, fieldnames=list(rows[0]))
+        w.writeheader()
+        w.writerows(rows)
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import logging
+import math
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import kube_util as util
+
+log = logging.getLogger(__name__)
+
+# optimize for speed and size and drop everything envoy does not need
+WASM_OPT_FLAGS = "--strip-debug --strip-producers"
+OPT_LEVELS = ["O1", "O2", "O3", "O4", "Os", "Oz"]
+# etcd rejects objects above 1 MiB, binary files are stored base64 encoded
+CONFIGMAP_LIMIT = 1 << 20
+CONFIGMAP_WARN = 0.8
+COMPILE_RUNS = 5
+REPORT_FILE = "wasm_report.csv"
+# compiles the module with V8, the engine the istio sidecars use, eagerly and
+# with the optimizing tier, V8 caches modules so every run needs its own node
+NODE_FLAGS = ["--no-wasm-lazy-compilation", "--no-liftoff"]
+NODE_COMPILE = """
+const buf = require("fs").readFileSync(process.argv[1]);
+const start = process.hrtime.bigint();
+new WebAssembly.Module(buf);
+console.log(Number(process.hrtime.bigint() - start) / 1e6);
+"""
+
+
+def wasm_modules(filter_dir):
+    return sorted(Path(filter_dir).joinpath("wasm_bins").glob("*.wasm"))
+
+
+def configmap_size(wasm_file):
+    # size of the module once it is base64 encoded into binaryData
+    return 4 * math.ceil(Path(wasm_file).stat().st_size / 3)
+
+
+def check_size(wasm_file):
+    """ Warn if a module gets close to what fits into a config map. """
+    size = configmap_size(wasm_file)
+    if size >= CONFIGMAP_LIMIT:
+        log.error("%s needs %d KiB in a config map, the limit is %d KiB.",
+                  wasm_file, size // 1024, CONFIGMAP_LIMIT // 1024)
+        return False
+    if size >= CONFIGMAP_WARN * CONFIGMAP_LIMIT:
+        log.warning("%s needs %d KiB in a config map, close to the limit of"
+                    " %d KiB.", wasm_file, size // 1024,
+                    CONFIGMAP_LIMIT // 1024)
+    return True
+
+
+def optimize(wasm_file, level="O3"):
+    """ Run wasm-opt on a module in place. Returns the size before and
+    after, or None if wasm-opt is not installed or fails.
+    """
+    if shutil.which("wasm-opt") is None:
+        log.warning("wasm-opt not found, not optimizing %s.", wasm_file)
+        return None
+    before = Path(wasm_file).stat().st_size
+    tmp_file = f"{wasm_file}.opt"
+    cmd = f"wasm-opt -{level} {WASM_OPT_FLAGS} {wasm_file} -o {tmp_file}"
+    if util.exec_process(cmd, stdout=subprocess.PIPE,
+                         stderr=subprocess.PIPE) != util.EXIT_SUCCESS:
+        log.warning("wasm-opt failed, not optimizing %s.", wasm_file)
+        Path(tmp_file).unlink(missing_ok=True)
+        return None
+    Path(tmp_file).replace(wasm_file)
+    after = Path(wasm_file).stat().st_size
+    log.info("Optimized %s with -%s: %d KiB -> %d KiB (%.0f%%)",
+             Path(wasm_file).name, level, before // 1024, after // 1024,
+             (after - before) / before * 100 if before else 0)
+    return before, after
+
+
+def optimize_filter(filter_dir, level="O3"):
+    """ Optimize all modules of a filter. Fails if any of them could not be
+    optimized, the others are optimized anyway.
+    """
+    result = util.EXIT_SUCCESS
+    for wasm_file in wasm_modules(filter_dir):
+        if optimize(wasm_file, level) is None:
+            result = util.EXIT_FAILURE
+        check_size(wasm_file)
+    return result
+
+
+def compile_time(wasm_file, runs=COMPILE_RUNS):
+    """ Median time in ms V8 takes to compile the module, None if node is
+    not installed.
+    """
+    if shutil.which("node") is None:
+        return None
+    timings = []
+    for _ in range(runs):
+        res = subprocess.run(["node", *NODE_FLAGS, "-e", NODE_COMPILE,
+                              str(wasm_file)], stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, check=False)
+        if res.returncode != util.EXIT_SUCCESS:
+            log.error("Could not compile %s:\n%s", wasm_file,
+                      res.stderr.decode("utf-8"))
+            return None
+        timings.append(float(res.stdout))
+    return statistics.median(timings)
+
+
+def report(filter_dirs, runs=COMPILE_RUNS, output_file=REPORT_FILE):
+    """ Log and append size and compile time of every module to a CSV, so
+    filters can be compared over time.
+    """
+    rows = []
+    for filter_dir in filter_dirs:
+        for wasm_file in wasm_modules(filter_dir):
+            check_size(wasm_file)
+            row = {"time": time.time(), "filter": Path(filter_dir).name,
+                   "module": wasm_file.name,
+                   "size": wasm_file.stat().st_size,
+                   "configmap_size": configmap_size(wasm_file),
+                   "compile_ms": compile_time(wasm_file, runs)}
+            log.info("%-30s %-18s %8d KiB %10s ms", row["filter"],
+                     row["module"], row["size"] // 1024,
+                     "n/a" if row["compile_ms"] is None
+                     else f"{row['compile_ms']:.2f}")
+            rows.append(row)
+    if not rows:
+        return rows
+    write_header = not Path(output_file).exists()
+    with open(output_file, "a+") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]))
+        if write_header:
+            writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+def main(args):
+    if args.optimize:
+        for filter_dir in args.filter_dirs:
+            # asked for explicitly, an unoptimized report would mislead
+            if optimize_filter(filter_dir,
+                               args.optimize) != util.EXIT_SUCCESS:
+                log.error("Could not optimize %s with -%s.", filter_dir,
+                          args.optimize)
+                return util.EXIT_FAILURE
+    report(args.filter_dirs, args.runs, args.output_file)
+    return util.EXIT_SUCCESS
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l",
+                        "--log-file",
+                        dest="log_file",
+                        default="wasm.log",
+                        help="Specifies name of the log file.")
+    parser.add_argument(
+        "-ll",
+        "--log-level",
+        dest="log_level",
+        default="INFO",
+        choices=["CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG", "NOTSET"],
+        help="The log level to choose.")
+    parser.add_argument("-fds",
+                        "--filter-dirs",
+                        dest="filter_dirs",
+                        nargs="+",
+                        required=True,
+                        help="Filter directories whose wasm_bins to report.")
+    parser.add_argument("-opt",
+                        "--optimize",
+                        dest="optimize",
+                        choices=OPT_LEVELS,
+                        help="Run wasm-opt at this level before reporting.")
+    parser.add_argument("-r",
+                        "--runs",
+                        dest="runs",
+                        type=int,
+                        default=COMPILE_RUNS,
+                        help="How often to compile each module.")
+    parser.add_argument("-o",
+                        "--output-file",
+                        dest="output_file",
+                        default=REPORT_FILE,
+                        help="CSV file the report is appended to.")
+    # Parse options and process argv
+    arguments = parser.parse_args()
+    # configure logging
+    logging.basicConfig(filename=arguments.log_file,
+                        format="%(levelname)s:%(message)s",
+                        level=getattr(logging, arguments.log_level),
+                        filemode="w")
+    stderr_log = logging.StreamHandler()
+    stderr_log.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logging.getLogger().addHandler(stderr_log)
+    sys.exit(main(arguments))
@@ -4,10 +4,13 @@ import logging
 import time
 from pathlib import Path
 
-import kubernetes_env.kube_util as util
-import kubernetes_env.kube_env as kube_env
-import kubernetes_env.send_request as requests
-import kubernetes_env.query_storage as storage
+# importing the package puts the environment scripts on the path, use their
+# canonical names so each module is only loaded once
+import kubernetes_env  # noqa: F401
+import kube_util as util
+import kube_env
+import send_request as requests
+import query_storage as storage
 
 # some folder definitions
 FILE_DIR = Path.resolve(Path(__file__)).parent
@@ -56,10 +59,9 @@ def bootstrap(distributed=False):
     result = kube_env.build_filter(filter_dir)
     assert result == util.EXIT_SUCCESS
     log.info("Refresh the filters")
+    # returns once all pods run the new filter and are ready
     result = kube_env.refresh_filter(filter_dir)
-    # sleep a little, so things initialize better
-    log.info("Sleeping for 60 seconds")
-    time.sleep(60)
+    assert result == util.EXIT_SUCCESS
     # first, clean the storage
     log.info("Cleaning storage")
     storage_proc = storage.init_storage_mon()
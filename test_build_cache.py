@@ -0,0 +1,150 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+import build_cache
+import kube_env
+import kube_util as util
+
+
+@pytest.fixture
+def filter_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(build_cache, "CACHE_DIR", tmp_path.joinpath("cache"))
+    monkeypatch.setattr(build_cache, "toolchain_version",
+                        lambda: "rustc 1.0.0-nightly")
+    filter_dir = tmp_path.joinpath("filter")
+    filter_dir.joinpath("src").mkdir(parents=True)
+    filter_dir.joinpath("Cargo.toml").write_text("[package]\n")
+    filter_dir.joinpath("src/lib.rs").write_text("fn main() {}\n")
+    return filter_dir
+
+
+def fake_cargo(builds, fail=()):
+    def exec_parallel(cmds, **kwargs):
+        for cmd in cmds.values():
+            builds.append(cmd)
+            if any(name in cmd for name in fail):
+                return util.EXIT_FAILURE
+            out_dir = Path(cmd.split("--out-dir ")[1].split()[0])
+            name = "agg_filter.wasm" if "agg/" in cmd else "filter.wasm"
+            out_dir.mkdir(exist_ok=True)
+            out_dir.joinpath(name).write_bytes(b"\0asm" + name.encode("utf-8"))
+        return util.EXIT_SUCCESS
+    return exec_parallel
+
+
+@pytest.mark.run_default
+def test_build_is_cached(filter_dir, monkeypatch):
+    builds = []
+    monkeypatch.setattr(util, "exec_parallel", fake_cargo(builds))
+    assert kube_env.build_filter(filter_dir) == util.EXIT_SUCCESS
+    assert len(builds) == 2
+    util.del_dir(filter_dir.joinpath("wasm_bins"))
+
+    # unchanged sources are restored without building
+    assert kube_env.build_filter(filter_dir) == util.EXIT_SUCCESS
+    assert len(builds) == 2
+    wasm = filter_dir.joinpath("wasm_bins/agg_filter.wasm").read_bytes()
+    assert wasm == b"\0asmagg_filter.wasm"
+
+    # any change of the sources is a miss
+    filter_dir.joinpath("src/lib.rs").write_text("fn main() { }\n")
+    assert kube_env.build_filter(filter_dir) == util.EXIT_SUCCESS
+    assert len(builds) == 4
+    stats = build_cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 2)
+
+
+@pytest.mark.run_default
+def test_unknown_toolchain_is_not_cached(filter_dir, monkeypatch):
+    monkeypatch.setattr(build_cache, "toolchain_version", lambda: None)
+    assert build_cache.cache_key(filter_dir, "") is None
+    assert not build_cache.restore(None, filter_dir.joinpath("wasm_bins"))
+
+
+@pytest.mark.run_default
+def test_evict(filter_dir):
+    out_dir = filter_dir.joinpath("wasm_bins")
+    out_dir.mkdir()
+    out_dir.joinpath("filter.wasm").write_bytes(b"x" * 100)
+    for key in ("old", "mid", "new"):
+        build_cache.store(key, out_dir)
+    meta_file = build_cache.CACHE_DIR.joinpath("old", build_cache.META_NAME)
+    meta = json.loads(meta_file.read_text())
+    meta["last_used"] = time.time() - 7200
+    meta_file.write_text(json.dumps(meta))
+    assert build_cache.evict(max_age=3600) == ["old"]
+    # least recently used first
+    build_cache.restore("mid", out_dir)
+    assert build_cache.evict(max_size=150) == ["new"]
+    assert [meta["key"] for meta in build_cache.entries()] == ["mid"]
+
+
+@pytest.mark.run_default
+def test_failed_optimization_is_not_cached(filter_dir, monkeypatch):
+    builds = []
+    monkeypatch.setattr(util, "exec_parallel", fake_cargo(builds))
+    monkeypatch.setenv("PATH", "")
+    assert kube_env.build_filter(filter_dir,
+                                 optimize="O3") == util.EXIT_SUCCESS
+    assert build_cache.entries() == []
+    util.del_dir(filter_dir.joinpath("wasm_bins"))
+    # neither an optimized nor a plain build can be restored from it
+    assert kube_env.build_filter(filter_dir,
+                                 optimize="O3") == util.EXIT_SUCCESS
+    assert kube_env.build_filter(filter_dir) == util.EXIT_SUCCESS
+    assert len(builds) == 6
+
+
+@pytest.mark.run_default
+def test_build_filters_reports_failures(filter_dir, tmp_path, monkeypatch):
+    builds = []
+    broken_dir = tmp_path.joinpath("broken")
+    broken_dir.mkdir()
+    monkeypatch.setattr(util, "exec_parallel",
+                        fake_cargo(builds, fail=[str(broken_dir)]))
+    futures = kube_env.build_filters([filter_dir, broken_dir, filter_dir])
+    assert list(futures) == [filter_dir, broken_dir]
+    assert kube_env.wait_for_builds(futures) == [broken_dir]
+    # the filter and its aggregation filter are built in one go
+    assert any("agg/Cargo.toml" in cmd for cmd in builds)
+    assert any("--target-dir " + str(filter_dir.joinpath("agg/target"))
+               in cmd for cmd in builds)
+
+
+@pytest.mark.run_default
+def test_key_covers_path_dependencies(filter_dir, tmp_path):
+    utils_dir = tmp_path.joinpath("libs/utils")
+    utils_dir.joinpath("src").mkdir(parents=True)
+    utils_dir.joinpath("Cargo.toml").write_text("[package]\n")
+    utils_dir.joinpath("src/lib.rs").write_text("pub fn f() {}\n")
+    filter_dir.joinpath("Cargo.toml").write_text(
+        "[dependencies]\nutils = { path = \"../libs/utils\" }\n")
+    key = build_cache.cache_key(filter_dir, "")
+    assert key is not None
+    # a change outside of the filter directory is a different build
+    utils_dir.joinpath("src/lib.rs").write_text("pub fn g() {}\n")
+    assert build_cache.cache_key(filter_dir, "") != key
+    # so is a dependency that cannot be found
+    util.del_dir(utils_dir)
+    assert build_cache.cache_key(filter_dir, "") is None
+
+
+@pytest.mark.run_default
+def test_concurrent_restores(filter_dir):
+    out_dir = filter_dir.joinpath("wasm_bins")
+    out_dir.mkdir()
+    out_dir.joinpath("filter.wasm").write_bytes(b"\0asm")
+    build_cache.store("key", out_dir)
+    # a corrupt stats file counts as empty
+    build_cache.CACHE_DIR.joinpath(build_cache.STATS_NAME).write_text("{\"hi")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        hits = list(executor.map(
+            lambda _: build_cache.restore("key", out_dir), range(64)))
+    assert all(hits)
+    assert build_cache.stats()["hits"] == 64
+    assert not list(build_cache.CACHE_DIR.rglob("*.tmp"))
@@ -0,0 +1,185 @@
+import json
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+import context_pool
+import gateway_cache
+import kube_env
+import kube_util as util
+import matrix
+import results_store
+import run_experiment
+
+# answers kubectl config view with a kubeconfig naming the context
+STUB_KUBECTL = """#!/bin/sh
+if [ "$2" = "current-context" ]; then echo "mk-a"; exit 0; fi
+context=""
+while [ $# -gt 0 ]; do
+    if [ "$1" = "--context" ]; then context="$2"; fi
+    shift
+done
+if [ "$context" = "broken" ]; then exit 1; fi
+provider=""
+case "$context" in mk-*) provider="minikube.sigs.k8s.io" ;; esac
+echo "{\\"current-context\\": \\"$context\\", \\"provider\\": \\"$provider\\"}"
+"""
+
+# stores one run per cell like run_experiment.py --attach would
+STUB_WORKER = """
+import json, os, sys, time
+sys.path.insert(0, {env_dir!r})
+import matrix, results_store
+args = sys.argv[1:]
+cells = json.load(open(args[args.index("--cells-file") + 1]))
+context = json.load(open(os.environ["KUBECONFIG"]))["current-context"]
+spec_file = args[args.index("--spec") + 1]
+checkpoint = matrix.checkpoint_file(spec_file)
+completed = {{}}
+start = time.time()
+time.sleep(0.3)
+for cell in cells:
+    run_dir = results_store.STORE_DIR.joinpath(cell.replace("/", "_"))
+    run_dir.mkdir(parents=True)
+    manifest = {{"run_id": run_dir.name, "started": start,
+                "application": "OB", "filter": cell.split("/")[2],
+                "params": {{}}, "path": str(run_dir), "columns": {{}}}}
+    run_dir.joinpath("manifest.json").write_text(json.dumps(manifest))
+    matrix.mark_completed(checkpoint, completed, {{"id": cell}}, 0)
+with open({log_file!r}, "a") as log:
+    log.write(json.dumps([context, os.getcwd(), start, time.time(),
+                          os.environ.get("KUBE_ENV_NAMESPACE"),
+                          os.environ.get("MINIKUBE_PROFILE")]) + "\\n")
+"""
+
+
+@pytest.fixture
+def pool(tmp_path, monkeypatch):
+    bin_dir = tmp_path.joinpath("bin")
+    bin_dir.mkdir()
+    kubectl = bin_dir.joinpath("kubectl")
+    kubectl.write_text(STUB_KUBECTL)
+    kubectl.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    store_dir = tmp_path.joinpath("results")
+    monkeypatch.setattr(results_store, "STORE_DIR", store_dir)
+    monkeypatch.setattr(gateway_cache, "STATE_FILE",
+                        tmp_path.joinpath("gateway.json"))
+    installs = []
+    monkeypatch.setattr(kube_env, "install_istio",
+                        lambda env: installs.append(env) or util.EXIT_SUCCESS)
+    log_file = tmp_path.joinpath("workers.jsonl")
+    worker = tmp_path.joinpath("worker.py")
+    worker.write_text(STUB_WORKER.format(
+        env_dir=str(context_pool.FILE_DIR), log_file=str(log_file)))
+    monkeypatch.setattr(context_pool, "WORKER", [sys.executable, str(worker)])
+    spec_file = tmp_path.joinpath("campaign.json")
+    spec_file.write_text(json.dumps({
+        "applications": ["OB"],
+        "filters": ["no_filter", "f1", "f2"],
+        "repetitions": 1}))
+    return spec_file, store_dir, log_file, installs
+
+
+@pytest.mark.run_default
+def test_split_units():
+    jobs = [{"application": app, "filter": filter_dir}
+            for app in ("A", "B") for filter_dir in ("f1", "f2", "f3")]
+    units = context_pool.split_units(jobs, 2)
+    assert [(unit["application"], [job["filter"] for job in unit["jobs"]])
+            for unit in units] == [("A", ["f1", "f3"]), ("A", ["f2"]),
+                                   ("B", ["f1", "f3"]), ("B", ["f2"])]
+
+
+@pytest.mark.run_default
+def test_cells_run_on_all_contexts(pool):
+    spec_file, store_dir, log_file, installs = pool
+    result = run_experiment.run_matrix(spec_file, contexts=["mk-a", "mk-b"])
+    assert result == util.EXIT_SUCCESS
+    workers = [json.loads(line) for line in log_file.read_text().splitlines()]
+    assert sorted(context for context, *_ in workers) == ["mk-a", "mk-b"]
+    # isolated working directories, running at the same time
+    assert len({cwd for _, cwd, *_ in workers}) == 2
+    (_, _, start_a, end_a, *_), (_, _, start_b, end_b, *_) = workers
+    assert start_a < end_b and start_b < end_a
+    # istio is installed once per context, by the runner
+    assert sorted(Path(env["KUBECONFIG"]).name for env in installs) == [
+        "mk-a.kubeconfig", "mk-b.kubeconfig"]
+    assert sorted(profile for *_, profile in workers) == ["mk-a", "mk-b"]
+    # the credentials do not stay in the results
+    assert not list(store_dir.rglob(f"*{context_pool.KUBECONFIG_NAME}"))
+
+    # one combined index and checkpoint
+    runs = results_store.query_runs(store_dir)
+    assert len(runs) == len(run_experiment.SCENARIOS["OB"]) * 3
+    assert all(run["path"].startswith(str(store_dir)) for run in runs)
+    manifest = results_store.load_manifest(runs[0]["run_id"], store_dir)
+    assert manifest["context"] in ("mk-a", "mk-b")
+    completed = matrix.load_checkpoint(matrix.checkpoint_file(spec_file))
+    assert len(completed) == len(runs)
+    assert {entry["context"] for entry in completed.values()} == {"mk-a",
+                                                                 "mk-b"}
+
+    # nothing is left to run
+    assert run_experiment.run_matrix(spec_file,
+                                     contexts=["mk-a"]) == util.EXIT_SUCCESS
+    assert len(log_file.read_text().splitlines()) == 2
+
+
+@pytest.mark.run_default
+def test_cells_run_in_namespaces(pool):
+    spec_file, store_dir, log_file, installs = pool
+    result = run_experiment.run_matrix(spec_file,
+                                       namespace_list=["exp-a", "exp-b"])
+    assert result == util.EXIT_SUCCESS
+    workers = [json.loads(line) for line in log_file.read_text().splitlines()]
+    # both instances share the cluster of the current context
+    assert sorted((context, namespace)
+                  for context, _, _, _, namespace, _ in workers) == [
+        ("mk-a", "exp-a"), ("mk-a", "exp-b")]
+    (_, _, start_a, end_a, *_), (_, _, start_b, end_b, *_) = workers
+    assert start_a < end_b and start_b < end_a
+    assert len(installs) == 1
+    runs = results_store.query_runs(store_dir)
+    manifests = [results_store.load_manifest(run["run_id"], store_dir)
+                 for run in runs]
+    assert {manifest["namespace"] for manifest in manifests} == {"exp-a",
+                                                                 "exp-b"}
+
+
+@pytest.mark.run_default
+def test_kubeconfig_is_private(pool, tmp_path):
+    kubeconfig = tmp_path.joinpath(context_pool.KUBECONFIG_NAME)
+    kubeconfig.write_text("stale")
+    kubeconfig.chmod(0o644)
+    assert context_pool.write_kubeconfig("mk-a",
+                                         kubeconfig) == util.EXIT_SUCCESS
+    assert kubeconfig.stat().st_mode & 0o777 == 0o600
+    assert json.loads(kubeconfig.read_text())["current-context"] == "mk-a"
+
+
+@pytest.mark.run_default
+def test_broken_context(pool):
+    spec_file, _, log_file, installs = pool
+    result = run_experiment.run_matrix(spec_file, contexts=["broken"])
+    assert result == util.EXIT_FAILURE
+    assert not log_file.exists()
+    assert not installs
+
+
+@pytest.mark.run_default
+def test_profile_only_for_minikube(tmp_path, monkeypatch):
+    monkeypatch.setenv("MINIKUBE_PROFILE", "runner")
+    kubeconfig = tmp_path.joinpath(context_pool.KUBECONFIG_NAME)
+    kubeconfig.write_text("clusters:\n- cluster:\n    extensions:\n"
+                          "    - extension:\n"
+                          "        provider: minikube.sigs.k8s.io\n")
+    env = context_pool.worker_env("mk-a", tmp_path)
+    assert env["MINIKUBE_PROFILE"] == "mk-a"
+    kubeconfig.write_text("current-context: gke_project_zone_cluster\n")
+    env = context_pool.worker_env("gke_project_zone_cluster", tmp_path)
+    assert "MINIKUBE_PROFILE" not in env
+    assert env["KUBECONFIG"] == str(kubeconfig)
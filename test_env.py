@@ -2,8 +2,9 @@ import logging
 from pathlib import Path
 
 import pytest
-import kubernetes_env.kube_util as util
-import kubernetes_env.kube_env as kube_env
+import kubernetes_env  # noqa: F401
+import kube_util as util
+import kube_env
 import query_tests
 
 # configure logging
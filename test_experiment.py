@@ -0,0 +1,71 @@
+import pytest
+
+import kubernetes_env  # noqa: F401
+import kube_util as util
+import run_experiment
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    calls = []
+
+    def call(name, result=util.EXIT_SUCCESS):
+        return lambda *args, **kwargs: calls.append(
+            (name, kwargs.get("output_file"))) or result
+
+    monkeypatch.setattr(run_experiment, "setup_application_deployment",
+                        call("setup"))
+    monkeypatch.setattr(run_experiment, "stop_kubernetes", call("stop"))
+    monkeypatch.setattr(run_experiment.kube_env, "reset_application",
+                        call("reset"))
+    monkeypatch.setattr(run_experiment, "start_benchmark", call("benchmark"))
+    return calls
+
+
+@pytest.mark.run_default
+def test_scenarios_share_cluster(calls):
+    result = run_experiment.online_boutique_experiment("MK", False, False,
+                                                      False, ["f"])
+    assert result == util.EXIT_SUCCESS
+    assert calls == [("setup", None),
+                     ("benchmark", "MKonline_boutique_view_cart"),
+                     ("reset", None),
+                     ("benchmark", "MKonline_boutique_add_to_cart"),
+                     ("stop", None)]
+
+
+@pytest.mark.run_default
+def test_fresh_cluster_per_scenario(calls):
+    run_experiment.online_boutique_experiment("MK", False, False, False,
+                                              ["f"], reuse_cluster=False)
+    assert [name for name, _ in calls] == ["setup", "benchmark", "stop",
+                                           "setup", "benchmark", "stop"]
+
+
+@pytest.mark.run_default
+def test_failed_reset_tears_down(calls, monkeypatch):
+    monkeypatch.setattr(run_experiment.kube_env, "reset_application",
+                        lambda: calls.append(("reset", None))
+                        or util.EXIT_FAILURE)
+    result = run_experiment.online_boutique_experiment("MK", False, False,
+                                                      False, ["f"])
+    assert result == util.EXIT_FAILURE
+    assert [name for name, _ in calls] == ["setup", "benchmark", "reset",
+                                           "stop"]
+
+
+@pytest.mark.run_default
+def test_failed_scenario_fails_run(calls, monkeypatch):
+    results = [util.EXIT_FAILURE, util.EXIT_SUCCESS]
+
+    def benchmark(*args, **kwargs):
+        calls.append(("benchmark", kwargs.get("output_file")))
+        return results.pop(0)
+
+    monkeypatch.setattr(run_experiment, "start_benchmark", benchmark)
+    result = run_experiment.online_boutique_experiment("MK", False, False,
+                                                      False, ["f"])
+    # the second scenario still runs, but the failure is not hidden
+    assert result == util.EXIT_FAILURE
+    assert [name for name, _ in calls] == ["setup", "benchmark", "reset",
+                                           "benchmark", "stop"]
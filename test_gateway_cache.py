@@ -0,0 +1,63 @@
+import pytest
+
+import kubernetes_env  # noqa: F401
+import gateway_cache
+
+
+@pytest.fixture
+def state_file(tmp_path, monkeypatch):
+    state_file = tmp_path.joinpath("gateway.json")
+    monkeypatch.setattr(gateway_cache, "STATE_FILE", state_file)
+    monkeypatch.setattr(gateway_cache, "ENTRIES", {})
+    kubeconfig = tmp_path.joinpath("kubeconfig")
+    kubeconfig.write_text("apiVersion: v1\ncurrent-context: mk-a\n")
+    monkeypatch.setenv("KUBECONFIG", str(kubeconfig))
+    monkeypatch.delenv("MINIKUBE_PROFILE", raising=False)
+    return state_file
+
+
+@pytest.mark.run_default
+def test_store_and_lookup(state_file, monkeypatch):
+    key = gateway_cache.cache_key("MK")
+    assert ":mk-a:" in key
+    assert gateway_cache.lookup(key) is None
+    gateway_cache.store(key, "10.0.0.1", 31380, "42")
+    assert gateway_cache.lookup(key)["port"] == "31380"
+    # another process reads it from the state file
+    monkeypatch.setattr(gateway_cache, "ENTRIES", {})
+    assert gateway_cache.lookup(key)["host"] == "10.0.0.1"
+    monkeypatch.setenv(gateway_cache.TTL_ENV, "0")
+    assert gateway_cache.lookup(key) is None
+    assert gateway_cache.lookup(key, expired_ok=True)["version"] == "42"
+
+
+@pytest.mark.run_default
+def test_no_address_is_not_cached(state_file):
+    key = gateway_cache.cache_key("GCP")
+    assert gateway_cache.store(key, "", "80") is None
+    assert gateway_cache.lookup(key) is None
+    assert not state_file.exists()
+
+
+@pytest.mark.run_default
+def test_invalidate_current_context(state_file, monkeypatch):
+    gateway_cache.store(gateway_cache.cache_key("MK"), "10.0.0.1", "80")
+    other = gateway_cache.cache_key("MK", "other:ctx:")
+    gateway_cache.store(other, "10.0.0.2", "80")
+    gateway_cache.invalidate()
+    assert gateway_cache.lookup(gateway_cache.cache_key("MK")) is None
+    # clusters of other contexts are still there
+    monkeypatch.setattr(gateway_cache, "ENTRIES", {})
+    assert gateway_cache.lookup(other)["host"] == "10.0.0.2"
+    gateway_cache.invalidate(other)
+    assert gateway_cache.load_state() == {}
+
+
+@pytest.mark.run_default
+def test_invalidate_context(state_file):
+    worker = gateway_cache.cache_key("MK", "/pool/unit0/kubeconfig:mk-b:mk-b")
+    gateway_cache.store(worker, "10.0.0.3", "80")
+    gateway_cache.store(gateway_cache.cache_key("MK"), "10.0.0.1", "80")
+    gateway_cache.invalidate_context("mk-b")
+    assert gateway_cache.lookup(worker) is None
+    assert gateway_cache.lookup(gateway_cache.cache_key("MK")) is not None
@@ -0,0 +1,101 @@
+import math
+import random
+
+import numpy as np
+import pytest
+
+import kubernetes_env  # noqa: F401
+from histogram import (LatencyHistogram, OutcomeHistograms, load_histograms,
+                       dump_histograms, status_outcome, SUCCESS, TIMEOUT,
+                       CONNECTION_ERROR)
+
+
+@pytest.mark.run_default
+def test_percentile_accuracy():
+    rng = random.Random(3)
+    latencies = [rng.lognormvariate(3, 1.2) for _ in range(20000)]
+    hist = LatencyHistogram()
+    for latency in latencies:
+        hist.record(latency)
+    assert hist.total == len(latencies)
+    ordered = sorted(latencies)
+    for percent in (50, 90, 99, 99.9):
+        # the nearest rank, the histogram does not interpolate
+        exact = ordered[math.ceil(percent / 100 * len(ordered)) - 1]
+        # one sub-bucket wide, 2^-7 of the value at 8 sub-bucket bits
+        assert hist.percentile(percent) == pytest.approx(exact, rel=1 / 128)
+    assert hist.percentile(0) == pytest.approx(min(latencies), abs=0.001)
+    assert hist.percentile(100) == pytest.approx(max(latencies), abs=0.001)
+    assert hist.mean() == pytest.approx(np.mean(latencies), rel=1e-4)
+
+
+@pytest.mark.run_default
+def test_small_values_are_exact_and_large_ones_clamped():
+    hist = LatencyHistogram()
+    for latency in (0.001, 0.1, 0.255):
+        hist.record(latency)
+    assert [low for low, _, _ in hist.buckets()] == [0.001, 0.1, 0.255]
+    assert LatencyHistogram().percentile(50) is None
+    hist.record(-5)
+    assert hist.percentile(0) == 0
+    hist.record(10 * 3600 * 1000)
+    assert hist.percentile(100) == 3600 * 1000
+
+
+@pytest.mark.run_default
+def test_merge_and_round_trip(tmp_path):
+    first, second, both = (LatencyHistogram() for _ in range(3))
+    for latency in range(1, 500):
+        (first if latency % 2 else second).record(latency)
+        both.record(latency)
+    merged = LatencyHistogram().merge(first).merge(second)
+    assert merged.to_dict() == both.to_dict()
+    assert LatencyHistogram.from_dict(both.to_dict()).percentile(99) == (
+        both.percentile(99))
+    result = OutcomeHistograms(10)
+    result.hists[SUCCESS] = both
+    path = tmp_path.joinpath("run.hist.json")
+    dump_histograms(path, {"f": result})
+    loaded = load_histograms(path)["f"]
+    assert loaded.duration == 10
+    assert loaded.get(SUCCESS).to_dict() == both.to_dict()
+
+
+@pytest.mark.run_default
+def test_status_outcome():
+    assert [status_outcome(status) for status in (200, 204, 302, 404, 503)] == [
+        SUCCESS, SUCCESS, "http_3xx", "http_4xx", "http_5xx"]
+
+
+@pytest.mark.run_default
+def test_goodput_and_error_rate():
+    result = OutcomeHistograms(duration=10)
+    assert result.goodput() == 0 and result.error_rate() == 0
+    for _ in range(80):
+        result.record(SUCCESS, 5)
+    for _ in range(15):
+        result.record(TIMEOUT, 3000)
+    for _ in range(5):
+        result.record("http_5xx", 1)
+    assert result.offered == 100
+    assert result.offered_rate() == 10
+    assert result.goodput() == 8
+    assert result.error_rate() == pytest.approx(0.2)
+    # censored timeouts only show up in the combined latencies
+    assert result.get(SUCCESS).percentile(99) == 5
+    assert result.combined().percentile(99) == 3000
+    assert result.get(CONNECTION_ERROR).total == 0
+    assert "error rate 20.00%" in result.summary()
+
+
+@pytest.mark.run_default
+def test_merged_outcomes():
+    first, second = OutcomeHistograms(10), OutcomeHistograms(12)
+    first.record(SUCCESS, 5)
+    second.record(SUCCESS, 7)
+    second.record(CONNECTION_ERROR, 1)
+    merged = OutcomeHistograms.from_dict(first.to_dict()).merge(second)
+    # workers ran side by side, the longest one is the duration
+    assert merged.duration == 12
+    assert merged.get(SUCCESS).total == 2
+    assert merged.error_rate() == pytest.approx(1 / 3)
@@ -0,0 +1,478 @@
+import base64
+import http.client
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+import gateway_cache
+import kube_client
+import kube_env
+import kube_util as util
+import namespaces
+import readiness
+import results_store
+import timing
+
+
+class FakeApiServer(ThreadingHTTPServer):
+    """ Records every request and answers from a dict of canned responses
+    keyed by (method, path).
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeApiHandler)
+        self.requests = []
+        self.responses = {}
+        # events streamed to watch requests, keyed by path
+        self.watch_events = {}
+        self.connections = set()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        self.server.connections.add(self.client_address)
+        self.server.requests.append({
+            "method": self.command,
+            "path": self.path,
+            "headers": dict(self.headers),
+            "body": json.loads(body) if body else None,
+        })
+        path = self.path.split("?")[0]
+        status, response = self.server.responses.get((self.command, path),
+                                                     (200, {}))
+        data = json.dumps(response).encode("utf-8")
+        if "watch=1" in self.path:
+            events = self.server.watch_events.get(path, [])
+            data = b"".join(json.dumps(event).encode("utf-8") + b"\n"
+                            for event in events)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def api_server():
+    server = FakeApiServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(api_server):
+    client = kube_client.KubeClient(api_server.url, token="secret")
+    kube_client.set_client(client)
+    yield client
+    client.close()
+    kube_client.set_client(None)
+
+
+def deployment_list(*names):
+    return {"items": [{"metadata": {"name": name}} for name in names]}
+
+
+@pytest.mark.run_default
+def test_requests_share_one_connection(api_server, client):
+    api_server.responses[("GET", "/apis/apps/v1/namespaces/default/"
+                          "deployments")] = (200, deployment_list("a", "b"))
+    for _ in range(5):
+        items = client.list("deployments", "default")
+    assert [item["metadata"]["name"] for item in items] == ["a", "b"]
+    assert len(api_server.requests) == 5
+    assert len(api_server.connections) == 1
+    headers = api_server.requests[0]["headers"]
+    assert headers["Authorization"] == "Bearer secret"
+
+
+@pytest.mark.run_default
+def test_patch_and_apply(api_server, client):
+    patch = {"spec": {"replicas": 2}}
+    client.patch_all("deployments", ["a", "b"], patch, "default")
+    manifest = {"apiVersion": "networking.istio.io/v1alpha3",
+                "kind": "EnvoyFilter",
+                "metadata": {"name": "f", "namespace": "default"}}
+    client.apply_all([manifest])
+    patches, applies = api_server.requests[:2], api_server.requests[2:]
+    assert [req["path"] for req in patches] == [
+        "/apis/apps/v1/namespaces/default/deployments/a",
+        "/apis/apps/v1/namespaces/default/deployments/b"]
+    assert all(req["body"] == patch for req in patches)
+    assert patches[0]["headers"]["Content-Type"] == (
+        "application/strategic-merge-patch+json")
+    assert applies[0]["method"] == "PATCH"
+    assert applies[0]["path"].startswith(
+        "/apis/networking.istio.io/v1alpha3/namespaces/default/"
+        "envoyfilters/f?fieldManager=")
+    assert applies[0]["headers"]["Content-Type"] == (
+        "application/apply-patch+yaml")
+    assert applies[0]["body"] == manifest
+
+
+@pytest.mark.run_default
+def test_errors_raise(api_server, client):
+    path = "/api/v1/namespaces/default/configmaps/missing"
+    api_server.responses[("GET", path)] = (404, {"message": "not found"})
+    with pytest.raises(kube_client.KubeApiError) as err:
+        client.get("configmaps", "missing", "default")
+    assert err.value.status == 404
+    assert not client.exists("configmaps", "missing", "default")
+
+
+@pytest.mark.run_default
+def test_kube_env_uses_client(api_server, client, tmp_path):
+    api_server.responses[("GET", "/apis/apps/v1/namespaces/default/"
+                          "deployments")] = (200, deployment_list("web"))
+    assert kube_env.get_deployments() == ["deployment.apps/web"]
+    assert kube_env.restart_deployments() == util.EXIT_SUCCESS
+    restarts = [req for req in api_server.requests if req["method"] == "PATCH"]
+    assert [req["path"] for req in restarts] == [
+        "/apis/apps/v1/namespaces/default/deployments/web",
+        "/apis/apps/v1/namespaces/storage/deployments/storage-upstream"]
+    annotations = restarts[0]["body"]["spec"]["template"]["metadata"][
+        "annotations"]
+    assert "kubectl.kubernetes.io/restartedAt" in annotations
+
+    # binary files go into binaryData like with kubectl --from-file
+    wasm_dir = tmp_path.joinpath("wasm_bins")
+    wasm_dir.mkdir()
+    wasm_dir.joinpath("filter.wasm").write_bytes(b"\0asm\xff")
+    wasm_dir.joinpath("agg_filter.wasm").write_bytes(b"\0asm\xfe")
+    assert kube_env.create_conf_map(tmp_path) == util.EXIT_SUCCESS
+    creates = [req for req in api_server.requests if req["method"] == "POST"]
+    assert [req["path"] for req in creates] == [
+        "/api/v1/namespaces/default/configmaps",
+        "/api/v1/namespaces/storage/configmaps"]
+    assert "filter.wasm" in creates[0]["body"]["binaryData"]
+
+
+@pytest.mark.run_default
+def test_fallback_without_client(monkeypatch):
+    monkeypatch.setenv(kube_client.USE_API_ENV, "0")
+    assert kube_client.with_fallback(lambda client: "api",
+                                     lambda: "kubectl") == "kubectl"
+
+
+def pod(name, ready, revision=None):
+    status = "True" if ready else "False"
+    annotations = {readiness.REVISION_ANNOTATION: revision} if revision else {}
+    return {"metadata": {"name": name, "annotations": annotations},
+            "status": {"phase": "Running",
+                       "conditions": [{"type": "Ready", "status": status}]}}
+
+
+@pytest.mark.run_default
+def test_wait_for_new_revision(api_server, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(results_store, "STORE_DIR", tmp_path)
+    pods_path = "/api/v1/namespaces/default/pods"
+    api_server.responses[("GET", pods_path)] = (200, {
+        "metadata": {"resourceVersion": "7"},
+        "items": [pod("web-old", True, "old")]})
+    # the old pod goes away and the new one becomes ready
+    api_server.watch_events[pods_path] = [
+        {"type": "ADDED", "object": pod("web-new", False, "new")},
+        {"type": "DELETED", "object": pod("web-old", True, "old")},
+        {"type": "MODIFIED", "object": pod("web-new", True, "new")},
+    ]
+    api_server.responses[("GET", "/api/v1/namespaces/default/endpoints")] = (
+        200, {"items": []})
+    start = time.time()
+    result = readiness.wait_for_application("new", timeout=10,
+                                            targets=[("default", None)])
+    assert result == util.EXIT_SUCCESS
+    assert time.time() - start < 5
+    watches = [req["path"] for req in api_server.requests
+               if "watch=1" in req["path"]]
+    assert watches[0].startswith(pods_path)
+    assert "resourceVersion=7" in watches[0]
+    phases = {line["phase"]: line for line in timing.load_timings()}
+    assert phases["ready"]["ready"]
+    assert "ready:web-new" in phases
+
+
+@pytest.mark.run_default
+def test_wait_gives_up(api_server, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(results_store, "STORE_DIR", tmp_path)
+    api_server.responses[("GET", "/api/v1/namespaces/default/pods")] = (
+        200, {"items": [pod("web", False)]})
+    result = readiness.wait_for_application(timeout=1,
+                                            targets=[("default", None)])
+    assert result == util.EXIT_FAILURE
+
+
+@pytest.mark.run_default
+def test_wait_for_port(api_server, tmp_path, monkeypatch):
+    monkeypatch.setattr(results_store, "STORE_DIR", tmp_path)
+    assert readiness.wait_for_port("127.0.0.1", api_server.server_address[1])
+    with socket.socket() as sock:
+        # a bound but not listening port refuses connections
+        sock.bind(("127.0.0.1", 0))
+        assert not readiness.wait_for_port("127.0.0.1",
+                                           sock.getsockname()[1], timeout=0.2)
+
+
+@pytest.mark.run_default
+def test_hot_swap_manifests():
+    manifests = kube_client.load_manifests(
+        kube_env.YAML_DIR.joinpath("filter.yaml"))
+    swapped = kube_env.hot_swap_manifests(manifests, "abc")
+    swapped = kube_env.hot_swap_manifests(swapped, "def")
+    vm_configs = [kube_env._vm_config(manifest) for manifest in swapped]
+    assert [vm["code"]["local"]["filename"] for vm in vm_configs] == [
+        f"{kube_env.WASM_MOUNT}/filter-def.wasm",
+        f"{kube_env.WASM_MOUNT}/agg_filter-def.wasm"]
+    assert vm_configs[0]["vm_id"] == "my-example-rev-def"
+    # the original manifests are left alone
+    assert kube_env._vm_config(manifests[0])["vm_id"] == "my-example"
+
+
+@pytest.mark.run_default
+def test_publish_module(api_server, client, tmp_path):
+    wasm_dir = tmp_path.joinpath("wasm_bins")
+    wasm_dir.mkdir()
+    wasm_dir.joinpath("filter.wasm").write_bytes(b"\0asm new")
+    path = "/api/v1/namespaces/default/configmaps/rs-filter"
+    api_server.responses[("GET", path)] = (200, {"binaryData": {
+        "filter-old.wasm": "AA==", "filter-older.wasm": "AA=="}})
+    new_module = kube_env.publish_module(client, tmp_path, "default",
+                                         "filter-old.wasm", "new")
+    assert new_module == "filter-new.wasm"
+    patch = api_server.requests[-1]
+    assert patch["headers"]["Content-Type"] == "application/merge-patch+json"
+    # the module in use stays, older versions are dropped
+    assert patch["body"]["binaryData"] == {
+        "filter-older.wasm": None,
+        "filter-new.wasm": base64.b64encode(b"\0asm new").decode("ascii")}
+
+
+@pytest.mark.run_default
+def test_swap_falls_back_to_restart(api_server, client, tmp_path,
+                                    monkeypatch):
+    monkeypatch.setattr(results_store, "STORE_DIR", tmp_path)
+    refreshed = []
+    monkeypatch.setattr(kube_env, "refresh_filter",
+                        lambda filter_dir, timeout: refreshed.append(
+                            filter_dir) or util.EXIT_SUCCESS)
+    # no EnvoyFilter deployed yet, nothing to swap
+    path = ("/apis/networking.istio.io/v1alpha3/namespaces/default/"
+            "envoyfilters/ui-examplefilter")
+    api_server.responses[("GET", path)] = (404, {"message": "not found"})
+    assert kube_env.swap_filter(tmp_path) == util.EXIT_SUCCESS
+    assert refreshed == [tmp_path]
+    total = [line for line in timing.load_timings()
+             if line["phase"] == "total"]
+    assert total[0]["kind"] == "swap_filter"
+    assert total[0]["mode"] == "restart"
+
+
+@pytest.mark.run_default
+def test_verify_reset(api_server, client):
+    deployments = "/apis/apps/v1/namespaces/default/deployments"
+    api_server.responses[("GET", deployments)] = (200, {"items": [
+        {"metadata": {"name": "web"}, "status": {"readyReplicas": 1}},
+        {"metadata": {"name": "db"}, "status": {"readyReplicas": 3}}]})
+    envoy_filter = ("/apis/networking.istio.io/v1alpha3/namespaces/default/"
+                    "envoyfilters/ui-examplefilter")
+    api_server.responses[("GET", envoy_filter)] = (404, {})
+    # the autoscaler has not scaled db back yet
+    assert kube_env.verify_reset() == util.EXIT_FAILURE
+    api_server.responses[("GET", deployments)] = (200, {"items": [
+        {"metadata": {"name": "web"}, "status": {"readyReplicas": 1}}]})
+    assert kube_env.verify_reset() == util.EXIT_SUCCESS
+    api_server.responses[("GET", envoy_filter)] = (200, {})
+    assert kube_env.verify_reset() == util.EXIT_FAILURE
+
+
+@pytest.mark.run_default
+def test_namespaced_instance(api_server, client, tmp_path, monkeypatch):
+    monkeypatch.setenv(namespaces.NAMESPACE_ENV, "exp-a")
+    api_server.responses[("GET", "/apis/apps/v1/namespaces/exp-a/"
+                          "deployments")] = (200, deployment_list("web"))
+    assert kube_env.restart_deployments() == util.EXIT_SUCCESS
+    wasm_dir = tmp_path.joinpath("wasm_bins")
+    wasm_dir.mkdir()
+    wasm_dir.joinpath("filter.wasm").write_bytes(b"\0asm\xff")
+    wasm_dir.joinpath("agg_filter.wasm").write_bytes(b"\0asm\xfe")
+    assert kube_env.create_conf_map(tmp_path) == util.EXIT_SUCCESS
+    paths = [req["path"] for req in api_server.requests
+             if req["method"] in ("PATCH", "POST")]
+    assert paths == [
+        "/apis/apps/v1/namespaces/exp-a/deployments/web",
+        "/apis/apps/v1/namespaces/exp-a-storage/deployments/storage-upstream",
+        "/api/v1/namespaces/exp-a/configmaps",
+        "/api/v1/namespaces/exp-a-storage/configmaps"]
+
+
+@pytest.mark.run_default
+def test_route_gateway(api_server, client, monkeypatch):
+    monkeypatch.setenv(namespaces.NAMESPACE_ENV, "exp-a")
+    istio = "/apis/networking.istio.io/v1alpha3/namespaces/exp-a"
+    api_server.responses[("GET", f"{istio}/gateways")] = (200, {"items": [
+        {"metadata": {"name": "gw"},
+         "spec": {"servers": [{"port": {"number": 80}, "hosts": ["*"]}]}}]})
+    api_server.responses[("GET", f"{istio}/virtualservices")] = (200, {
+        "items": [{"metadata": {"name": "ingress"},
+                   "spec": {"hosts": ["*"], "gateways": ["gw"]}},
+                  {"metadata": {"name": "mesh"},
+                   "spec": {"hosts": ["frontend"]}}]})
+    assert kube_env.route_gateway() == util.EXIT_SUCCESS
+    patches = {req["path"]: req["body"] for req in api_server.requests
+               if req["method"] == "PATCH"}
+    # services only reachable inside the mesh keep their hosts
+    assert patches == {
+        f"{istio}/gateways/gw": {"spec": {"servers": [
+            {"port": {"number": 80}, "hosts": ["exp-a.kube-env.local"]}]}},
+        f"{istio}/virtualservices/ingress": {"spec": {
+            "hosts": ["exp-a.kube-env.local"]}}}
+
+
+@pytest.mark.run_default
+def test_gateway_is_cached(api_server, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(gateway_cache, "STATE_FILE",
+                        tmp_path.joinpath("gateway.json"))
+    monkeypatch.setattr(gateway_cache, "ENTRIES", {})
+    path = "/api/v1/namespaces/istio-system/services/istio-ingressgateway"
+
+    def ingress(ip, version):
+        return (200, {"metadata": {"resourceVersion": version},
+                      "spec": {"ports": [{"name": "http2", "port": 80}]},
+                      "status": {"loadBalancer": {"ingress": [{"ip": ip}]}}})
+
+    api_server.responses[("GET", path)] = ingress("1.2.3.4", "7")
+    assert kube_env.get_gateway_info("GCP")[2] == "1.2.3.4:80"
+    assert kube_env.get_gateway_info("GCP")[2] == "1.2.3.4:80"
+    assert len(api_server.requests) == 1
+    # once expired, an unchanged service keeps the gateway
+    monkeypatch.setenv(gateway_cache.TTL_ENV, "0")
+    api_server.responses[("GET", path)] = ingress("5.6.7.8", "7")
+    assert kube_env.get_gateway_info("GCP")[2] == "1.2.3.4:80"
+    api_server.responses[("GET", path)] = ingress("5.6.7.8", "8")
+    assert kube_env.get_gateway_info("GCP")[2] == "5.6.7.8:80"
+    assert len(api_server.requests) == 3
+
+
+class DroppedConnection:
+    """ A keep-alive connection the server closed while it was idle. """
+
+    def __init__(self, sent):
+        self.sent = sent
+
+    def request(self, method, path, body=None, headers=None):
+        self.sent.append(method)
+
+    def getresponse(self):
+        raise http.client.RemoteDisconnected("closed")
+
+    def close(self):
+        pass
+
+
+@pytest.mark.run_default
+def test_only_idempotent_requests_are_repeated(api_server, client):
+    sent = []
+    client.conn = DroppedConnection(sent)
+    api_server.responses[("GET", "/api/v1/namespaces/default/configmaps/a")] = (
+        200, {"metadata": {"name": "a"}})
+    assert client.get("configmaps", "a", "default")["metadata"]["name"] == "a"
+    assert sent == ["GET"]
+    # the server may have created it before the connection broke
+    client.conn = DroppedConnection(sent)
+    with pytest.raises(http.client.RemoteDisconnected):
+        client.create("configmaps", {"metadata": {"name": "a"}}, "default")
+    assert sent == ["GET", "POST"]
+    assert not [req for req in api_server.requests if req["method"] == "POST"]
+
+
+@pytest.mark.run_default
+def test_conflict_is_not_repeated_with_kubectl(api_server, client, tmp_path):
+    path = "/api/v1/namespaces/default/configmaps"
+    api_server.responses[("POST", path)] = (409, {"message": "exists"})
+    tmp_path.joinpath("filter.wasm").write_bytes(b"\0asm")
+    client.create_configmap("rs-filter", [tmp_path.joinpath("filter.wasm")],
+                            "default")
+    assert [(req["method"], req["path"]) for req in api_server.requests] == [
+        ("POST", path), ("PUT", f"{path}/rs-filter")]
+
+    def conflict(client):
+        raise kube_client.KubeApiError(409, "exists")
+
+    fallbacks = []
+    with pytest.raises(kube_client.KubeApiError):
+        kube_client.with_fallback(conflict, lambda: fallbacks.append(True))
+    assert not fallbacks
+
+
+@pytest.mark.run_default
+def test_kubeconfig_keys_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(kube_client.tempfile, "tempdir", str(tmp_path))
+    config = {"clusters": [{"cluster": {
+        "server": "https://127.0.0.1:6443",
+        "certificate-authority-data": base64.b64encode(b"ca").decode()}}],
+        "users": [{"user": {
+            "client-certificate-data": base64.b64encode(b"cert").decode(),
+            "client-key-data": base64.b64encode(b"key").decode()}}]}
+    monkeypatch.setattr(kube_client.util, "get_output_from_proc",
+                        lambda *args, **kwargs: json.dumps(config).encode())
+    seen = []
+
+    class Client:
+        def __init__(self, server, ca_file=None, cert_file=None,
+                     key_file=None, **kwargs):
+            seen.extend(open(name, "rb").read()
+                        for name in (ca_file, cert_file, key_file))
+
+    monkeypatch.setattr(kube_client, "KubeClient", Client)
+    assert isinstance(kube_client.from_kubeconfig(), Client)
+    assert seen == [b"ca", b"cert", b"key"]
+    assert list(tmp_path.iterdir()) == []
+
+
+@pytest.mark.run_default
+def test_kubectl_waits_for_rollouts(tmp_path, monkeypatch):
+    monkeypatch.setattr(results_store, "STORE_DIR", tmp_path)
+    monkeypatch.setenv(kube_client.USE_API_ENV, "0")
+    web = pod("web-5d4f-x1", True, "old")
+    web["metadata"]["ownerReferences"] = [{"kind": "ReplicaSet",
+                                           "name": "web-5d4f"}]
+    job = pod("job-x1", False)
+    job["status"]["phase"] = "Succeeded"
+    pods = {"items": [web, dict(web), pod("debug", True), job]}
+    monkeypatch.setattr(util, "get_output_from_proc",
+                        lambda cmd, *args, **kwargs: json.dumps(pods).encode())
+    cmds = []
+
+    def exec_process(cmd, *args, **kwargs):
+        cmds.append(cmd)
+        return util.EXIT_SUCCESS
+
+    monkeypatch.setattr(util, "exec_process", exec_process)
+    result = readiness.wait_for_application("new", timeout=10,
+                                            targets=[("default", None)])
+    assert result == util.EXIT_SUCCESS
+    # the Ready pods of the old revision do not count, the rollout does
+    assert cmds[0].startswith(
+        "kubectl rollout status -n default deployment/web ")
+    assert cmds[1].startswith(
+        "kubectl wait --for=condition=Ready -n default pod/debug ")
+    assert len(cmds) == 2
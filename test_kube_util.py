@@ -0,0 +1,96 @@
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+import kube_util as util
+import namespaces
+
+
+class PortHandler(BaseHTTPRequestHandler):
+    """ Keeps connections open and records the client port of every
+    request.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.ports.append(self.client_address[1])
+        self.server.hosts.append(self.headers.get("Host"))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        if self.headers.get("Connection") == "close":
+            # like envoy, tell the client the connection is gone
+            self.send_header("Connection", "close")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PortHandler)
+    server.ports = []
+    server.hosts = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.run_default
+def test_commands_run_concurrently():
+    start = time.time()
+    cmds = {f"deployment{idx}": "sleep 0.5" for idx in range(4)}
+    assert util.exec_parallel(cmds, max_workers=4) == util.EXIT_SUCCESS
+    assert time.time() - start < 1.5
+    assert util.exec_parallel({}) == util.EXIT_SUCCESS
+
+
+@pytest.mark.run_default
+def test_first_failure_is_returned(caplog):
+    cmds = {"a": "exit 0", "b": "echo broken >&2; exit 3", "c": "exit 4"}
+    assert util.exec_parallel(cmds) == 3
+    assert "Failed targets: b, c" in caplog.text
+    assert "broken" in caplog.text
+    caplog.clear()
+    assert util.exec_parallel(cmds, allow_failures=True) == 3
+    assert not [record for record in caplog.records
+                if record.levelno >= logging.ERROR]
+
+
+@pytest.mark.run_default
+def test_single_worker_keeps_order(tmp_path):
+    out_file = tmp_path.joinpath("order")
+    cmds = {target: f"echo {target} >> {out_file}"
+            for target in ("c", "a", "b")}
+    assert util.exec_parallel(cmds, max_workers=1) == util.EXIT_SUCCESS
+    assert out_file.read_text().split() == ["c", "a", "b"]
+
+
+@pytest.mark.run_default
+def test_session_reuses_connections(server, monkeypatch):
+    monkeypatch.delenv(namespaces.NAMESPACE_ENV, raising=False)
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    with util.make_session(2) as session:
+        for _ in range(5):
+            assert session.get(url).status_code == 200
+    assert len(set(server.ports)) == 1
+    server.ports.clear()
+    with util.make_session(2, fresh_connections=True) as session:
+        for _ in range(5):
+            session.get(url)
+    assert len(set(server.ports)) == 5
+
+
+@pytest.mark.run_default
+def test_session_names_the_instance(server, monkeypatch):
+    monkeypatch.setenv(namespaces.NAMESPACE_ENV, "exp-a")
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    with util.make_session() as session:
+        session.get(url)
+    assert server.hosts == ["exp-a.kube-env.local"]
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+from benchmark import benchmark
+from histogram import CONNECTION_ERROR, OutcomeHistograms, SUCCESS, TIMEOUT
+
+
+class AppHandler(BaseHTTPRequestHandler):
+    """ Answers every request with 200, or with the status in the path.
+    /slow answers after half a second, /broken with a broken body.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        path = self.path.split("?")[0].strip("/")
+        if path == "slow":
+            time.sleep(0.5)
+            path = ""
+        if path == "broken":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            self.wfile.write(b"zz\r\n")
+            self.close_connection = True
+            return
+        status = int(path or 200)
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = do_POST = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def app_url():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), AppHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def lost_worker(idx, cpu, barrier, queue, *args):
+    if idx == 0:
+        queue.put((idx, OutcomeHistograms(1).to_dict(), 0.1))
+        queue.close()
+        queue.join_thread()
+        return
+    os._exit(1)
+
+
+@pytest.mark.run_default
+def test_sharded_loadgen_merges_workers(app_url, tmp_path):
+    records_file = str(tmp_path.joinpath("run.records.bin"))
+    hist = benchmark.run_sharded_loadgen(app_url, "MK", 2, 6, 1, "GET", 2,
+                                         records_file=records_file)
+    assert hist.get(SUCCESS).total == 6
+    assert hist.error_rate() == 0
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "run.w0.records.bin", "run.w1.records.bin"]
+
+
+@pytest.mark.run_default
+def test_sharded_loadgen_fails_on_lost_worker(monkeypatch):
+    monkeypatch.setattr(benchmark, "_loadgen_worker", lost_worker)
+    monkeypatch.setattr(benchmark, "WORKER_POLL", 0.1)
+    assert benchmark.run_sharded_loadgen("http://127.0.0.1:1", "MK", 1, 4, 1,
+                                         "GET", 2) is None
+
+
+@pytest.mark.run_default
+def test_broken_responses_are_errors(app_url):
+    hist = benchmark.run_loadgen(f"{app_url}/broken", "MK", 2, 4, 1, "GET")
+    assert hist.get(CONNECTION_ERROR).total == 4
+    assert hist.error_rate() == 1
+
+
+@pytest.mark.run_default
+def test_async_loadgen(app_url, tmp_path):
+    series_file = str(tmp_path.joinpath("run.series.csv"))
+    hist = benchmark.run_async_loadgen(app_url, "MK", 20, 1, "GET",
+                                       series_file=series_file)
+    assert hist.get(SUCCESS).total == 20
+    assert hist.offered_rate() == pytest.approx(20, rel=0.3)
+    assert tmp_path.joinpath("run.series.csv").exists()
+    hist = benchmark.run_async_loadgen(f"{app_url}/503", "MK", 10, 1, "POST")
+    assert hist.get("http_5xx").total == 10
+    assert hist.error_rate() == 1
+
+
+@pytest.mark.run_default
+def test_async_timeouts_count_from_send_time(app_url, monkeypatch):
+    monkeypatch.setattr(benchmark, "REQUEST_TIMEOUT", 0.2)
+    hist = benchmark.run_async_loadgen(f"{app_url}/slow", "MK", 5, 1, "GET")
+    timeouts = hist.get(TIMEOUT)
+    assert timeouts.total == 5
+    # not the constant timeout, but the time from the scheduled send
+    assert timeouts.percentile(0) >= 200
+    assert timeouts.percentile(100) > 200
+
+
+@pytest.mark.run_default
+def test_async_loadgen_needs_a_rate(app_url):
+    with pytest.raises(ValueError):
+        benchmark.run_async_loadgen(app_url, "MK", 0, 1, "GET")
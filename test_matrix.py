@@ -0,0 +1,127 @@
+import json
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+import kube_util as util
+import matrix
+import results_store
+import run_experiment
+
+SCENARIOS = {
+    "A": [{"output": "a1"}, {"output": "a2"}],
+    "B": [{"output": "b1"}],
+}
+
+
+def spec(**fields):
+    return matrix.validate_spec(dict({
+        "applications": ["A", {"name": "B"}],
+        "filters": ["f1", "no_filter", "f2"],
+        "loads": [{"qps": 10}, {"qps": 50, "threads": 4}],
+        "repetitions": 2}, **fields))
+
+
+@pytest.mark.run_default
+def test_expand_and_order():
+    jobs = matrix.order_jobs(matrix.expand(spec(), SCENARIOS))
+    assert len(jobs) == (2 + 1) * 3 * 2 * 2
+    assert len({job["id"] for job in jobs}) == len(jobs)
+    # one cluster per application and one deployment per filter
+    sequence = [(job["application"], job["filter"]) for job in jobs]
+    groups = [key for idx, key in enumerate(sequence)
+              if idx == 0 or sequence[idx - 1] != key]
+    assert groups == [("A", "no_filter"), ("A", "f1"), ("A", "f2"),
+                      ("B", "no_filter"), ("B", "f1"), ("B", "f2")]
+    assert jobs[0]["id"] == "A/a1/no_filter/q10t2/r0"
+    assert jobs[1]["id"] == "A/a1/no_filter/q10t2/r1"
+
+
+@pytest.mark.run_default
+def test_invalid_specs():
+    with pytest.raises(ValueError):
+        matrix.validate_spec({"applications": ["A"], "qps": 10})
+    with pytest.raises(ValueError):
+        matrix.expand(spec(applications=[{"name": "A",
+                                          "scenarios": ["a3"]}]), SCENARIOS)
+    selected = matrix.expand(spec(applications=[
+        {"name": "A", "scenarios": ["a2"]}]), SCENARIOS)
+    assert {job["scenario"]["output"] for job in selected} == {"a2"}
+
+
+@pytest.mark.run_default
+def test_load_toml_spec(tmp_path):
+    spec_file = tmp_path.joinpath("campaign.toml")
+    spec_file.write_text('applications = ["A"]\nfilters = ["filters/f"]\n'
+                         '[[loads]]\nqps = 20\n')
+    loaded = matrix.load_spec(spec_file)
+    assert loaded["filters"] == [str(tmp_path.joinpath("filters/f"))]
+    assert loaded["loads"] == [{"qps": 20, "threads": 2}]
+
+
+@pytest.mark.run_default
+def test_checkpoint_follows_spec_contents(tmp_path):
+    spec_file = tmp_path.joinpath("campaign.json")
+    spec_file.write_text(json.dumps({"applications": ["A"]}))
+    checkpoint = matrix.checkpoint_file(spec_file, tmp_path)
+    assert checkpoint.name.startswith("campaign-")
+    assert matrix.checkpoint_file(spec_file, tmp_path) == checkpoint
+    # a spec of the same name elsewhere resolves its filters elsewhere
+    other_dir = tmp_path.joinpath("other")
+    other_dir.mkdir()
+    for directory in (tmp_path, other_dir):
+        directory.joinpath("campaign.json").write_text(
+            json.dumps({"applications": ["A"], "filters": ["f"]}))
+    edited = matrix.checkpoint_file(spec_file, tmp_path)
+    assert edited != checkpoint
+    assert matrix.checkpoint_file(other_dir.joinpath("campaign.json"),
+                                  tmp_path) != edited
+
+
+@pytest.fixture
+def cluster(tmp_path, monkeypatch):
+    monkeypatch.setattr(results_store, "STORE_DIR", tmp_path)
+    calls = []
+    monkeypatch.setattr(run_experiment, "setup_application_deployment",
+                        lambda *args, **kwargs: calls.append("setup")
+                        or util.EXIT_SUCCESS)
+    monkeypatch.setattr(run_experiment, "stop_kubernetes",
+                        lambda *args: calls.append("stop"))
+    monkeypatch.setattr(run_experiment.kube_env, "reset_application",
+                        lambda: calls.append("reset") or util.EXIT_SUCCESS)
+    return calls
+
+
+@pytest.mark.run_default
+def test_matrix_resumes(tmp_path, cluster, monkeypatch):
+    spec_file = tmp_path.joinpath("campaign.json")
+    spec_file.write_text(json.dumps({
+        "applications": [{"name": "OB",
+                          "scenarios": ["online_boutique_view_cart"]}],
+        "filters": ["no_filter", "f1"], "repetitions": 2}))
+    benchmarks = []
+
+    def interrupted(filter_dirs, *args, **kwargs):
+        if len(benchmarks) == 3:
+            raise KeyboardInterrupt
+        benchmarks.append((filter_dirs, kwargs["deploy"]))
+        return util.EXIT_SUCCESS
+
+    monkeypatch.setattr(run_experiment, "start_benchmark", interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        run_experiment.run_matrix(spec_file)
+    # the filter is only deployed for its first cell
+    assert [deploy for _, deploy in benchmarks] == [False, False, True]
+    assert cluster == ["setup", "stop"]
+    checkpoint = matrix.load_checkpoint(matrix.checkpoint_file(spec_file))
+    assert len(checkpoint) == 3
+
+    monkeypatch.setattr(run_experiment, "start_benchmark",
+                        lambda filter_dirs, *args, **kwargs: benchmarks.append(
+                            (filter_dirs, kwargs["deploy"]))
+                        or util.EXIT_SUCCESS)
+    assert run_experiment.run_matrix(spec_file) == util.EXIT_SUCCESS
+    # a new cluster needs the filter again
+    assert benchmarks[3:] == [([str(tmp_path.joinpath("f1"))], True)]
+    assert run_experiment.run_matrix(spec_file) == util.EXIT_SUCCESS
+    assert len(benchmarks) == 4
@@ -0,0 +1,60 @@
+import pytest
+
+import kubernetes_env  # noqa: F401
+import namespaces
+import query_storage
+
+MANIFESTS = [
+    {"kind": "Deployment",
+     "metadata": {"name": "storage-upstream", "namespace": "storage"}},
+    {"kind": "Service",
+     "metadata": {"name": "storage-upstream", "namespace": "default"},
+     "spec": {"type": "ExternalName",
+              "externalName": "storage-upstream.storage.svc.cluster.local"}},
+    {"kind": "EnvoyFilter", "metadata": {"name": "root-cluster"}},
+]
+
+
+@pytest.mark.run_default
+def test_default_instance(monkeypatch):
+    monkeypatch.delenv(namespaces.NAMESPACE_ENV, raising=False)
+    assert namespaces.targets() == [("default", None),
+                                    ("storage", "app=storage-upstream")]
+    assert namespaces.gateway_host() is None
+    assert namespaces.gateway_headers() == {}
+    rewritten = namespaces.rewrite(MANIFESTS)
+    assert [manifest["metadata"]["namespace"] for manifest in rewritten] == [
+        "storage", "default", "default"]
+    assert rewritten[1]["spec"]["externalName"] == (
+        "storage-upstream.storage.svc.cluster.local")
+
+
+@pytest.mark.run_default
+def test_isolated_instance(monkeypatch):
+    monkeypatch.setenv(namespaces.NAMESPACE_ENV, "exp-a")
+    assert namespaces.targets() == [("exp-a", None),
+                                    ("exp-a-storage", "app=storage-upstream")]
+    assert namespaces.gateway_headers() == {"Host": "exp-a.kube-env.local"}
+    rewritten = namespaces.rewrite(MANIFESTS)
+    assert [manifest["metadata"]["namespace"] for manifest in rewritten] == [
+        "exp-a-storage", "exp-a", "exp-a"]
+    # the application reaches its own storage
+    assert rewritten[1]["spec"]["externalName"] == (
+        "storage-upstream.exp-a-storage.svc.cluster.local")
+    # the loaded manifests stay as they are
+    assert MANIFESTS[0]["metadata"]["namespace"] == "storage"
+    assert "namespace" not in MANIFESTS[2]["metadata"]
+
+
+@pytest.mark.run_default
+def test_storage_ports(monkeypatch):
+    monkeypatch.setattr(query_storage, "PORTS", {})
+    monkeypatch.delenv(namespaces.NAMESPACE_ENV, raising=False)
+    assert query_storage.storage_port() == query_storage.STORAGE_PORT
+    ports = []
+    for namespace in ("exp-a", "exp-b"):
+        monkeypatch.setenv(namespaces.NAMESPACE_ENV, namespace)
+        ports.append(query_storage.storage_port())
+        # stable until the next port-forward
+        assert query_storage.storage_port() == ports[-1]
+    assert len(set(ports + [query_storage.STORAGE_PORT])) == 3
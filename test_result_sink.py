@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+import kubernetes_env  # noqa: F401
+import result_sink
+import results_store
+from histogram import OutcomeHistograms, SUCCESS, TIMEOUT
+
+
+RECORDS = [(100.0, 12.5, SUCCESS), (100.5, 3000.0, TIMEOUT),
+           (101.0, 40.25, "http_5xx"), (101.5, 7.0, SUCCESS),
+           (102.0, 1.0, "http_999")]
+
+
+@pytest.fixture
+def fsyncs(monkeypatch):
+    fsyncs = []
+    monkeypatch.setattr(result_sink.os, "fsync", fsyncs.append)
+    return fsyncs
+
+
+def write(path, records):
+    sink = result_sink.ResultSink(str(path))
+    for record in records:
+        sink.record(*record)
+    sink.close()
+
+
+@pytest.mark.run_default
+def test_round_trip(tmp_path):
+    path = tmp_path.joinpath("run.records.bin")
+    write(path, RECORDS)
+    records = result_sink.read_records(path)
+    assert records["sent_at"].tolist() == [100.0, 100.5, 101.0, 101.5, 102.0]
+    assert records["latency_ms"].tolist() == [12.5, 3000.0, 40.25, 7.0, 1.0]
+    assert [result_sink.OUTCOMES[code] for code in records["outcome"]] == [
+        SUCCESS, TIMEOUT, "http_5xx", SUCCESS, "http_other"]
+    hist = result_sink.histograms_from_records(path)
+    assert hist.get(SUCCESS).total == 2
+    assert hist.get(TIMEOUT).percentile(100) == 3000
+    # from the first send to the end of the timed out request
+    assert hist.duration == pytest.approx(3.5)
+
+
+@pytest.mark.run_default
+def test_torn_record_is_ignored(tmp_path):
+    path = tmp_path.joinpath("run.records.bin")
+    write(path, RECORDS[:2])
+    with open(path, "ab") as records:
+        records.write(b"\x01\x02\x03")
+    assert len(result_sink.read_records(path)) == 2
+
+
+@pytest.mark.run_default
+def test_fsync_is_batched(tmp_path, fsyncs, monkeypatch):
+    monkeypatch.setattr(result_sink, "FLUSH_RECORDS", 10)
+    monkeypatch.setattr(result_sink, "FLUSH_INTERVAL", 3600)
+    path = tmp_path.joinpath("run.records.bin")
+    sink = result_sink.ResultSink(str(path))
+    for idx in range(25):
+        sink.record(float(idx), 1.0, SUCCESS)
+    assert len(fsyncs) == 2
+    assert len(result_sink.read_records(path)) == 20
+    sink.close()
+    assert len(fsyncs) == 3
+    assert len(result_sink.read_records(path)) == 25
+
+
+@pytest.mark.run_default
+def test_fsync_after_interval(tmp_path, fsyncs, monkeypatch):
+    monkeypatch.setattr(result_sink, "FLUSH_INTERVAL", 0)
+    sink = result_sink.ResultSink(str(tmp_path.joinpath("run.records.bin")))
+    sink.record(1.0, 1.0, SUCCESS)
+    sink.record(2.0, 1.0, SUCCESS)
+    assert len(fsyncs) == 2
+    sink.close()
+
+
+@pytest.mark.run_default
+def test_histograms_match_record_by_record(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_sink, "READ_CHUNK", 1000)
+    rng = np.random.default_rng(7)
+    latencies = rng.lognormal(3, 1.5, 5000)
+    outcomes = rng.choice([SUCCESS, TIMEOUT, "http_4xx"], 5000)
+    path = tmp_path.joinpath("run.records.bin")
+    write(path, [(float(idx), lat, outcome) for idx, (lat, outcome)
+                 in enumerate(zip(latencies, outcomes))])
+    expected = OutcomeHistograms()
+    for _, latency, code in result_sink.read_records(path).tolist():
+        expected.record(result_sink.OUTCOMES[code], latency)
+    hist = result_sink.histograms_from_records(path)
+    assert {outcome: h.to_dict() for outcome, h in hist.hists.items()} == {
+        outcome: h.to_dict() for outcome, h in expected.hists.items()}
+
+
+@pytest.mark.run_default
+def test_shards_are_stored_as_one_run(tmp_path):
+    write(tmp_path.joinpath("run.w0.records.bin"), RECORDS[:3])
+    write(tmp_path.joinpath("run.w1.records.bin"), RECORDS[3:])
+    path = tmp_path.joinpath("run.records.bin")
+    columns = result_sink.records_to_columns(path)
+    assert [len(chunk) for chunk in columns["latency_ms"]] == [3, 2]
+    assert result_sink.histograms_from_records(path).offered == 5
+    store_dir = tmp_path.joinpath("results")
+    run_id = results_store.save_run(columns, "app", "MK", "f", "loadgen",
+                                    {}, 100.0, store_dir=store_dir)
+    stored = results_store.load_columns(run_id, store_dir=store_dir)
+    assert stored["sent_at"].tolist() == [100.0, 100.5, 101.0, 101.5, 102.0]
+    assert stored["outcome"].dtype == np.uint8
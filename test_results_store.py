@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+import kubernetes_env  # noqa: F401
+import results_store
+
+
+@pytest.fixture
+def store_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(results_store, "git_revision", lambda: "abc")
+    return tmp_path.joinpath("results")
+
+
+def save(store_dir, filter_name, latencies, load_generator="loadgen",
+         started=100.0):
+    columns = {"latency_ms": np.array(latencies, dtype=np.float32)}
+    if load_generator != "loadgen":
+        columns = {"Latency (ms)": np.array(latencies),
+                   "Percent": np.linspace(0, 100, len(latencies))}
+    return results_store.save_run(columns, "online_boutique_benchmark", "MK",
+                                  filter_name, load_generator, {"qps": 10},
+                                  started, store_dir=store_dir)
+
+
+@pytest.mark.run_default
+def test_save_and_query(store_dir):
+    first = save(store_dir, "no_filter", [1, 2, 3])
+    second = save(store_dir, "rs-empty-filter", [4, 5], started=200.0)
+    runs = results_store.query_runs(store_dir)
+    assert [run["run_id"] for run in runs] == [first, second]
+    assert runs[0]["params"] == {"qps": 10}
+    assert runs[0]["git_revision"] == "abc"
+    runs = results_store.query_runs(store_dir, filter="rs-empty-filter")
+    assert [run["run_id"] for run in runs] == [second]
+    with pytest.raises(ValueError):
+        results_store.query_runs(store_dir, latency=1)
+    columns = results_store.load_columns(first, store_dir=store_dir)
+    assert columns["latency_ms"].tolist() == [1, 2, 3]
+
+
+@pytest.mark.run_default
+def test_compare(store_dir):
+    base = save(store_dir, "no_filter", range(1, 101))
+    other = save(store_dir, "rs-empty-filter", range(101, 201))
+    rows = results_store.compare([base, other], store_dir=store_dir)
+    assert [row["filter"] for row in rows] == ["no_filter", "rs-empty-filter"]
+    assert [row["samples"] for row in rows] == [100, 100]
+    assert rows[0]["p50"] == pytest.approx(50.5)
+    assert rows[1]["p99"] == pytest.approx(199.01)
+
+
+@pytest.mark.run_default
+def test_compare_missing_column(store_dir):
+    base = save(store_dir, "no_filter", [1, 2, 3])
+    fortio = save(store_dir, "no_filter", [1, 2, 3], "fortio")
+    with pytest.raises(ValueError, match="fortio.*Latency \\(ms\\)"):
+        results_store.compare([base, fortio], store_dir=store_dir)
+    rows = results_store.compare([fortio], "Latency (ms)",
+                                 store_dir=store_dir)
+    assert rows[0]["p50"] == 2
+
+
+@pytest.mark.run_default
+def test_import_and_rebuild(store_dir, tmp_path):
+    worker_dir = tmp_path.joinpath("worker")
+    run_id = save(worker_dir, "no_filter", [1, 2])
+    assert results_store.import_runs(worker_dir, store_dir,
+                                     extra={"context": "mk-a"}) == [run_id]
+    assert not worker_dir.joinpath(run_id).exists()
+    manifest = results_store.load_manifest(run_id, store_dir)
+    assert manifest["context"] == "mk-a"
+    assert manifest["path"] == str(store_dir.joinpath(run_id))
+    store_dir.joinpath(results_store.INDEX_NAME).unlink()
+    assert results_store.query_runs(store_dir) == []
+    results_store.rebuild_index(store_dir)
+    assert [run["run_id"] for run in results_store.query_runs(store_dir)] == [
+        run_id]
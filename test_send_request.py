@@ -0,0 +1,100 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+import kube_env
+import send_request
+
+
+class GatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self):
+        with self.server.lock:
+            self.server.active += 1
+            self.server.peak = max(self.server.peak, self.server.active)
+            self.server.requests.append((self.command, self.path))
+        time.sleep(0.05)
+        with self.server.lock:
+            self.server.active -= 1
+        status = 200 if self.path == "/productpage" else 404
+        self.send_response(status)
+        self.send_header("x-request-id", f"id-{len(self.server.requests)}")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_GET = do_HEAD = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), GatewayHandler)
+    server.lock = threading.Lock()
+    server.active = server.peak = 0
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    port = str(server.server_address[1])
+    monkeypatch.setattr(kube_env, "get_gateway_info",
+                        lambda platform: ("127.0.0.1", port,
+                                          f"127.0.0.1:{port}"))
+    monkeypatch.setattr(send_request, "SESSIONS", {})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.run_default
+def test_batch(gateway):
+    rows = send_request.send_requests(count=8, concurrency=4)
+    assert [row["status"] for row in rows] == [200] * 8
+    assert gateway.peak > 1
+    assert all(row["headers"]["x-request-id"].startswith("id-")
+               for row in rows)
+    table = send_request.format_table(rows).splitlines()
+    assert table[0].split() == ["#", "status", "ms", "x-request-id",
+                                "x-envoy-upstream-service-time"]
+    assert len(table) == 9
+    assert send_request.summarize(rows).startswith("8/8 ok, p50")
+
+
+@pytest.mark.run_default
+def test_invocations_share_the_pool(gateway):
+    send_request.send_requests(count=2, concurrency=2, method="HEAD",
+                               path="/missing")
+    session = send_request.get_session()
+    rows = send_request.send_requests(count=2, concurrency=2,
+                                      path="missing", method="HEAD")
+    assert send_request.get_session() is session
+    assert [row["status"] for row in rows] == [404, 404]
+    assert gateway.requests[-1] == ("HEAD", "/missing")
+    assert send_request.summarize(rows).startswith("0/2 ok")
+    # a larger batch gets a larger pool
+    send_request.send_requests(count=20, concurrency=20)
+    assert send_request.SESSIONS[False][1] == 20
+    # fresh connections are not reused, but their session is
+    fresh = send_request.get_session(fresh_connections=True)
+    assert fresh is not session
+    assert fresh.headers["Connection"] == "close"
+    send_request.send_requests(count=2, concurrency=2,
+                               fresh_connections=True)
+    assert send_request.get_session(fresh_connections=True) is fresh
+
+
+@pytest.mark.run_default
+def test_unreachable_gateway(monkeypatch):
+    monkeypatch.setattr(kube_env, "get_gateway_info",
+                        lambda platform: ("127.0.0.1", "9", "127.0.0.1:9"))
+    forgotten = []
+    monkeypatch.setattr(send_request, "forget_gateway",
+                        lambda platform, err: forgotten.append(platform))
+    rows = send_request.send_requests("MK", count=2, concurrency=2)
+    assert [row["error"] for row in rows] == ["ConnectionError"] * 2
+    assert forgotten == ["MK"]
+    assert "ConnectionError" in send_request.format_table(rows)
@@ -0,0 +1,55 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+FILE_DIR = Path.resolve(Path(__file__)).parent
+ENV_DIR = FILE_DIR.joinpath("kubernetes_env")
+# seconds an entry point may take to print its help, the plotting and
+# analysis stack must not be part of this
+STARTUP_BUDGET = {
+    "kube_env.py": 0.5,
+    "run_experiment.py": 0.5,
+    "benchmark/benchmark.py": 0.5,
+    "query_storage.py": 0.5,
+    "send_request.py": 0.5,
+}
+# modules that are only needed once something is plotted or transformed
+HEAVY_MODULES = ["pandas", "numpy", "seaborn", "matplotlib", "requests",
+                 "aiohttp"]
+
+
+def measure_startup(entry_point, runs=3):
+    # the best of a few runs, to keep a busy machine from failing the test
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, str(ENV_DIR.joinpath(entry_point)),
+                        "--help"],
+                       check=True, stdout=subprocess.DEVNULL, cwd=ENV_DIR)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+@pytest.mark.run_default
+@pytest.mark.parametrize("entry_point", sorted(STARTUP_BUDGET))
+def test_startup_budget(entry_point):
+    elapsed = measure_startup(entry_point)
+    assert elapsed < STARTUP_BUDGET[entry_point], (
+        f"{entry_point} took {elapsed:.2f}s to start")
+
+
+@pytest.mark.run_default
+@pytest.mark.parametrize("entry_point", sorted(STARTUP_BUDGET))
+def test_no_heavy_imports(entry_point):
+    module = Path(entry_point).stem
+    module_dir = ENV_DIR.joinpath(entry_point).parent
+    code = (f"import sys; sys.path[:0] = [{str(ENV_DIR)!r}, "
+            f"{str(module_dir)!r}]; import {module}; "
+            f"print(' '.join(m for m in {HEAVY_MODULES!r} "
+            "if m in sys.modules))")
+    res = subprocess.run([sys.executable, "-c", code], check=True,
+                         stdout=subprocess.PIPE, cwd=ENV_DIR)
+    assert res.stdout.decode("utf-8").strip() == ""
@@ -0,0 +1,80 @@
+import csv
+import threading
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+from benchmark import benchmark
+from timeseries import TimeSeries, TimeSeriesWriter
+
+
+@pytest.mark.run_default
+def test_seconds_roll_up():
+    series = TimeSeries(100.0)
+    for offset in (0.1, 0.5, 0.9, 1.2):
+        series.offered(100 + offset)
+    series.completed(100.4, 10)
+    series.completed(100.95, 30)
+    # completed in the next second, counted there
+    series.completed(101.1, 20)
+    series.completed(101.3, timeout=True)
+    series.completed(101.4)
+    # sent before the start, counted in the first second
+    series.offered(99.0)
+    first, second = series.pop_rows()
+    assert (first["second"], first["offered"], first["achieved"]) == (0, 4, 2)
+    assert first["p50"] == pytest.approx(10, rel=1 / 128)
+    assert first["max"] == 30
+    assert (second["second"], second["offered"], second["achieved"],
+            second["errors"], second["timeouts"]) == (1, 1, 1, 1, 1)
+    assert series.pop_rows() == []
+
+
+@pytest.mark.run_default
+def test_only_finished_seconds_are_popped():
+    series = TimeSeries(0.0)
+    for timestamp in (0.5, 1.5, 2.5, 3.5):
+        series.offered(timestamp)
+    # the current second is not over yet
+    assert [row["second"] for row in series.pop_rows(now=2.1)] == [0, 1]
+    # one second left for late responses
+    assert [row["second"] for row in series.pop_rows(now=4.0,
+                                                     grace=1)] == [2]
+    assert [row["second"] for row in series.pop_rows()] == [3]
+
+
+@pytest.mark.run_default
+def test_concurrent_recording():
+    series = TimeSeries(0.0)
+
+    def send():
+        for _ in range(1000):
+            series.offered(0.5)
+            series.completed(0.5, 1)
+
+    threads = [threading.Thread(target=send) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    row, = series.pop_rows()
+    assert (row["offered"], row["achieved"]) == (4000, 4000)
+
+
+@pytest.mark.run_default
+def test_writer_and_sharded_series(tmp_path):
+    for idx, offered in enumerate((3, 5)):
+        series = TimeSeries(0.0)
+        for _ in range(offered):
+            series.offered(0.5)
+            series.completed(0.6, 10 * (idx + 1))
+        writer = TimeSeriesWriter(tmp_path.joinpath(f"run.w{idx}.series.csv"))
+        writer.write([])
+        writer.write(series.pop_rows())
+        writer.close()
+    with open(tmp_path.joinpath("run.w0.series.csv")) as csv_file:
+        assert [row["offered"] for row in csv.DictReader(csv_file)] == ["3"]
+    merged = benchmark.load_series(tmp_path.joinpath("run.series.csv"))
+    # counts add up, percentiles are those of the worst worker
+    assert merged["offered"].tolist() == [8]
+    assert merged["p99"].tolist() == [20]
@@ -0,0 +1,84 @@
+import threading
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+import results_store
+import timing
+
+
+@pytest.fixture(autouse=True)
+def store_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(results_store, "STORE_DIR", tmp_path)
+    return tmp_path
+
+
+@pytest.mark.run_default
+def test_phases_share_run_id():
+    with timing.run("refresh_filter", filter="f") as run:
+        with timing.phase("configmap_create"):
+            pass
+        # nested runs are part of the outer one
+        with timing.run("swap_filter"):
+            with timing.phase("patch_application") as patch:
+                patch["result"] = 0
+        run["result"] = 0
+    lines = timing.load_timings()
+    assert [line["phase"] for line in lines] == [
+        "configmap_create", "patch_application", "total"]
+    assert len({line["run_id"] for line in lines}) == 1
+    assert all(line["kind"] == "refresh_filter" for line in lines)
+    assert lines[1]["result"] == 0
+    assert lines[2]["filter"] == "f"
+    assert timing.RUN.get() is None
+
+
+@pytest.mark.run_default
+def test_concurrent_runs_are_apart():
+    started = threading.Barrier(2)
+
+    def run(kind):
+        with timing.run(kind):
+            # both runs are open at the same time
+            started.wait()
+            with timing.phase("ready"):
+                pass
+            started.wait()
+
+    threads = [threading.Thread(target=run, args=(kind, ))
+               for kind in ("setup", "refresh_filter")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    lines = timing.load_timings()
+    assert len(lines) == 4
+    runs = {}
+    for line in lines:
+        runs.setdefault(line["kind"], set()).add(line["run_id"])
+    assert sorted(runs) == ["refresh_filter", "setup"]
+    assert all(len(run_ids) == 1 for run_ids in runs.values())
+    assert runs["setup"] != runs["refresh_filter"]
+
+
+@pytest.mark.run_default
+def test_failed_phase_is_recorded():
+    with pytest.raises(RuntimeError):
+        with timing.run("setup"):
+            with timing.phase("cluster_start"):
+                raise RuntimeError("no cluster")
+    lines = timing.load_timings()
+    assert [line.get("error") for line in lines] == [True, True]
+    # a phase outside of any run is a run of its own
+    timing.record("ready", 1.0)
+    assert timing.load_timings()[-1]["kind"] == "ready"
+
+
+@pytest.mark.run_default
+def test_summarize():
+    for duration in range(1, 21):
+        timing.record("ready", duration)
+    summary = timing.summarize(timing.load_timings())
+    assert summary == [{"kind": "ready", "phase": "ready", "count": 20,
+                        "p50": 10, "p95": 19, "max": 20}]
+    assert timing.summarize(timing.load_timings(), "setup") == []
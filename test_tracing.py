@@ -0,0 +1,81 @@
+import json
+import subprocess
+import time
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+import kube_util as util
+import results_store
+import timing
+import tracing
+
+
+@pytest.fixture
+def trace_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(results_store, "STORE_DIR", tmp_path)
+    trace_file = tmp_path.joinpath("trace.json")
+    tracing.enable(trace_file)
+    yield trace_file
+    tracing.disable()
+
+
+def spans_by_name():
+    return {span["name"]: span for span in tracing.SPANS}
+
+
+@pytest.mark.run_default
+def test_commands_are_traced(trace_file):
+    with timing.phase("configmap_create"):
+        util.exec_process("echo hello", stdout=subprocess.PIPE)
+        util.exec_parallel({"a": "true", "b": "false"}, allow_failures=True)
+    assert util.get_output_from_proc("printf abc") == b"abc"
+    proc = util.start_process("sleep 0.1")
+    proc.wait()
+    for _ in range(50):
+        if "sleep" in spans_by_name():
+            break
+        time.sleep(0.01)
+    spans = spans_by_name()
+    assert spans["echo"]["parent"] == "configmap_create"
+    assert spans["echo"]["attrs"]["output_size"] == len(b"hello\n")
+    # commands in worker threads still belong to the phase
+    assert spans["false"]["parent"] == "configmap_create"
+    assert spans["false"]["attrs"]["exit_code"] == 1
+    assert spans["printf"]["parent"] is None
+    assert spans["sleep"]["end"] - spans["sleep"]["start"] >= 0.1 * 1e9
+
+
+@pytest.mark.run_default
+def test_chrome_trace(trace_file):
+    with timing.run("refresh_filter"):
+        util.exec_process("true")
+    assert tracing.flush() == trace_file
+    events = json.loads(trace_file.read_text())["traceEvents"]
+    assert [event["name"] for event in events] == ["refresh_filter", "true"]
+    assert all(event["ph"] == "X" for event in events)
+    assert events[1]["args"]["parent"] == "refresh_filter"
+    assert events[1]["ts"] >= events[0]["ts"]
+
+
+@pytest.mark.run_default
+def test_otlp_trace(trace_file):
+    tracing.enable(trace_file, "otlp")
+    with tracing.span("setup"):
+        util.exec_process("exit 3", allow_failures=True)
+    tracing.flush()
+    trace = json.loads(trace_file.read_text())
+    spans = trace["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    setup, command = spans
+    assert command["parentSpanId"] == setup["spanId"]
+    assert command["traceId"] == setup["traceId"]
+    assert command["status"]["code"] == 2
+    attributes = {attr["key"]: attr["value"] for attr in command["attributes"]}
+    assert attributes["exit_code"] == {"intValue": "3"}
+
+
+@pytest.mark.run_default
+def test_disabled_records_nothing():
+    assert not tracing.enabled()
+    util.exec_process("true")
+    assert tracing.flush() is None
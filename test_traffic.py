@@ -0,0 +1,116 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+import traffic
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    """ Answers every request after a quarter of a second. """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(0.25)
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def killed_loop(url, profile, fresh_connections, stop_event, queue):
+    queue.put({"second": 0})
+    queue.close()
+    queue.join_thread()
+    # dies without sending the end of the run
+    os._exit(3)
+
+
+@pytest.mark.run_default
+def test_rate_functions():
+    step = {"type": "step", "levels": [10, 20, 40], "hold": 2}
+    assert [traffic.step_rate(step, t) for t in (0, 1.9, 2, 5, 9)] == [
+        10, 10, 20, 40, 40]
+    assert traffic.phase_duration(step) == 6
+    ramp = {"type": "ramp", "start": 0, "end": 100, "duration": 10}
+    assert traffic.ramp_rate(ramp, 0) == 0
+    assert traffic.ramp_rate(ramp, 5) == 50
+    square = {"type": "square", "low": 1, "high": 9, "period": 4,
+              "duration": 8}
+    assert [traffic.square_rate(square, t) for t in (0, 1.9, 2, 3.9, 4)] == [
+        9, 9, 1, 1, 9]
+    square["duty"] = 0.25
+    assert traffic.square_rate(square, 1) == 1
+    spike = {"type": "spike", "base": 5, "peak": 50, "at": 1, "width": 0.5,
+             "duration": 3}
+    assert [traffic.spike_rate(spike, t) for t in (0, 1, 1.4, 1.5)] == [
+        5, 50, 50, 5]
+
+
+@pytest.mark.run_default
+def test_arrival_schedule():
+    phases = [{"type": "step", "levels": [2, 4], "hold": 1},
+              {"type": "spike", "base": 0, "peak": 10, "at": 1, "width": 0.5,
+               "duration": 2}]
+    offsets = list(traffic.arrivals(phases))
+    assert offsets[:6] == pytest.approx([0, 0.5, 1, 1.25, 1.5, 1.75])
+    # the spike phase starts after the step phase and idles until its peak
+    spike = offsets[6:]
+    assert len(spike) in (4, 5)
+    assert all(3.0 <= t < 3.5 for t in spike)
+    assert offsets == sorted(offsets)
+
+
+@pytest.mark.run_default
+def test_poisson_arrivals(monkeypatch):
+    traffic.random.seed(1)
+    phases = [{"type": "poisson", "rate": 200, "duration": 5}]
+    offsets = list(traffic.arrivals(phases))
+    assert 900 < len(offsets) < 1100
+    assert all(0 < t < 5 for t in offsets)
+
+
+@pytest.mark.run_default
+def test_unknown_shape_is_rejected(tmp_path):
+    profile = tmp_path.joinpath("profile.json")
+    profile.write_text('{"phases": [{"type": "sine", "duration": 1}]}')
+    with pytest.raises(ValueError):
+        traffic.load_profile(profile)
+
+
+@pytest.mark.run_default
+def test_join_returns_when_process_dies(monkeypatch):
+    monkeypatch.setattr(traffic, "_shape_loop", killed_loop)
+    monkeypatch.setattr(traffic, "JOIN_POLL", 0.1)
+    shaper = traffic.TrafficShaper("http://localhost:1", {"phases": []})
+    rows = shaper.start().join()
+    assert rows == [{"second": 0}]
+    assert shaper.proc.exitcode == 3
+
+
+@pytest.mark.run_default
+def test_stop_drops_queued_requests():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SlowHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    # far more arrivals than one thread can send in the run
+    profile = {"threads": 1, "timeout": 5,
+               "phases": [{"type": "step", "levels": [100], "hold": 2}]}
+    try:
+        shaper = traffic.TrafficShaper(url, profile).start()
+        time.sleep(0.5)
+        stopped = time.time()
+        shaper.stop()
+        rows = shaper.join()
+    finally:
+        server.shutdown()
+        server.server_close()
+    # only the request in flight finishes, not the queued ones
+    assert time.time() - stopped < 2
+    assert sum(row["achieved"] for row in rows) <= 4
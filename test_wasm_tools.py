@@ -0,0 +1,62 @@
+import argparse
+import csv
+import shutil
+
+import pytest
+
+import kubernetes_env  # noqa: F401
+import kube_util as util
+import wasm_tools
+
+# the smallest valid module, just the header
+EMPTY_MODULE = b"\0asm\x01\0\0\0"
+
+
+@pytest.fixture
+def filter_dir(tmp_path):
+    wasm_dir = tmp_path.joinpath("rs-empty-filter", "wasm_bins")
+    wasm_dir.mkdir(parents=True)
+    wasm_dir.joinpath("filter.wasm").write_bytes(EMPTY_MODULE)
+    return wasm_dir.parent
+
+
+@pytest.mark.run_default
+def test_check_size(filter_dir, monkeypatch, caplog):
+    wasm_file = filter_dir.joinpath("wasm_bins/filter.wasm")
+    # 8 bytes take 12 once base64 encoded
+    assert wasm_tools.configmap_size(wasm_file) == 12
+    assert wasm_tools.check_size(wasm_file)
+    assert not caplog.records
+    monkeypatch.setattr(wasm_tools, "CONFIGMAP_LIMIT", 14)
+    assert wasm_tools.check_size(wasm_file)
+    assert "close to the limit" in caplog.text
+    monkeypatch.setattr(wasm_tools, "CONFIGMAP_LIMIT", 12)
+    assert not wasm_tools.check_size(wasm_file)
+
+
+@pytest.mark.run_default
+def test_optimize_without_binaryen(filter_dir, monkeypatch, caplog):
+    monkeypatch.setenv("PATH", "")
+    wasm_file = filter_dir.joinpath("wasm_bins/filter.wasm")
+    assert wasm_tools.optimize(wasm_file) is None
+    assert "wasm-opt not found" in caplog.text
+    assert wasm_file.read_bytes() == EMPTY_MODULE
+    assert wasm_tools.compile_time(wasm_file) is None
+    assert wasm_tools.optimize_filter(filter_dir) == util.EXIT_FAILURE
+    # asked for on the command line, the report is not written
+    args = argparse.Namespace(filter_dirs=[filter_dir], optimize="O3",
+                              runs=1, output_file="report.csv")
+    assert wasm_tools.main(args) == util.EXIT_FAILURE
+
+
+@pytest.mark.run_default
+@pytest.mark.skipif(shutil.which("node") is None, reason="needs node")
+def test_report(filter_dir, tmp_path):
+    output_file = tmp_path.joinpath("report.csv")
+    rows = wasm_tools.report([filter_dir], runs=2, output_file=output_file)
+    assert [row["module"] for row in rows] == ["filter.wasm"]
+    assert rows[0]["compile_ms"] >= 0
+    wasm_tools.report([filter_dir], runs=1, output_file=output_file)
+    with open(output_file) as csv_file:
+        lines = list(csv.DictReader(csv_file))
+    assert [line["filter"] for line in lines] == ["rs-empty-filter"] * 2